@@ -4,7 +4,6 @@ Multiple Plugin Agent for the New Relic Platform
 """
 import helper
 import importlib
-import json
 import logging
 import os
 import requests
@@ -15,6 +14,7 @@ import threading
 import time
 
 from newrelic_plugin_agent import __version__
+from newrelic_plugin_agent import codec
 from newrelic_plugin_agent import plugins
 
 LOGGER = logging.getLogger(__name__)
@@ -224,7 +224,7 @@ class NewRelicPluginAgent(helper.Controller):
             response = requests.post(self.endpoint,
                                      headers=self.http_headers,
                                      proxies=self.proxies,
-                                     data=json.dumps(body, ensure_ascii=False),
+                                     data=codec.dumps(body),
                                      timeout=self.config.get('newrelic_api_timeout', 10),
                                      verify=self.config.get('verify_ssl_cert',
                                                             True))
@@ -0,0 +1,67 @@
+"""
+JSON encoding and decoding, using the fastest library that is installed and
+falling back to the standard library json module.
+
+"""
+import importlib
+import json
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+BACKENDS = ['ujson', 'simplejson', 'json']
+
+# The ValueError message ujson uses for numbers that do not fit in 64 bits
+TOO_BIG = 'too big'
+
+
+def _import_backend():
+    """Return the first JSON library in BACKENDS that can be imported.
+
+    :rtype: module
+
+    """
+    for name in BACKENDS:
+        try:
+            return importlib.import_module(name)
+        except ImportError:
+            continue
+    return json
+
+backend = _import_backend()
+LOGGER.debug('Using %s for JSON encoding and decoding', backend.__name__)
+
+
+def dumps(value):
+    """Encode the value as JSON. Values the backend can not represent, such
+    as integers wider than 64 bits in ujson, are encoded with the standard
+    library instead.
+
+    :param mixed value: The value to encode
+    :rtype: str
+
+    """
+    try:
+        return backend.dumps(value, ensure_ascii=False)
+    except OverflowError:
+        return json.dumps(value, ensure_ascii=False)
+
+
+def loads(value):
+    """Decode the JSON document, raising ValueError if it is not valid. A
+    document with numbers the backend can not represent, such as integers
+    wider than 64 bits in ujson, is decoded with the standard library
+    instead. Invalid documents are not decoded a second time.
+
+    :param str value: The JSON document
+    :rtype: mixed
+
+    """
+    try:
+        return backend.loads(value)
+    except OverflowError:
+        return json.loads(value)
+    except ValueError as error:
+        if backend is json or TOO_BIG not in str(error).lower():
+            raise
+        return json.loads(value)
@@ -3,16 +3,33 @@ Base Plugin Classes
 
 """
 import csv
+import decimal
 import logging
 from os import path
+import Queue as queue
 import requests
 import socket
-import tempfile
+import threading
 import time
 import urlparse
 
+from newrelic_plugin_agent import codec
+
+try:
+    from ijson.backends import yajl2_c as ijson
+except ImportError:
+    try:
+        import ijson
+    except ImportError:
+        ijson = None
+
 LOGGER = logging.getLogger(__name__)
 
+# Values that outlive a single poll, such as connections and cached results,
+# keyed by plugin class and target configuration
+STATE = dict()
+STATE_LOCK = threading.Lock()
+
 
 class Plugin(object):
 
@@ -24,11 +41,32 @@ class Plugin(object):
         LOGGER.debug('%s config: %r', self.__class__.__name__, self.config)
         self.poll_interval = poll_interval
         self.poll_start_time = 0
+        self._state = None
+        self.children = dict()
 
         self.derive_values = dict()
         self.derive_last_interval = last_interval_values or dict()
         self.gauge_values = dict()
 
+    def add_child(self, name, config):
+        """Add a plugin instance for a component that is polled and reported
+        along with this one, such as a cluster member. The child's derive
+        values and state are kept with this plugin's, keyed by name.
+
+        :param str name: The name of the child
+        :param dict config: The configuration for the child
+        :rtype: Plugin
+
+        """
+        key = 'Child/%s' % name
+        child = self.__class__(config, self.poll_interval,
+                               self.derive_last_interval.get(key))
+        self.derive_last_interval[key] = child.derive_last_interval
+        child._state = self.state.setdefault('children',
+                                             dict()).setdefault(name, dict())
+        self.children[name] = child
+        return child
+
     def add_datapoints(self, data):
         """Extend this method to process the data points retrieved during the
         poll process.
@@ -142,6 +180,7 @@ class Plugin(object):
     def initialize(self):
         """Empty stats collection dictionaries for the polling interval"""
         self.poll_start_time = time.time()
+        self.children = dict()
         self.derive_values = dict()
         self.gauge_values = dict()
 
@@ -210,6 +249,89 @@ class Plugin(object):
         """
         raise NotImplementedError
 
+    def poll_children(self, max_threads=None):
+        """Poll the children added this interval concurrently, then forget
+        the derive values and state of children that were not added.
+
+        :param int max_threads: The maximum number of threads to use
+
+        """
+        self.run_concurrently([(child.poll, ())
+                               for child in self.children.values()],
+                              max_threads)
+        self.prune_children()
+
+    def prune_children(self):
+        """Forget the derive values and state of children that were not
+        added this interval.
+
+        """
+        for key in list(self.derive_last_interval):
+            if key.startswith('Child/') and key[6:] not in self.children:
+                del self.derive_last_interval[key]
+        states = self.state.get('children', dict())
+        for name in set(states) - set(self.children):
+            self.release_state(states.pop(name))
+
+    def release_state(self, state):
+        """Extend this method to close any connections held in the state of
+        a child that is no longer polled.
+
+        :param dict state: The child's state
+
+        """
+        pass
+
+    def run_concurrently(self, tasks, max_threads=None):
+        """Run each (callable, args) task in a thread, returning the results
+        in the same order as the tasks. If a task raises an exception it is
+        logged and its result is None.
+
+        :param list tasks: The list of (callable, args) tuples to run
+        :param int max_threads: The maximum number of threads to use
+        :rtype: list
+
+        """
+        results = [None] * len(tasks)
+        pending = queue.Queue()
+        for offset, task in enumerate(tasks):
+            pending.put((offset, task))
+
+        def worker():
+            while True:
+                try:
+                    offset, (method, args) = pending.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    results[offset] = method(*args)
+                except Exception as error:
+                    LOGGER.exception('Error running %s: %s',
+                                     method.__name__, error)
+
+        threads = [threading.Thread(target=worker)
+                   for _thread in range(min(len(tasks),
+                                            max_threads or len(tasks)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    @property
+    def state(self):
+        """Return the dict that persists across poll intervals for this
+        plugin class and target configuration.
+
+        :rtype: dict
+
+        """
+        if self._state is None:
+            key = (self.__class__.__name__, repr(sorted(self.config.items())))
+            with STATE_LOCK:
+                self._state = STATE.setdefault(key, dict())
+        return self._state
+
     def sum_of_squares(self, values):
         """Return the sum_of_squares for the given values
 
@@ -226,29 +348,35 @@ class Plugin(object):
         return sum(squares) - float(value_sum * value_sum) / len(values)
 
     def values(self):
-        """Return the poll results
+        """Return the poll results, as a list of components when there are
+        children.
 
-        :rtype: dict
+        :rtype: dict or list
 
         """
-        return self.component_data()
+        if not self.children:
+            return self.component_data()
+        return [self.component_data()] + [child.component_data() for child
+                                          in self.children.values()]
 
 
 class SocketStatsPlugin(Plugin):
     """Connect to a socket and collect stats data"""
     DEFAULT_HOST = 'localhost'
     DEFAULT_PORT = 0
+    DEFAULT_TIMEOUT = None
     SOCKET_RECV_MAX = 10485760
 
-    def connect(self):
+    def connect(self, timeout=None):
         """Top level interface to create a socket and connect it to the
         socket.
 
+        :param float timeout: The timeout for connecting and socket operations
         :rtype: socket
 
         """
         try:
-            connection = self.socket_connect()
+            connection = self.socket_connect(timeout)
         except socket.error as error:
             LOGGER.error('Error connecting to %s: %s',
                          self.__class__.__name__, error)
@@ -281,7 +409,8 @@ class SocketStatsPlugin(Plugin):
         self.initialize()
 
         # Fetch the data from the remote socket
-        connection = self.connect()
+        connection = self.connect(self.config.get('timeout',
+                                                  self.DEFAULT_TIMEOUT))
         if not connection:
             LOGGER.error('%s could not connect, skipping poll interval',
                          self.__class__.__name__)
@@ -296,9 +425,11 @@ class SocketStatsPlugin(Plugin):
         else:
             self.error_message()
 
-    def socket_connect(self):
-        """Low level interface to create a socket and connect to it.
+    def socket_connect(self, timeout=None):
+        """Low level interface to create a socket and connect to it, setting
+        the timeout before connecting so it also bounds the connect.
 
+        :param float timeout: The timeout for connecting and socket operations
         :rtype: socket
 
         """
@@ -307,6 +438,7 @@ class SocketStatsPlugin(Plugin):
                 LOGGER.debug('Connecting to UNIX domain socket: %s',
                              self.config['path'])
                 connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                connection.settimeout(timeout)
                 connection.connect(self.config['path'])
             else:
                 LOGGER.error('UNIX domain socket path does not exist: %s',
@@ -317,6 +449,7 @@ class SocketStatsPlugin(Plugin):
                            self.config.get('port', self.DEFAULT_PORT))
             LOGGER.debug('Connecting to %r', remote_host)
             connection = socket.socket()
+            connection.settimeout(timeout)
             connection.connect(remote_host)
         return connection
 
@@ -338,10 +471,11 @@ class HTTPStatsPlugin(Plugin):
         data = self.http_get()
         return data.content if data else ''
 
-    def http_get(self, url=None):
+    def http_get(self, url=None, stream=False):
         """Fetch the data from the stats URL or a specified one.
 
         :param str url: URL to fetch instead of the stats URL
+        :param bool stream: Defer reading the response body
         :rtype: requests.models.Response
 
         """
@@ -349,6 +483,8 @@ class HTTPStatsPlugin(Plugin):
                      self.__class__.__name__, url or self.stats_url)
         req_kwargs = self.request_kwargs
         req_kwargs.update({'url': url} if url else {})
+        if stream:
+            req_kwargs['stream'] = True
         try:
             response = requests.get(**req_kwargs)
         except requests.ConnectionError as error:
@@ -358,6 +494,7 @@ class HTTPStatsPlugin(Plugin):
         if response.status_code >= 300:
             LOGGER.error('Error response from %s (%s): %s', self.stats_url,
                          response.status_code, response.content)
+            response.close()
             return None
         return response
 
@@ -408,31 +545,58 @@ class HTTPStatsPlugin(Plugin):
 
 
 class CSVStatsPlugin(HTTPStatsPlugin):
-    """Extend the Plugin overriding poll for targets that provide JSON output
+    """Extend the Plugin overriding poll for targets that provide CSV output
     for stats collection
 
     """
+    CSV_COLUMNS = None
+    CHUNK_SIZE = 8192
+
     def fetch_data(self):
-        """Fetch the data from the stats URL
+        """Fetch the data from the stats URL, returning an iterator of rows
+        that is consumed as the response body is read.
 
-        :rtype: dict
+        :rtype: iterator
 
         """
-        data = super(CSVStatsPlugin, self).fetch_data()
-        if not data:
-            return dict()
-        temp = tempfile.TemporaryFile()
-        temp.write(data)
-        temp.seek(0)
-        reader = csv.DictReader(temp)
-        data = list()
-        for row in reader:
-            data.append(row)
-        temp.close()
-        return data
+        response = self.http_get(stream=True)
+        if not response:
+            return list()
+        return self.read_rows(response)
+
+    def read_rows(self, response):
+        """Parse the response body line by line, yielding a dict per row that
+        is restricted to CSV_COLUMNS when it is set. If reading the body
+        fails part way through, the error is logged and no more rows are
+        yielded. The response is closed when iteration ends.
+
+        :param requests.models.Response response: The streaming response
+        :rtype: iterator
+
+        """
+        try:
+            reader = csv.reader(response.iter_lines(self.CHUNK_SIZE))
+            try:
+                header = reader.next()
+            except StopIteration:
+                return
+            if self.CSV_COLUMNS is None:
+                columns = list(enumerate(header))
+            else:
+                columns = [(offset, name) for offset, name in enumerate(header)
+                           if name in self.CSV_COLUMNS]
+            for row in reader:
+                yield dict([(name, row[offset])
+                            for offset, name in columns
+                            if offset < len(row)])
+        except requests.RequestException as error:
+            LOGGER.error('Error reading stats from %s: %s', self.stats_url,
+                         error)
+        finally:
+            response.close()
 
     def poll(self):
-        """Poll HTTP JSON endpoint for stats data"""
+        """Poll HTTP CSV endpoint for stats data"""
         self.initialize()
         data = self.fetch_data()
         if data:
@@ -445,19 +609,122 @@ class JSONStatsPlugin(HTTPStatsPlugin):
     for stats collection
 
     """
+    JSON_PATHS = None
+
     def fetch_data(self):
         """Fetch the data from the stats URL
 
         :rtype: dict
 
         """
+        if self.JSON_PATHS and ijson:
+            return self.fetch_selected_data()
         data = self.http_get()
         try:
-            return data.json() if data else {}
+            return codec.loads(data.content) if data else {}
         except Exception as error:
             LOGGER.error('JSON decoding error: %r', error)
         return {}
 
+    def fetch_selected_data(self):
+        """Incrementally parse the response body, only materializing the
+        subtrees found at the key paths in JSON_PATHS.
+
+        :rtype: dict
+
+        """
+        response = self.http_get(stream=True)
+        if not response:
+            return {}
+        response.raw.decode_content = True
+        try:
+            return self.select_paths(ijson.basic_parse(response.raw),
+                                     self.JSON_PATHS) or {}
+        except Exception as error:
+            LOGGER.error('JSON decoding error: %r', error)
+        finally:
+            response.close()
+        return {}
+
+    @staticmethod
+    def path_match(path, paths):
+        """Return select if the path is at or below one of the key paths,
+        descend if it is an ancestor of one, otherwise None. A * in a key
+        path matches any object key or array element.
+
+        :param tuple path: The path to the current value
+        :param list paths: The key paths to match against
+        :rtype: str|None
+
+        """
+        result = None
+        for key_path in paths:
+            depth = min(len(key_path), len(path))
+            if all(key_path[offset] in ('*', path[offset])
+                   for offset in range(depth)):
+                if len(key_path) <= len(path):
+                    return 'select'
+                result = 'descend'
+        return result
+
+    def select_paths(self, events, paths):
+        """Build a document from ijson basic_parse events, skipping over any
+        value that is not on or below one of the key paths.
+
+        :param iterator events: The (event, value) parse events
+        :param list paths: The key paths to materialize
+        :rtype: mixed
+
+        """
+        root, stack, key, skip = dict(), list(), None, 0
+        for event, value in events:
+            if skip:
+                if event in ('start_map', 'start_array'):
+                    skip += 1
+                elif event in ('end_map', 'end_array'):
+                    skip -= 1
+                continue
+            if event == 'map_key':
+                key = value
+                continue
+            if event in ('end_map', 'end_array'):
+                stack.pop()
+                continue
+
+            if stack:
+                parent, parent_path, selected, offset = stack[-1]
+                if isinstance(parent, list):
+                    stack[-1][3] += 1
+                    path = parent_path + (offset,)
+                else:
+                    path = parent_path + (key,)
+            else:
+                parent, path, selected = root, (), False
+                key = None
+
+            nested = event in ('start_map', 'start_array')
+            if not selected:
+                match = self.path_match(path, paths)
+                if not match or (match == 'descend' and not nested):
+                    skip = 1 if nested else 0
+                    continue
+                selected = match == 'select'
+
+            if event == 'start_map':
+                value = dict()
+            elif event == 'start_array':
+                value = list()
+            elif isinstance(value, decimal.Decimal):
+                value = float(value)
+
+            if isinstance(parent, list):
+                parent.append(value)
+            else:
+                parent[key] = value
+            if nested:
+                stack.append([value, path, selected, 0])
+        return root.get(None)
+
     def poll(self):
         """Poll HTTP JSON endpoint for stats data"""
         self.initialize()
@@ -2,13 +2,38 @@
 Elastic Search
 
 """
+import heapq
 import logging
 import requests
+from requests import adapters
+import urlparse
 
+from newrelic_plugin_agent import codec
 from newrelic_plugin_agent.plugins import base
 
 LOGGER = logging.getLogger(__name__)
 
+# The node stats values that are reported, used to limit the response with
+# filter_path and the JSON_PATHS to parse when it is not supported
+NODE_STATS = [('name',),
+              ('http', 'total_opened'),
+              ('indices', 'docs'),
+              ('indices', 'flush'),
+              ('indices', 'get'),
+              ('indices', 'indexing'),
+              ('indices', 'merges'),
+              ('indices', 'search'),
+              ('indices', 'store'),
+              ('network', 'tcp'),
+              ('transport', 'rx_size_in_bytes'),
+              ('transport', 'tx_size_in_bytes')]
+
+# The index stats values reported for the most active indices with top_indices
+INDEX_STATS = ['total.indexing.index_total',
+               'total.search.query_time_in_millis',
+               'total.search.query_total',
+               'total.store.size_in_bytes']
+
 
 class ElasticSearch(base.JSONStatsPlugin):
 
@@ -18,9 +43,13 @@ class ElasticSearch(base.JSONStatsPlugin):
     GAUGE_MATCH = ['Current']
 
     DEFAULT_HOST = 'localhost'
-    DEFAULT_PATH = '/_nodes/stats?all'
+    DEFAULT_PATH = '/_nodes/stats/http,indices,transport'
     DEFAULT_PORT = 9200
+    DEFAULT_QUERY = 'filter_path=%s' % ','.join(['nodes.*.%s' % '.'.join(path)
+                                                 for path in NODE_STATS])
+    DEFAULT_TIMEOUT = 10
     GUID = 'com.meetme.newrelic_elasticsearch_node_agent'
+    JSON_PATHS = [('nodes', '*') + path for path in NODE_STATS]
 
     STATUS_CODE = {'green': 0, 'yellow': 1, 'red': 2}
 
@@ -31,43 +60,128 @@ class ElasticSearch(base.JSONStatsPlugin):
 
         """
         totals = dict()
-        for node in stats.get('nodes'):
-            for key in stats['nodes'][node].keys():
-                if isinstance(stats['nodes'][node][key], dict):
+        for node_id, node in stats.get('nodes', dict()).items():
+            for key in node.keys():
+                if isinstance(node[key], dict):
                     if key not in totals:
                         totals[key] = dict()
-                    self.process_tree(totals[key],
-                                      stats['nodes'][node][key])
+                    self.process_tree(totals[key], node[key])
+            if self.config.get('node_components'):
+                self.add_node_datapoints(node.get('name', node_id), node)
+        if self.config.get('node_components'):
+            self.prune_children()
 
         self.add_index_datapoints(totals)
         self.add_network_datapoints(totals)
-        self.add_cluster_stats()
-
-    def add_cluster_stats(self):
-        """Add stats that go under Component/Cluster"""
-        url = self.stats_url.replace(self.DEFAULT_PATH, '/_cluster/health')
-        response = self.http_get(url)
-        if response.status_code == 200:
-            data = response.json()
-            self.add_gauge_value('Cluster/Status', 'level',
-                                 self.STATUS_CODE[data.get('status', 'red')])
-            self.add_gauge_value('Cluster/Nodes', 'nodes',
-                                 data.get('number_of_nodes', 0))
-            self.add_gauge_value('Cluster/Data Nodes', 'nodes',
-                                 data.get('number_of_data_nodes', 0))
-            self.add_gauge_value('Cluster/Shards/Active', 'shards',
-                                 data.get('active_shards', 0))
-            self.add_gauge_value('Cluster/Shards/Initializing', 'shards',
-                                 data.get('initializing_shards', 0))
-            self.add_gauge_value('Cluster/Shards/Primary', 'shards',
-                                 data.get('active_primary_shards', 0))
-            self.add_gauge_value('Cluster/Shards/Relocating', 'shards',
-                                 data.get('relocating_shards', 0))
-            self.add_gauge_value('Cluster/Shards/Unassigned', 'shards',
-                                 data.get('unassigned_shards', 0))
-        else:
-            LOGGER.error('Error collecting cluster stats (%s): %s',
-                         response.status_code, response.content)
+
+    def add_node_datapoints(self, name, node):
+        """Report the stats for a single node as a separate component.
+
+        :param str name: The name of the node
+        :param dict node: The node's stats
+
+        """
+        child = self.add_child(name, dict(self.config, name=name,
+                                          node_components=False))
+        child.initialize()
+        child.add_index_datapoints(node)
+        child.add_network_datapoints(node)
+
+    def add_cluster_stats(self, data):
+        """Add stats that go under Component/Cluster
+
+        :param dict data: The cluster health response
+
+        """
+        self.add_gauge_value('Cluster/Status', 'level',
+                             self.STATUS_CODE.get(data.get('status', 'red'),
+                                                  self.STATUS_CODE['red']))
+        self.add_gauge_value('Cluster/Nodes', 'nodes',
+                             data.get('number_of_nodes', 0))
+        self.add_gauge_value('Cluster/Data Nodes', 'nodes',
+                             data.get('number_of_data_nodes', 0))
+        self.add_gauge_value('Cluster/Shards/Active', 'shards',
+                             data.get('active_shards', 0))
+        self.add_gauge_value('Cluster/Shards/Initializing', 'shards',
+                             data.get('initializing_shards', 0))
+        self.add_gauge_value('Cluster/Shards/Primary', 'shards',
+                             data.get('active_primary_shards', 0))
+        self.add_gauge_value('Cluster/Shards/Relocating', 'shards',
+                             data.get('relocating_shards', 0))
+        self.add_gauge_value('Cluster/Shards/Unassigned', 'shards',
+                             data.get('unassigned_shards', 0))
+
+    def add_index_stats(self, stats):
+        """Add the primary shard values from the index stats, which unlike
+        the node stats do not count the replicas, and the values for the most
+        active indices when top_indices is set.
+
+        :param dict stats: The index stats response
+
+        """
+        if self.config.get('index_stats'):
+            primaries = stats.get('_all', dict()).get('primaries', dict())
+            self.add_gauge_value('Indices/Primaries/Documents', 'docs',
+                                 primaries.get('docs', dict()).get('count', 0))
+            self.add_gauge_value('Indices/Primaries/Storage', 'bytes',
+                                 primaries.get('store',
+                                               dict()).get('size_in_bytes',
+                                                           0))
+        if self.config.get('top_indices'):
+            self.add_top_index_stats(stats.get('indices', dict()))
+
+    def add_index_values(self, prefix, values):
+        """Add the values for an index or the sum of the less active ones.
+
+        :param str prefix: The metric name prefix
+        :param list values: The indexed documents, search queries and search
+            query time since the last poll and the storage size
+
+        """
+        indexed, queries, query_time, storage = values
+        self.add_gauge_value('%s/Indexing' % prefix, 'docs', indexed)
+        self.add_gauge_value('%s/Search Queries' % prefix, 'queries',
+                             queries)
+        self.add_gauge_value('%s/Search Query Time' % prefix, 'ms',
+                             float(query_time) / queries if queries else 0)
+        self.add_gauge_value('%s/Storage' % prefix, 'bytes', storage)
+
+    def add_top_index_stats(self, indices):
+        """Add the values for the indices with the most documents indexed and
+        search queries since the last poll, summing the rest into an Other
+        bucket. Only the counters from the last poll are kept, so deleted
+        indices fall out of the state on the next poll.
+
+        :param dict indices: The stats by index name
+
+        """
+        previous, current = self.state.get('index_counters'), dict()
+        ranked, totals = list(), [0, 0, 0, 0]
+        for name, stats in indices.items():
+            total = stats.get('total', dict())
+            search = total.get('search', dict())
+            counters = (total.get('indexing', dict()).get('index_total', 0),
+                        search.get('query_total', 0),
+                        search.get('query_time_in_millis', 0))
+            current[name] = counters
+            last = (previous or dict()).get(name, counters)
+            values = [max(value - last[offset], 0)
+                      for offset, value in enumerate(counters)]
+            values.append(total.get('store', dict()).get('size_in_bytes', 0))
+            totals = [value + totals[offset]
+                      for offset, value in enumerate(values)]
+            if values[0] or values[1]:
+                ranked.append((values[0] + values[1], name, values))
+        self.state['index_counters'] = current
+        if previous is None:
+            return
+
+        for activity, name, values in heapq.nlargest(
+                int(self.config['top_indices']), ranked):
+            self.add_index_values('Index/%s' % name, values)
+            totals = [total - values[offset]
+                      for offset, total in enumerate(totals)]
+        self.add_index_values('Index/Other', totals)
 
     def add_index_datapoints(self, stats):
         """Add the data points for Component/Indices
@@ -128,7 +242,7 @@ class ElasticSearch(base.JSONStatsPlugin):
         self.add_derive_value('Indices/Search Fetch', 'ms',
                               search.get('fetch_time_in_millis', 0))
 
-        merge_stats = indices.get('merge', dict())
+        merge_stats = indices.get('merges', dict())
         self.add_derive_value('Indices/Merge', 'count',
                               merge_stats.get('total', 0))
         self.add_derive_value('Indices/Merge', 'ms',
@@ -141,7 +255,9 @@ class ElasticSearch(base.JSONStatsPlugin):
                               flush_stats.get('total_time_in_millis', 0))
 
     def add_network_datapoints(self, stats):
-        """Add the data points for Component/Network
+        """Add the data points for Component/Network. The TCP values are only
+        returned by Elasticsearch versions before 2.0 when the network metric
+        group is in the path, so they are left out when not returned.
 
         :param dict stats: The stats to process for the values
 
@@ -151,8 +267,12 @@ class ElasticSearch(base.JSONStatsPlugin):
                               transport.get('rx_size_in_bytes', 0))
         self.add_derive_value('Network/Traffic/Sent', 'bytes',
                               transport.get('tx_size_in_bytes', 0))
+        self.add_derive_value('Network/HTTP Connections', 'conn',
+                              stats.get('http', dict()).get('total_opened', 0))
 
-        network = stats.get('network', dict())
+        network = stats.get('network', dict()).get('tcp')
+        if not network:
+            return
         self.add_derive_value('Network/Connections/Active', 'conn',
                               network.get('active_opens', 0))
         self.add_derive_value('Network/Connections/Passive', 'conn',
@@ -161,10 +281,6 @@ class ElasticSearch(base.JSONStatsPlugin):
                               network.get('estab_resets', 0))
         self.add_derive_value('Network/Connections/Failures', 'conn',
                               network.get('attempt_fails', 0))
-
-        self.add_derive_value('Network/HTTP Connections', 'conn',
-                              stats.get('http', dict()).get('total_opened', 0))
-
         self.add_derive_value('Network/Segments/In', 'seg',
                               network.get('in_seg', 0))
         self.add_derive_value('Network/Segments/In', 'errors',
@@ -174,6 +290,116 @@ class ElasticSearch(base.JSONStatsPlugin):
         self.add_derive_value('Network/Segments/Retransmitted', 'seg',
                               network.get('retrans_segs', 0))
 
+    def api_url(self, path, query=None):
+        """Return the URL for an API path on the configured node.
+
+        :param str path: The API path
+        :param str query: The optional query string
+        :rtype: str
+
+        """
+        parts = urlparse.urlparse(self.stats_url)
+        return urlparse.urlunparse((parts.scheme, parts.netloc, path, None,
+                                    query, None))
+
+    def fetch_json(self, path, query=None):
+        """Fetch and decode the response for an API path, returning None if
+        the request failed.
+
+        :param str path: The API path
+        :param str query: The optional query string
+        :rtype: dict or None
+
+        """
+        response = self.http_get(self.api_url(path, query))
+        if not response:
+            return None
+        try:
+            return codec.loads(response.content)
+        except Exception as error:
+            LOGGER.error('JSON decoding error for %s: %r', path, error)
+        return None
+
+    def get_session(self):
+        """Return the requests session kept in state, with a connection pool
+        large enough for the concurrent requests of a poll.
+
+        :rtype: requests.Session
+
+        """
+        if 'session' not in self.state:
+            adapter = adapters.HTTPAdapter(pool_maxsize=3)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self.state['session'] = session
+        return self.state['session']
+
+    def http_get(self, url=None, stream=False):
+        """Fetch the data from the stats URL or a specified one over the
+        session kept in state, reusing its connections between polls.
+
+        :param str url: URL to fetch instead of the stats URL
+        :param bool stream: Defer reading the response body
+        :rtype: requests.models.Response or None
+
+        """
+        kwargs = self.request_kwargs
+        kwargs.update({'url': url} if url else {})
+        kwargs['stream'] = stream
+        kwargs['timeout'] = self.config.get('timeout', self.DEFAULT_TIMEOUT)
+        try:
+            response = self.get_session().get(**kwargs)
+        except requests.RequestException as error:
+            LOGGER.error('Error fetching data from %s: %s', kwargs['url'],
+                         error)
+            return None
+
+        if response.status_code >= 300:
+            LOGGER.error('Error response from %s (%s): %s', kwargs['url'],
+                         response.status_code, response.content)
+            return None
+        return response
+
+    def poll(self):
+        """Fetch the node stats, cluster health and, when enabled, the index
+        stats at the same time, adding the values from each request that
+        succeeded.
+
+        """
+        self.initialize()
+        tasks = [(self.fetch_data, ()),
+                 (self.fetch_json, ('/_cluster/health',))]
+        if self.config.get('index_stats') or self.config.get('top_indices'):
+            tasks.append((self.fetch_json, ('/_stats/docs,indexing,search,'
+                                            'store', self.index_stats_query)))
+
+        # Create the session before the requests share it
+        self.get_session()
+        results = self.run_concurrently(tasks)
+        if results[0]:
+            self.add_datapoints(results[0])
+        if results[1]:
+            self.add_cluster_stats(results[1])
+        if len(results) > 2 and results[2]:
+            self.add_index_stats(results[2])
+        self.finish()
+
+    @property
+    def index_stats_query(self):
+        """Return the query string limiting the index stats response to the
+        values that are reported.
+
+        :rtype: str
+
+        """
+        paths = list()
+        if self.config.get('index_stats'):
+            paths += ['_all.primaries.docs', '_all.primaries.store']
+        if self.config.get('top_indices'):
+            paths += ['indices.*.%s' % path for path in INDEX_STATS]
+        return 'filter_path=%s' % ','.join(paths)
+
     def process_tree(self, tree, values):
         """Recursively combine all node stats into a single top-level value
 
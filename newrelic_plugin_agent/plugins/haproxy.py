@@ -11,6 +11,9 @@ LOGGER = logging.getLogger(__name__)
 
 class HAProxy(base.CSVStatsPlugin):
 
+    CSV_COLUMNS = ['qcur', 'qmax', 'scur', 'smax', 'stot', 'bin', 'bout',
+                   'dreq', 'dresp', 'ereq', 'eresp', 'econ', 'wretr',
+                   'wredis', 'downtime']
     DEFAULT_PATH = 'haproxy?stats;csv'
     GUID = 'com.meetme.newrelic_haproxy_agent'
     UNIT = {'Queue': {'Current': 'connections', 'Max': 'connections'},
@@ -57,7 +60,7 @@ class HAProxy(base.CSVStatsPlugin):
     def add_datapoints(self, stats):
         """Add all of the data points for a node
 
-        :param list stats: The parsed csv content
+        :param iterator stats: The parsed csv rows
 
         """
         if not stats:
@@ -3,6 +3,7 @@ memcached
 
 """
 import logging
+import socket
 
 from newrelic_plugin_agent.plugins import base
 
@@ -12,7 +13,9 @@ LOGGER = logging.getLogger(__name__)
 class Memcached(base.SocketStatsPlugin):
 
     GUID = 'com.meetme.newrelic_memcached_agent'
+    COMMANDS = ['stats', 'stats slabs', 'stats items']
     DEFAULT_PORT = 11211
+    DEFAULT_TIMEOUT = 10
     KEYS = ['curr_connections',
             'curr_items',
             'connection_structures',
@@ -78,6 +81,54 @@ class Memcached(base.SocketStatsPlugin):
                               stats['rusage_user'])
         self.add_gauge_value('System/Memory', 'bytes', stats['bytes'])
 
+        self.add_gauge_value('Slabs/Active', 'slabs',
+                             stats.get('active_slabs', 0))
+        self.add_gauge_value('Slabs/Memory/Allocated', 'bytes',
+                             stats.get('total_malloced', 0))
+        for slab, slab_stats in stats['slabs'].items():
+            self.add_slab_datapoints(slab, slab_stats)
+
+    def add_slab_datapoints(self, slab, stats):
+        """Add the memory, item, eviction and age values for a slab class from
+        the stats slabs and stats items values.
+
+        :param str slab: The slab class id
+        :param dict stats: The slab class values
+
+        """
+        metric = 'Slabs/%s' % slab
+        chunk_size = stats.get('chunk_size', 0)
+        used_chunks = stats.get('used_chunks', 0)
+        self.add_gauge_value('%s/Chunk Size' % metric, 'bytes', chunk_size)
+        self.add_gauge_value('%s/Pages' % metric, 'pages',
+                             stats.get('total_pages', 0))
+        self.add_gauge_value('%s/Chunks/Used' % metric, 'chunks', used_chunks)
+        self.add_gauge_value('%s/Chunks/Free' % metric, 'chunks',
+                             stats.get('free_chunks', 0))
+        self.add_gauge_value('%s/Memory/Allocated' % metric, 'bytes',
+                             chunk_size * stats.get('total_chunks', 0))
+        self.add_gauge_value('%s/Memory/Requested' % metric, 'bytes',
+                             stats.get('mem_requested', 0))
+        if used_chunks and chunk_size:
+            self.add_gauge_value('%s/Memory/Efficiency' % metric, 'ratio',
+                                 100.0 * stats.get('mem_requested', 0) /
+                                 (chunk_size * used_chunks))
+
+        self.add_gauge_value('%s/Items' % metric, 'items',
+                             stats.get('number', 0))
+        self.add_gauge_value('%s/Age' % metric, 'seconds',
+                             stats.get('age', 0))
+        self.add_gauge_value('%s/Eviction Age' % metric, 'seconds',
+                             stats.get('evicted_time', 0))
+        self.add_derive_value('%s/Evictions' % metric, 'items',
+                              stats.get('evicted', 0))
+        self.add_derive_value('%s/Evictions/Unfetched' % metric, 'items',
+                              stats.get('evicted_unfetched', 0))
+        self.add_derive_value('%s/Expired Unfetched' % metric, 'items',
+                              stats.get('expired_unfetched', 0))
+        self.add_derive_value('%s/Out of Memory' % metric, 'errors',
+                              stats.get('outofmemory', 0))
+
     def command_value(self, name, prefix, stats):
         """Process commands adding the command and the hit ratio.
 
@@ -95,47 +146,91 @@ class Memcached(base.SocketStatsPlugin):
         self.add_gauge_value('Command/Hit Ratio/%s' % name, 'ratio', ratio)
 
     def fetch_data(self, connection):
-        """Loop in and read in all the data until we have received it all.
+        """Send the stats, stats slabs and stats items commands in a single
+        write, then parse the replies line by line as they arrive until each
+        has been terminated by END.
 
         :param  socket connection: The connection
+        :rtype: dict
 
         """
-        connection.send("stats\n")
-        data = super(Memcached, self).fetch_data(connection)
-        data_in = []
-        for line in data.replace('\r', '').split('\n'):
-            if line == 'END':
-                return self.process_data(data_in)
-            data_in.append(line.strip())
-        return None
-
-    def process_data(self, data):
-        """Loop through all the rows and parse each line, looking to see if it
-        is in the data points we would like to process, adding the key => value
-        pair to values if it is.
-
-        :param list data: The list of rows
-        :returns: dict
-
-        """
-        values = dict()
-        for row in data:
-            parts = row.split(' ')
-            if parts[1] in self.KEYS:
-                try:
-                    values[parts[1]] = int(parts[2])
-                except ValueError:
-                    try:
-                        values[parts[1]] = float(parts[2])
-                    except ValueError:
-                        LOGGER.warning('Could not parse line: %r', parts)
-                        values[parts[1]] = 0
+        values, slabs = dict(), dict()
+        replies, pending = 0, ''
+        try:
+            connection.sendall(''.join(['%s\r\n' % command
+                                        for command in self.COMMANDS]))
+        except socket.error as error:
+            LOGGER.error('Error sending stats commands: %s', error)
+            return None
+        while replies < len(self.COMMANDS):
+            try:
+                chunk = connection.recv(self.SOCKET_RECV_MAX)
+            except socket.error as error:
+                LOGGER.error('Error reading stats after %i of %i replies: %s',
+                             replies, len(self.COMMANDS), error)
+                return None
+            if not chunk:
+                LOGGER.error('Connection closed after %i of %i replies',
+                             replies, len(self.COMMANDS))
+                return None
+            lines = (pending + chunk).split('\r\n')
+            pending = lines.pop()
+            for line in lines:
+                if line in ('END', 'ERROR'):
+                    replies += 1
+                else:
+                    self.process_line(replies, line, values, slabs)
 
         # Back fill any missed data
         for key in self.KEYS:
             if key not in values:
                 LOGGER.info('Populating missing element with 0: %s', key)
                 values[key] = 0
-
-        # Return the values dict
+        values['slabs'] = slabs
         return values
+
+    def process_line(self, reply, line, values, slabs):
+        """Parse a STAT line, adding the general stats we would like to
+        process to values and the per slab class stats to slabs.
+
+        :param int reply: The offset of the command the line is a reply to
+        :param str line: The line to parse
+        :param dict values: The general stats
+        :param dict slabs: The stats by slab class id
+
+        """
+        parts = line.split(' ')
+        if len(parts) != 3 or parts[0] != 'STAT':
+            return
+        if reply == 0:
+            if parts[1] in self.KEYS:
+                values[parts[1]] = self.parse_value(parts)
+            return
+
+        # stats slabs lines are "<id>:<name>", stats items "items:<id>:<name>"
+        fields = parts[1].split(':')
+        if reply == 2 and len(fields) == 3:
+            slabs.setdefault(fields[1], dict())[fields[2]] = \
+                self.parse_value(parts)
+        elif reply == 1 and len(fields) == 2:
+            slabs.setdefault(fields[0], dict())[fields[1]] = \
+                self.parse_value(parts)
+        elif reply == 1:
+            values[parts[1]] = self.parse_value(parts)
+
+    @staticmethod
+    def parse_value(parts):
+        """Return the value of a STAT line as an int or float
+
+        :param list parts: The parts of the line
+        :rtype: int or float
+
+        """
+        try:
+            return int(parts[2])
+        except ValueError:
+            try:
+                return float(parts[2])
+            except ValueError:
+                LOGGER.warning('Could not parse line: %r', parts)
+                return 0
@@ -3,6 +3,7 @@ MongoDB Support
 
 """
 import datetime
+import fnmatch
 from pymongo import errors
 import logging
 import pymongo
@@ -11,10 +12,21 @@ from newrelic_plugin_agent.plugins import base
 
 LOGGER = logging.getLogger(__name__)
 
+# serverStatus sections the plugin does not report on, which are excluded
+# from the response unless listed in server_status_sections
+EXCLUDED_SECTIONS = ['locks', 'logicalSessionRecordCache', 'opLatencies',
+                     'repl', 'security', 'storageEngine', 'tcmalloc',
+                     'transactions', 'wiredTiger']
+
+# serverStatus sections that are only reported on when listed in
+# server_status_sections
+OPTIONAL_SECTIONS = ['metrics', 'tcmalloc', 'wiredTiger']
+
 
 class MongoDB(base.Plugin):
 
     GUID = 'com.meetme.newrelic_mongodb_plugin_agent'
+    DEFAULT_MAX_CONCURRENCY = 4
 
     def add_datapoints(self, name, stats):
         """Add all of the data points for a database
@@ -75,9 +87,14 @@ class MongoDB(base.Plugin):
         self.add_gauge_value('Connections/Current', 'connections',
                              conn.get('current', 0))
 
-        cursors = stats.get('cursors', dict())
-        self.add_gauge_value('Cursors/Open', 'cursors',
-                             cursors.get('totalOpen', 0))
+        # MongoDB 3.2 moved the cursor counts into metrics.cursor
+        if 'cursors' in stats:
+            cursors = stats['cursors']
+            open_cursors = cursors.get('totalOpen', 0)
+        else:
+            cursors = stats.get('metrics', dict()).get('cursor', dict())
+            open_cursors = cursors.get('open', dict()).get('total', 0)
+        self.add_gauge_value('Cursors/Open', 'cursors', open_cursors)
         self.add_derive_value('Cursors/Timed Out', 'cursors',
                               cursors.get('timedOut', 0))
 
@@ -176,6 +193,130 @@ class MongoDB(base.Plugin):
         self.add_derive_value('System/Page Faults', 'faults',
                               extra.get('page_faults', 0))
 
+        sections = self.config.get('server_status_sections') or list()
+        if 'metrics' in sections:
+            self.add_metrics_datapoints(stats.get('metrics', dict()))
+        if 'tcmalloc' in sections:
+            self.add_tcmalloc_datapoints(stats.get('tcmalloc', dict()))
+        if 'wiredTiger' in sections:
+            self.add_wiredtiger_datapoints(stats.get('wiredTiger', dict()))
+
+    def add_metrics_datapoints(self, metrics):
+        """Add the document and query executor counters from the optional
+        metrics section of serverStatus
+
+        :param dict metrics: The metrics section
+
+        """
+        document = metrics.get('document', dict())
+        self.add_derive_value('Documents/Deleted', 'documents',
+                              document.get('deleted', 0))
+        self.add_derive_value('Documents/Inserted', 'documents',
+                              document.get('inserted', 0))
+        self.add_derive_value('Documents/Returned', 'documents',
+                              document.get('returned', 0))
+        self.add_derive_value('Documents/Updated', 'documents',
+                              document.get('updated', 0))
+
+        executor = metrics.get('queryExecutor', dict())
+        self.add_derive_value('Query Executor/Scanned Keys', 'keys',
+                              executor.get('scanned', 0))
+        self.add_derive_value('Query Executor/Scanned Objects', 'objects',
+                              executor.get('scannedObjects', 0))
+
+    def add_tcmalloc_datapoints(self, tcmalloc):
+        """Add the allocator values from the optional tcmalloc section of
+        serverStatus
+
+        :param dict tcmalloc: The tcmalloc section
+
+        """
+        generic = tcmalloc.get('generic', dict())
+        self.add_gauge_value('Memory/Allocator/Allocated', 'bytes',
+                             generic.get('current_allocated_bytes', 0))
+        self.add_gauge_value('Memory/Allocator/Heap Size', 'bytes',
+                             generic.get('heap_size', 0))
+        self.add_gauge_value('Memory/Allocator/Page Heap Free', 'bytes',
+                             tcmalloc.get('tcmalloc', dict()).get(
+                                 'pageheap_free_bytes', 0))
+
+    def add_wiredtiger_datapoints(self, wiredtiger):
+        """Add the cache and ticket values from the optional wiredTiger
+        section of serverStatus
+
+        :param dict wiredtiger: The wiredTiger section
+
+        """
+        cache = wiredtiger.get('cache', dict())
+        self.add_gauge_value('WiredTiger/Cache/Used', 'bytes',
+                             cache.get('bytes currently in the cache', 0))
+        self.add_gauge_value('WiredTiger/Cache/Dirty', 'bytes',
+                             cache.get('tracked dirty bytes in the cache', 0))
+        self.add_gauge_value('WiredTiger/Cache/Maximum', 'bytes',
+                             cache.get('maximum bytes configured', 0))
+        self.add_derive_value('WiredTiger/Cache/Pages Read', 'pages',
+                              cache.get('pages read into cache', 0))
+        self.add_derive_value('WiredTiger/Cache/Pages Written', 'pages',
+                              cache.get('pages written from cache', 0))
+
+        tickets = wiredtiger.get('concurrentTransactions', dict())
+        for name in ['read', 'write']:
+            values = tickets.get(name, dict())
+            self.add_gauge_value('WiredTiger/Tickets/%s/Used' %
+                                 name.title(), 'tickets',
+                                 values.get('out', 0))
+            self.add_gauge_value('WiredTiger/Tickets/%s/Available' %
+                                 name.title(), 'tickets',
+                                 values.get('available', 0))
+
+    def add_member_datapoints(self, member, newest):
+        """Add the replica set state of a member, with its replication lag
+        behind the newest optime in the set.
+
+        :param dict member: The member from replSetGetStatus
+        :param datetime.datetime newest: The newest optime in the set
+
+        """
+        self.add_gauge_value('Replication/State', 'state',
+                             member.get('state', 0))
+        self.add_gauge_value('Replication/Health', 'health',
+                             member.get('health', 0))
+        if newest and member.get('optimeDate'):
+            lag = newest - member['optimeDate']
+            self.add_gauge_value('Replication/Lag', 'seconds',
+                                 max(lag.days * 86400 + lag.seconds +
+                                     lag.microseconds / 1000000.0, 0))
+
+    def authenticate(self, client):
+        """Authenticate the new client as the admin user and as the users for
+        each database with credentials. The credentials are kept by the
+        client, so this only needs to happen once for each client.
+
+        :param pymongo.MongoClient client: The client to authenticate
+        :rtype: bool
+
+        """
+        try:
+            if self.config.get('admin_username'):
+                client.admin.authenticate(self.config['admin_username'],
+                                          self.config.get('admin_password'))
+        except errors.OperationFailure as error:
+            LOGGER.error('Could not authenticate as the admin user: %s',
+                         error)
+            return False
+        databases = self.config.get('databases', list())
+        if isinstance(databases, dict):
+            for database, credentials in databases.items():
+                if 'username' not in (credentials or dict()):
+                    continue
+                try:
+                    client[database].authenticate(credentials['username'],
+                                                  credentials.get('password'))
+                except errors.OperationFailure as error:
+                    LOGGER.critical('Could not authenticate to %s: %s',
+                                    database, error)
+        return True
+
     def connect(self):
         kwargs = {'host': self.config.get('host', 'localhost'),
                   'port': self.config.get('port', 27017)}
@@ -188,71 +329,179 @@ class MongoDB(base.Plugin):
         except pymongo.errors.ConnectionFailure as error:
             LOGGER.error('Could not connect to MongoDB: %s', error)
 
-    def get_and_add_db_stats(self):
-        """Fetch the data from the MongoDB server and add the datapoints
+    def database_names(self, client):
+        """Return the databases to fetch dbStats for, either as configured or
+        from listDatabases filtered by the include_databases and
+        exclude_databases patterns.
+
+        :param pymongo.MongoClient client: The client to query with
+        :rtype: list
 
         """
-        databases = self.config.get('databases', list())
-        if isinstance(databases, list):
-            self.get_and_add_db_list(databases)
-        else:
-            self.get_and_add_db_dict(databases)
+        if not self.config.get('discover_databases'):
+            return list(self.config.get('databases') or list())
+        include = self.config.get('include_databases') or ['*']
+        exclude = self.config.get('exclude_databases') or list()
+        response = client.admin.command('listDatabases', nameOnly=True)
+        return [database['name'] for database in response['databases']
+                if any([fnmatch.fnmatch(database['name'], pattern)
+                        for pattern in include]) and
+                not any([fnmatch.fnmatch(database['name'], pattern)
+                         for pattern in exclude])]
+
+    def fetch_db_stats(self, client, database):
+        """Return the dbStats for a database, or None if they could not be
+        fetched.
+
+        :param pymongo.MongoClient client: The client to query with
+        :param str database: The database name
+        :rtype: dict or None
 
-    def get_and_add_db_list(self, databases):
-        """Handle the list of databases while supporting authentication for
-        the admin if needed
+        """
+        LOGGER.debug('Collecting stats for %s', database)
+        try:
+            return client[database].command('dbStats')
+        except errors.OperationFailure as error:
+            LOGGER.critical('Could not fetch stats: %s', error)
+
+    def get_and_add_db_stats(self, client):
+        """Fetch the dbStats for each configured database, running up to
+        max_concurrency commands at a time, and add the datapoints
+
+        :param pymongo.MongoClient client: The client to query with
 
-        :param list databases: The database list
+        """
+        databases = self.database_names(client)
+        results = self.run_concurrently(
+            [(self.fetch_db_stats, (client, database))
+             for database in databases],
+            int(self.config.get('max_concurrency',
+                                self.DEFAULT_MAX_CONCURRENCY)))
+        for database, stats in zip(databases, results):
+            if stats:
+                self.add_datapoints(database, stats)
+
+    def get_and_add_member_stats(self, client):
+        """Poll the other replica set members as separate components,
+        concurrently, and add the replication state and lag for each member
+        from the optimes returned by replSetGetStatus.
+
+        :param pymongo.MongoClient client: The client to query with
 
         """
-        LOGGER.debug('Processing list of mongo databases')
-        client = self.connect()
-        if not client:
+        try:
+            status = client.admin.command('replSetGetStatus')
+        except errors.OperationFailure as error:
+            LOGGER.debug('Not polling replica set members: %s', error)
             return
-        for database in databases:
-            LOGGER.debug('Collecting stats for %s', database)
-            db = client[database]
-            try:
-                self.add_datapoints(database, db.command('dbStats'))
-            except errors.OperationFailure as error:
-                LOGGER.critical('Could not fetch stats: %s', error)
+        members = status.get('members', list())
+        optimes = [member['optimeDate'] for member in members
+                   if member.get('optimeDate')]
+        primaries = [member['optimeDate'] for member in members
+                     if member.get('state') == 1 and
+                     member.get('optimeDate')]
+        newest = primaries[0] if primaries else max(optimes or [None])
+        self.add_gauge_value('Replica Set/Members', 'members', len(members))
+        self.add_gauge_value('Replica Set/Healthy Members', 'members',
+                             len([member for member in members
+                                  if member.get('health') == 1]))
+
+        polled = list()
+        for member in members:
+            if member.get('self'):
+                self.add_member_datapoints(member, newest)
+                continue
+            host, _separator, port = member['name'].rpartition(':')
+            config = dict(self.config, name=member['name'], host=host,
+                          port=int(port), databases=list(),
+                          discover_databases=False, discover_members=False)
+            polled.append((self.add_child(member['name'], config), member))
+        self.poll_children(int(self.config.get('max_concurrency',
+                                               self.DEFAULT_MAX_CONCURRENCY)))
+        for child, member in polled:
+            child.add_member_datapoints(member, newest)
+
+    def get_and_add_server_stats(self, client):
+        LOGGER.debug('Fetching server stats')
+        stats = client.admin.command('serverStatus',
+                                     **self.server_status_exclusions())
+        self.state['server_version'] = self.parse_version(
+            stats.get('version'))
+        self.add_server_datapoints(stats)
 
-    def get_and_add_db_dict(self, databases):
-        """Handle the nested database structure with username and password.
+    def get_client(self):
+        """Return the MongoClient for the target, which is kept for the life
+        of the agent so its connection pool and monitor threads are reused
+        between polls.
 
-        :param dict databases: The databases data structure
+        :rtype: pymongo.MongoClient or None
 
         """
-        LOGGER.debug('Processing dict of mongo databases')
-        client = self.connect()
-        if not client:
-            return
-        db_names = databases.keys()
-        for database in db_names:
-            db = client[database]
-            try:
-                if 'username' in databases[database]:
-                    db.authenticate(databases[database]['username'],
-                                    databases[database].get('password'))
-                self.add_datapoints(database, db.command('dbStats'))
-                if 'username' in databases[database]:
-                    db.logout()
-            except errors.OperationFailure as error:
-                LOGGER.critical('Could not fetch stats: %s', error)
-
-    def get_and_add_server_stats(self):
-        LOGGER.debug('Fetching server stats')
-        client = self.connect()
-        if not client:
-            return
-        if self.config.get('admin_username'):
-            client.admin.authenticate(self.config['admin_username'],
-                                   self.config.get('admin_password'))
-        self.add_server_datapoints(client.db.command('serverStatus'))
-        client.close()
+        client = self.state.get('client')
+        if client is None:
+            client = self.connect()
+            if not client or not self.authenticate(client):
+                if client:
+                    client.close()
+                return None
+            self.state['client'] = client
+        return client
+
+    @staticmethod
+    def parse_version(version):
+        """Return the server version string as a tuple of integers
+
+        :param str version: The version from serverStatus
+        :rtype: tuple or None
+
+        """
+        try:
+            return tuple([int(part) for part in
+                          (version or '').split('-')[0].split('.')])
+        except ValueError:
+            return None
+
+    def release_state(self, state):
+        """Close the client of a replica set member that is no longer polled
+
+        :param dict state: The member's state
+
+        """
+        client = state.get('client')
+        if client:
+            client.close()
+
+    def server_status_exclusions(self):
+        """Return the serverStatus options that leave out the sections the
+        plugin does not report on. The metrics section holds the cursor
+        counts from MongoDB 3.2 on, so it is only excluded for older
+        servers, using the version from the last serverStatus response.
+        Only the optional sections can be requested with
+        server_status_sections, as the others are never reported on.
+
+        :rtype: dict
+
+        """
+        sections = [section for section in
+                    self.config.get('server_status_sections') or list()
+                    if section in OPTIONAL_SECTIONS]
+        exclusions = dict([(section, 0) for section in EXCLUDED_SECTIONS
+                           if section not in sections])
+        version = self.state.get('server_version')
+        if 'metrics' not in sections and version and version < (3, 2):
+            exclusions['metrics'] = 0
+        return exclusions
 
     def poll(self):
         self.initialize()
-        self.get_and_add_server_stats()
-        self.get_and_add_db_stats()
+        client = self.get_client()
+        if client:
+            try:
+                self.get_and_add_server_stats(client)
+                self.get_and_add_db_stats(client)
+                if self.config.get('discover_members'):
+                    self.get_and_add_member_stats(client)
+            except errors.ConnectionFailure as error:
+                LOGGER.error('Could not collect stats from MongoDB: %s',
+                             error)
         self.finish()
@@ -2,87 +2,210 @@
 pgBouncer Plugin Support
 
 """
+import calendar
 import logging
+import time
 
 from newrelic_plugin_agent.plugins import postgresql
 
 LOGGER = logging.getLogger(__name__)
 
+LIST_METRICS = {'databases': ('Overview/Databases', 'databases'),
+                'pools': ('Overview/Pools', 'pools'),
+                'users': ('Overview/Users', 'users'),
+                'free_clients': ('Overview/Clients/Free', 'clients'),
+                'used_clients': ('Overview/Clients/Used', 'clients'),
+                'free_servers': ('Overview/Servers/Free', 'servers'),
+                'used_servers': ('Overview/Servers/Used', 'servers')}
+
+# (column, metric name, unit) for the SHOW POOLS counters
+POOL_METRICS = [('cl_active', 'Clients/Active', 'clients'),
+                ('cl_waiting', 'Clients/Waiting', 'clients'),
+                ('sv_active', 'Servers/Active', 'servers'),
+                ('sv_idle', 'Servers/Idle', 'servers'),
+                ('sv_login', 'Servers/Login', 'servers'),
+                ('sv_tested', 'Servers/Tested', 'servers'),
+                ('sv_used', 'Servers/Used', 'servers')]
+
 
 class PgBouncer(postgresql.PostgreSQL):
 
     GUID = 'com.meetme.newrelic_pgbouncer_agent'
-    MULTIROW = ['POOLS', 'STATS']
-
-    def add_pgbouncer_stats(self, stats):
-
-        self.add_gauge_value('Overview/Databases', 'databases',
-                             stats['LISTS']['databases'])
-        self.add_gauge_value('Overview/Pools', 'pools',
-                             stats['LISTS']['pools'])
-        self.add_gauge_value('Overview/Users', 'users',
-                             stats['LISTS']['users'])
-
-        self.add_gauge_value('Overview/Clients/Free', 'clients',
-                             stats['LISTS']['free_clients'])
-        self.add_gauge_value('Overview/Clients/Used', 'clients',
-                             stats['LISTS']['used_clients'])
-        self.add_gauge_value('Overview/Servers/Free', 'servers',
-                             stats['LISTS']['free_servers'])
-        self.add_gauge_value('Overview/Servers/Used', 'servers',
-                             stats['LISTS']['used_servers'])
 
+    def add_stats(self):
+        self.query(self.add_console_stats)
+
+    def add_console_stats(self, cursor):
+        """Add the stats from the SHOW commands of the admin console
+
+        :param psycopg2.cursor cursor: The cursor to query with
+
+        """
+        self.add_list_stats(cursor)
+        self.add_request_stats(cursor)
+        self.add_pool_stats(cursor)
+        self.add_connection_stats(cursor, 'SERVERS', 'Servers')
+        self.add_connection_stats(cursor, 'CLIENTS', 'Clients')
+
+    def add_connection_stats(self, cursor, command, kind):
+        """Add the per-pool connection age distribution from SHOW SERVERS or
+        SHOW CLIENTS, and the wait time distribution for waiting clients. The
+        rows are aggregated as they are read, so only the running totals for
+        each pool are kept.
+
+        :param psycopg2.cursor cursor: The cursor to query with
+        :param str command: The SHOW command to run
+        :param str kind: The metric name for the connection type
+
+        """
+        cursor.execute('SHOW %s' % command)
+        columns = [column[0] for column in cursor.description]
+        wait_us = 'wait_us' in columns
+        now, timestamps = time.time(), dict()
+        ages, waits = dict(), dict()
+        for row in cursor:
+            connected = self.parse_timestamp(row['connect_time'], timestamps)
+            if connected:
+                self.accumulate(ages, row['database'], now - connected)
+            if kind != 'Clients' or row['state'] != 'waiting':
+                continue
+            if wait_us:
+                wait = row['wait'] + row['wait_us'] / 1000000.0
+            else:
+                requested = self.parse_timestamp(row['request_time'],
+                                                 timestamps)
+                if not requested:
+                    continue
+                wait = now - requested
+            self.accumulate(waits, row['database'], wait)
+
+        for name, distributions in [('Connection Age', ages),
+                                    ('Wait Time', waits)]:
+            for database, (count, total, min_val, max_val,
+                           squares) in distributions.items():
+                self.add_gauge_value('Pools/%s/%s/%s' %
+                                     (database, kind, name), 'seconds',
+                                     total, min_val, max_val, count, squares)
+
+    def add_list_stats(self, cursor):
+        cursor.execute('SHOW LISTS')
+        for row in cursor:
+            if row['list'] in LIST_METRICS:
+                name, unit = LIST_METRICS[row['list']]
+                self.add_gauge_value(name, unit, row['items'])
+
+    def add_pool_stats(self, cursor):
+        """Add the SHOW POOLS counters, summing the pools for each user of a
+        database and taking the longest wait.
+
+        :param psycopg2.cursor cursor: The cursor to query with
+
+        """
+        cursor.execute('SHOW POOLS')
+        pools = dict()
+        for row in cursor:
+            values = [row[column] for column, name, unit in POOL_METRICS]
+            maxwait = row['maxwait'] + (row.get('maxwait_us') or 0) / 1000000.0
+            if row['database'] not in pools:
+                pools[row['database']] = values + [maxwait]
+                continue
+            pool = pools[row['database']]
+            for offset, value in enumerate(values):
+                pool[offset] += value
+            pool[-1] = max(pool[-1], maxwait)
+
+        for database, values in pools.items():
+            metric = 'Pools/%s' % database
+            for offset, (column, name, unit) in enumerate(POOL_METRICS):
+                self.add_gauge_value('%s/%s' % (metric, name), unit,
+                                     values[offset])
+            self.add_gauge_value('%s/Maximum Wait' % metric, 'seconds',
+                                 values[-1])
+
+    def add_request_stats(self, cursor):
+        cursor.execute('SHOW STATS')
         requests = 0
-        for database in stats['STATS']:
-            metric = 'Database/%s' % database['database']
+        for row in cursor:
+            metric = 'Database/%s' % row['database']
+            # pgBouncer 1.8 split total_requests into transactions and queries
+            total_requests = row.get('total_requests',
+                                     row.get('total_query_count', 0))
             self.add_derive_value('%s/Query Time' % metric, 'seconds',
-                                  database['total_query_time'])
+                                  row['total_query_time'])
             self.add_derive_value('%s/Requests' % metric, 'requests',
-                                  database['total_requests'])
+                                  total_requests)
             self.add_derive_value('%s/Data Sent' % metric, 'bytes',
-                                  database['total_sent'])
+                                  row['total_sent'])
             self.add_derive_value('%s/Data Received' % metric, 'bytes',
-                                  database['total_received'])
-            requests += database['total_requests']
+                                  row['total_received'])
+            requests += total_requests
 
         self.add_derive_value('Overview/Requests', 'requests', requests)
 
-        for pool in stats['POOLS']:
-            metric = 'Pools/%s' % pool['database']
-            self.add_gauge_value('%s/Clients/Active' % metric, 'clients',
-                                 pool['cl_active'])
-            self.add_gauge_value('%s/Clients/Waiting' % metric, 'clients',
-                                 pool['cl_waiting'])
-            self.add_gauge_value('%s/Servers/Active' % metric, 'servers',
-                                 pool['sv_active'])
-            self.add_gauge_value('%s/Servers/Idle' % metric, 'servers',
-                                 pool['sv_idle'])
-            self.add_gauge_value('%s/Servers/Login' % metric, 'servers',
-                                 pool['sv_login'])
-            self.add_gauge_value('%s/Servers/Tested' % metric, 'servers',
-                                 pool['sv_tested'])
-            self.add_gauge_value('%s/Servers/Used' % metric, 'servers',
-                                 pool['sv_used'])
-            self.add_gauge_value('%s/Maximum Wait' % metric, 'seconds',
-                                 pool['maxwait'])
-
-    def add_stats(self, cursor):
-        stats = dict()
-        for key in self.MULTIROW:
-            stats[key] = dict()
-            cursor.execute('SHOW %s' % key)
-            temp = cursor.fetchall()
-            stats[key] = list()
-            for row in temp:
-                stats[key].append(dict(row))
+    @staticmethod
+    def accumulate(distributions, key, value):
+        """Add the value to the [count, total, min, max, sum of squares]
+        distribution for the key.
 
-        cursor.execute('SHOW LISTS')
-        temp = cursor.fetchall()
-        stats['LISTS'] = dict()
-        for row in temp:
-            stats['LISTS'][row['list']] = row['items']
+        :param dict distributions: The distributions by key
+        :param str key: The key to add the value for
+        :param float value: The value to add
+
+        """
+        distribution = distributions.get(key)
+        if distribution is None:
+            distributions[key] = [1, value, value, value, value * value]
+            return
+        distribution[0] += 1
+        distribution[1] += value
+        distribution[2] = min(distribution[2], value)
+        distribution[3] = max(distribution[3], value)
+        distribution[4] += value * value
+
+    @property
+    def connection_arguments(self):
+        """Create connection parameter dictionary for psycopg2.connect,
+        connecting to the admin console unless another dbname is configured.
 
-        self.add_pgbouncer_stats(stats)
+        :return dict: The dictionary to be passed to psycopg2.connect
+            via double-splat
+        """
+        args = super(PgBouncer, self).connection_arguments
+        args.setdefault('database', 'pgbouncer')
+        return args
+
+    @staticmethod
+    def parse_timestamp(value, timestamps):
+        """Return the UNIX timestamp for a connect_time or request_time value.
+        Connections opened in the same second share a value, so the parsed
+        values are cached for the duration of the poll.
+
+        :param mixed value: The timestamp string or datetime
+        :param dict timestamps: The cache of parsed values
+        :rtype: float or None
+
+        """
+        if not value:
+            return None
+        if value not in timestamps:
+            if isinstance(value, basestring):
+                parsed = time.strptime(value[:19], '%Y-%m-%d %H:%M:%S')
+            else:
+                parsed = value.timetuple()
+            if isinstance(value, basestring) and value.endswith('UTC'):
+                timestamps[value] = calendar.timegm(parsed)
+            else:
+                timestamps[value] = time.mktime(parsed)
+        return timestamps[value]
+
+    def prepare_connection(self, cursor):
+        """The admin console does not accept SET for server parameters, so
+        there is nothing to prepare.
+
+        :param psycopg2.cursor cursor: The cursor to query with
+
+        """
+        pass
 
     @property
     def dsn(self):
@@ -2,11 +2,15 @@
 PostgreSQL Plugin
 
 """
+import decimal
+import heapq
 import logging
 import psycopg2
+import time
 from psycopg2 import extensions
 from psycopg2 import extras
 
+from newrelic_plugin_agent import codec
 from newrelic_plugin_agent.plugins import base
 
 LOGGER = logging.getLogger(__name__)
@@ -14,7 +18,7 @@ LOGGER = logging.getLogger(__name__)
 ARCHIVE = """SELECT CAST(COUNT(*) AS INT) AS file_count,
 CAST(COALESCE(SUM(CAST(archive_file ~ $r$\.ready$$r$ as INT)), 0) AS INT)
 AS ready_count,CAST(COALESCE(SUM(CAST(archive_file ~ $r$\.done$$r$ AS INT)),
-0) AS INT) AS done_count FROM pg_catalog.pg_ls_dir('pg_xlog/archive_status')
+0) AS INT) AS done_count FROM pg_catalog.pg_ls_dir('%s/archive_status')
 AS archive_files (archive_file);"""
 BACKENDS = """SELECT count(*) - ( SELECT count(*) FROM pg_stat_activity WHERE
 current_query = '<IDLE>' ) AS backends_active, ( SELECT count(*) FROM
@@ -65,6 +69,40 @@ FROM (
     FROM pg_stat_replication
 ) AS s;
 """
+REPLICATION_9_2 = """
+SELECT
+    client_hostname,
+    client_addr,
+    state,
+    pg_xlog_location_diff(sent_location, replay_location) AS byte_lag
+FROM pg_stat_replication;
+"""
+REPLICATION_10 = """
+SELECT
+    client_hostname,
+    client_addr,
+    state,
+    pg_wal_lsn_diff(sent_lsn, replay_lsn) AS byte_lag
+FROM pg_stat_replication;
+"""
+TABLE_ACTIVITY = """SELECT t.relid, t.schemaname, t.relname, t.seq_scan,
+COALESCE(t.idx_scan, 0) AS idx_scan, t.n_tup_ins, t.n_tup_upd, t.n_tup_del,
+COALESCE(s.heap_blks_read, 0) AS heap_blks_read,
+COALESCE(s.heap_blks_hit, 0) AS heap_blks_hit
+FROM pg_stat_user_tables AS t JOIN pg_statio_user_tables AS s USING (relid)
+WHERE t.seq_scan + COALESCE(t.idx_scan, 0) + t.n_tup_ins + t.n_tup_upd +
+t.n_tup_del > 0;"""
+INDEX_ACTIVITY = """SELECT indexrelid AS relid, schemaname,
+indexrelname AS relname, idx_scan, idx_tup_read, idx_tup_fetch
+FROM pg_stat_user_indexes WHERE idx_scan > 0;"""
+STATEMENTS = """SELECT queryid, sum(calls) AS calls,
+sum(%s) AS total_time, sum(rows) AS rows FROM pg_stat_statements
+WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database())
+AND queryid IS NOT NULL AND calls > 0 GROUP BY queryid;"""
+DATABASES = """SELECT datname FROM pg_database WHERE datallowconn
+AND NOT datistemplate ORDER BY datname;"""
+STATEMENTS_EXTENSION = """SELECT count(*) AS installed FROM pg_extension
+WHERE extname = 'pg_stat_statements';"""
 
 LOCK_MAP = {'AccessExclusiveLock': 'Locks/Access Exclusive',
             'AccessShareLock': 'Locks/Access Share',
@@ -76,31 +114,176 @@ LOCK_MAP = {'AccessExclusiveLock': 'Locks/Access Exclusive',
             'ShareRowExclusiveLock': 'Locks/Share Row Exclusive',
             'SIReadLock': 'Locks/SI Read'}
 
+# (column, metric name, unit) for the per-relation counters. Tables are ranked
+# by the sum of the deltas of the first TABLE_ACTIVITY_COLUMNS counters and
+# indexes by the first INDEX_ACTIVITY_COLUMNS.
+TABLE_ACTIVITY_METRICS = [('seq_scan', 'Scans/Sequential', 'scans'),
+                          ('idx_scan', 'Scans/Index', 'scans'),
+                          ('n_tup_ins', 'Tuples/Inserts', 'tuples'),
+                          ('n_tup_upd', 'Tuples/Updates', 'tuples'),
+                          ('n_tup_del', 'Tuples/Deletes', 'tuples'),
+                          ('heap_blks_read', 'Heap Blocks/Read', 'blocks'),
+                          ('heap_blks_hit', 'Heap Blocks/Hit', 'blocks')]
+TABLE_ACTIVITY_COLUMNS = 5
+INDEX_ACTIVITY_METRICS = [('idx_scan', 'Scans', 'scans'),
+                          ('idx_tup_read', 'Tuples/Read', 'tuples'),
+                          ('idx_tup_fetch', 'Tuples/Fetched', 'tuples')]
+INDEX_ACTIVITY_COLUMNS = 1
+STATEMENT_METRICS = [('total_time', 'Time', 'ms'),
+                     ('calls', 'Calls', 'calls'),
+                     ('rows', 'Rows', 'rows')]
+STATEMENT_COLUMNS = 1
+
 
 class PostgreSQL(base.Plugin):
 
     GUID = 'com.meetme.newrelic_postgresql_agent'
+    DATABASE_GROUPS = ['relation_activity', 'relations']
+    DEFAULT_MAX_CONCURRENCY = 4
+    DEFAULT_STATEMENT_TIMEOUT = 10000
+    KEEPALIVES = {'keepalives': 1,
+                  'keepalives_idle': 30,
+                  'keepalives_interval': 10,
+                  'keepalives_count': 3}
 
-    def add_stats(self, cursor):
-        self.add_backend_stats(cursor)
-        self.add_bgwriter_stats(cursor)
-        self.add_database_stats(cursor)
-        self.add_lock_stats(cursor)
-        if self.config.get('relation_stats', True):
-            self.add_index_stats(cursor)
-            self.add_statio_stats(cursor)
-            self.add_table_stats(cursor)
-        self.add_replication_stats(cursor)
-        self.add_transaction_stats(cursor)
+    QUERY_GROUPS = {'index_activity': 'relation_activity',
+                    'index_count': 'relations',
+                    'index_size': 'relations',
+                    'statio': 'relations',
+                    'table_activity': 'relation_activity',
+                    'table_count': 'relations',
+                    'table_size': 'relations'}
 
-        # add_wal_metrics needs superuser to get directory listings
-        if self.config.get('superuser', True):
-            self.add_wal_stats(cursor)
+    # The database the metrics being added are for when polling discovered
+    # databases, which prefixes the metric names
+    database = None
 
-    def add_database_stats(self, cursor):
-        cursor.execute(DATABASE)
-        temp = cursor.fetchall()
-        for row in temp:
+    def add_stats(self):
+        handlers = self.stats_handlers()
+        if self.config.get('discover_databases'):
+            self.add_discovered_database_stats(
+                [handler for handler in handlers
+                 if handler[0] in self.DATABASE_GROUPS])
+            handlers = [handler for handler in handlers
+                        if handler[0] not in self.DATABASE_GROUPS]
+        due = self.due_query_groups(handlers)
+        queries = self.due_queries(due)
+        stats = dict()
+        if queries:
+            stats = self.query(lambda cursor: self.fetch_stats(cursor,
+                                                               queries))
+        self.add_handler_stats(handlers, due, stats)
+
+    def add_discovered_database_stats(self, handlers):
+        """Poll the per-database query groups for each database that accepts
+        connections, fetching the stats for up to max_concurrency databases
+        at a time over a persistent connection to each. The metrics are added
+        under Database/<name>.
+
+        :param list handlers: The (query group, method) pairs to poll
+
+        """
+        if not handlers:
+            return
+        databases = self.query(self.fetch_databases)
+        self.prune_databases(databases)
+
+        tasks, due = list(), dict()
+        for database in databases:
+            self.database = database
+            due[database] = self.due_query_groups(handlers)
+            tasks.append((self.fetch_database_stats,
+                          (database, self.due_queries(due[database]))))
+        self.database = None
+        results = self.run_concurrently(tasks, self.max_concurrency)
+
+        for database, stats in zip(databases, results):
+            if stats is None:
+                continue
+            self.database = database
+            try:
+                self.add_handler_stats(handlers, due[database], stats)
+            finally:
+                self.database = None
+
+    def add_handler_stats(self, handlers, due, stats):
+        """Add the metrics for the query groups that ran, and the cached
+        metrics for those that did not.
+
+        :param list handlers: The (query group, method) pairs
+        :param set due: The query groups that ran
+        :param dict stats: The query results by name
+
+        """
+        for group, handler in handlers:
+            if group not in due:
+                self.add_cached_stats(group)
+                continue
+            missing = [name for name, query, multirow
+                       in self.due_queries(set([group])) if name not in stats]
+            if missing:
+                LOGGER.warning('Skipping the %s stats, the %s query failed',
+                               group, ', '.join(missing))
+                continue
+            self.add_group_stats(group, handler, stats)
+
+    def add_cached_stats(self, group):
+        """Re-emit the metrics from the last time the query group ran.
+
+        :param str group: The query group name
+
+        """
+        tier = self.state.get('query_tiers', dict()).get((self.database,
+                                                          group))
+        if not tier:
+            return
+        for metric, payload in tier['derive'].items():
+            self.derive_values[metric] = dict(payload)
+        for metric, payload in tier['gauge'].items():
+            self.gauge_values[metric] = dict(payload)
+
+    def add_group_stats(self, group, handler, stats):
+        """Add the metrics for a query group. If the group has a refresh
+        interval longer than the poll interval, its derive values and the
+        gauges holding changes since the last run are spread evenly over the
+        polls since it last ran, and the metrics are cached to be re-emitted
+        until it runs again.
+
+        :param str group: The query group name
+        :param callable handler: The method that adds the group metrics
+        :param dict stats: The query results by name
+
+        """
+        derive, gauge = set(self.derive_values), set(self.gauge_values)
+        handler(stats)
+        if self.query_group_interval(group) <= self.poll_interval:
+            return
+
+        tiers = self.state.setdefault('query_tiers', dict())
+        now, polls = time.time(), 1
+        key = (self.database, group)
+        if key in tiers:
+            polls = max(1, int(round((now - tiers[key]['refreshed']) /
+                                     float(self.poll_interval))))
+        tier = {'derive': dict(), 'gauge': dict(), 'refreshed': now}
+        for metric in set(self.derive_values) - derive:
+            payload = self.derive_values[metric]
+            if polls > 1:
+                payload = self.metric_payload(payload['total'] / float(polls),
+                                              count=payload['count'])
+                self.derive_values[metric] = payload
+            tier['derive'][metric] = dict(payload)
+        for metric in set(self.gauge_values) - gauge:
+            payload = self.gauge_values[metric]
+            if polls > 1 and metric in self.delta_gauges:
+                payload = self.metric_payload(payload['total'] / float(polls),
+                                              count=payload['count'])
+                self.gauge_values[metric] = payload
+            tier['gauge'][metric] = dict(payload)
+        tiers[key] = tier
+
+    def add_database_stats(self, rows):
+        for row in rows:
             database = row['datname']
             self.add_gauge_value('Database/%s/Backends' % database, 'processes',
                                  row.get('numbackends', 0))
@@ -135,20 +318,13 @@ class PostgreSQL(base.Plugin):
                                   database, 'tuples',
                                   int(row.get('conflicts', 0)))
 
-    def add_backend_stats(self, cursor):
-        if self.server_version < (9, 2, 0):
-            cursor.execute(BACKENDS)
-        else:
-            cursor.execute(BACKENDS_9_2)
-        temp = cursor.fetchone()
+    def add_backend_stats(self, temp):
         self.add_gauge_value('Backends/Active', 'processes',
                              temp.get('backends_active', 0))
         self.add_gauge_value('Backends/Idle', 'processes',
                              temp.get('backends_idle', 0))
 
-    def add_bgwriter_stats(self, cursor):
-        cursor.execute(BGWRITER)
-        temp = cursor.fetchone()
+    def add_bgwriter_stats(self, temp):
         self.add_derive_value('Background Writer/Checkpoints/Scheduled',
                               'checkpoints',
                               temp.get('checkpoints_timed', 0))
@@ -156,19 +332,13 @@ class PostgreSQL(base.Plugin):
                               'checkpoints',
                               temp.get('checkpoints_requests', 0))
 
-    def add_index_stats(self, cursor):
-        cursor.execute(INDEX_COUNT)
-        temp = cursor.fetchone()
+    def add_index_stats(self, count, size):
         self.add_gauge_value('Objects/Indexes', 'indexes',
-                             temp.get('indexes', 0))
-        cursor.execute(INDEX_SIZE_ON_DISK)
-        temp = cursor.fetchone()
+                             count.get('indexes', 0))
         self.add_gauge_value('Disk Utilization/Indexes', 'bytes',
-                             temp.get('size_indexes', 0))
+                             size.get('size_indexes', 0))
 
-    def add_lock_stats(self, cursor):
-        cursor.execute(LOCKS)
-        temp = cursor.fetchall()
+    def add_lock_stats(self, temp):
         for lock in LOCK_MAP:
             found = False
             for row in temp:
@@ -179,9 +349,7 @@ class PostgreSQL(base.Plugin):
             if not found:
                     self.add_gauge_value(LOCK_MAP[lock], 'locks', 0)
 
-    def add_statio_stats(self, cursor):
-        cursor.execute(STATIO)
-        temp = cursor.fetchone()
+    def add_statio_stats(self, temp):
         self.add_derive_value('IO Operations/Heap/Reads', 'iops',
                               int(temp.get('heap_blocks_read', 0)))
         self.add_derive_value('IO Operations/Heap/Hits', 'iops',
@@ -199,19 +367,13 @@ class PostgreSQL(base.Plugin):
         self.add_derive_value('IO Operations/Toast Index/Hits', 'iops',
                               int(temp.get('toastindex_blocks_hit', 0)))
 
-    def add_table_stats(self, cursor):
-        cursor.execute(TABLE_COUNT)
-        temp = cursor.fetchone()
+    def add_table_stats(self, count, size):
         self.add_gauge_value('Objects/Tables', 'tables',
-                             temp.get('relations', 0))
-        cursor.execute(TABLE_SIZE_ON_DISK)
-        temp = cursor.fetchone()
+                             count.get('relations', 0))
         self.add_gauge_value('Disk Utilization/Tables', 'bytes',
-                             temp.get('size_relations', 0))
+                             size.get('size_relations', 0))
 
-    def add_transaction_stats(self, cursor):
-        cursor.execute(TRANSACTIONS)
-        temp = cursor.fetchone()
+    def add_transaction_stats(self, temp):
         self.add_derive_value('Transactions/Committed', 'transactions',
                               int(temp.get('transactions_committed', 0)))
         self.add_derive_value('Transactions/Rolled Back', 'transactions',
@@ -236,9 +398,7 @@ class PostgreSQL(base.Plugin):
         self.add_derive_value('Tuples/Writes/Deletes', 'tuples',
                               int(temp.get('tuples_deleted', 0)))
 
-    def add_wal_stats(self, cursor):
-        cursor.execute(ARCHIVE)
-        temp = cursor.fetchone()
+    def add_wal_stats(self, temp):
         self.add_derive_value('Archive Status/Total', 'files',
                               temp.get('file_count', 0))
         self.add_gauge_value('Archive Status/Ready', 'files',
@@ -246,21 +406,139 @@ class PostgreSQL(base.Plugin):
         self.add_derive_value('Archive Status/Done', 'files',
                               temp.get('done_count', 0))
 
-    def add_replication_stats(self, cursor):
-        cursor.execute(REPLICATION)
-        temp = cursor.fetchall()
+    def add_relation_stats(self, stats):
+        self.add_index_stats(stats['index_count'], stats['index_size'])
+        self.add_statio_stats(stats['statio'])
+        self.add_table_stats(stats['table_count'], stats['table_size'])
+
+    def add_relation_activity_stats(self, stats):
+        limit = int(self.config['top_relations'])
+        label = lambda row: '%s.%s' % (row['schemaname'], row['relname'])
+        self.add_top_deltas('Tables', stats['table_activity'], 'relid', label,
+                            TABLE_ACTIVITY_METRICS, TABLE_ACTIVITY_COLUMNS,
+                            limit)
+        self.add_top_deltas('Indexes', stats['index_activity'], 'relid',
+                            label, INDEX_ACTIVITY_METRICS,
+                            INDEX_ACTIVITY_COLUMNS, limit)
+
+    def add_statement_stats(self, rows):
+        self.add_top_deltas('Statements', rows, 'queryid',
+                            lambda row: str(row['queryid']),
+                            STATEMENT_METRICS, STATEMENT_COLUMNS,
+                            int(self.config['top_statements']))
+
+    def add_delta_gauge(self, metric_name, units, value):
+        """Add a gauge holding the change in a counter since the query group
+        last ran, so it is spread over the polls in between like the derive
+        values.
+
+        :param str metric_name: The name of the metric
+        :param str units: The unit type
+        :param int value: The change since the last run
+
+        """
+        self.add_gauge_value(metric_name, units, value)
+        self.delta_gauges.add(self.metric_name(metric_name, units))
+
+    def add_top_deltas(self, prefix, rows, key, label, metrics, ranked,
+                       limit):
+        """Add gauges for the change in each counter since the last run for
+        the most active rows, summing the rest into an Other bucket. Only the
+        counters from the last run are kept, keyed by the key column, so rows
+        that go away fall out of the state on the next run.
+
+        :param str prefix: The metric name prefix
+        :param list rows: The counter rows
+        :param str key: The column that identifies a row between runs
+        :param callable label: Returns the metric name for a row
+        :param list metrics: The (column, metric name, unit) tuples
+        :param int ranked: How many leading counters rank the rows
+        :param int limit: How many rows to report individually
+
+        """
+        counters = self.state.setdefault('activity_counters', dict())
+        previous, current = counters.get((self.database, prefix)), dict()
+        deltas, totals = list(), [0] * len(metrics)
+        for row in rows:
+            values = tuple([self.counter_value(row[column])
+                            for column, name, unit in metrics])
+            current[row[key]] = values
+            last = (previous or dict()).get(row[key])
+            if previous is None or last is None:
+                continue
+            delta = [max(value - last[offset], 0)
+                     for offset, value in enumerate(values)]
+            if not any(delta):
+                continue
+            deltas.append((sum(delta[:ranked]), label(row), delta))
+            totals = [total + value for total, value in zip(totals, delta)]
+        counters[(self.database, prefix)] = current
+        if previous is None:
+            return
+
+        for activity, name, delta in heapq.nlargest(limit, deltas):
+            for offset, (column, metric, unit) in enumerate(metrics):
+                self.add_delta_gauge('%s/%s/%s' % (prefix, name, metric),
+                                     unit, delta[offset])
+                totals[offset] -= delta[offset]
+        for offset, (column, metric, unit) in enumerate(metrics):
+            self.add_delta_gauge('%s/Other/%s' % (prefix, metric), unit,
+                                 totals[offset])
+
+    @staticmethod
+    def counter_value(value):
+        """Return a counter as a number, keeping the fractional part of
+        timings such as the statement time in milliseconds.
+
+        :param mixed value: The counter value
+        :rtype: int or float
+
+        """
+        if isinstance(value, decimal.Decimal):
+            return int(value) if value == value.to_integral_value() \
+                else float(value)
+        return value or 0
+
+    def add_replication_stats(self, temp):
         for row in temp:
             self.add_gauge_value('Replication/%s' % row.get('client_addr', 'Unknown'),
                                  'byte_lag',
                                  int(row.get('byte_lag', 0)))
 
-    def connect(self):
+    @property
+    def capabilities(self):
+        """Return the server capabilities detected when the connection was
+        established.
+
+        :rtype: dict
+
+        """
+        return self.state['capabilities']
+
+    @staticmethod
+    def close_connection(connection):
+        """Close the connection if it is open
+
+        :param psycopg2.connection connection: The connection to close
+
+        """
+        if connection and not connection.closed:
+            try:
+                connection.close()
+            except psycopg2.Error as error:
+                LOGGER.debug('Error closing connection: %s', error)
+
+    def connect(self, database=None):
         """Connect to PostgreSQL, returning the connection object.
 
+        :param str database: Connect to this database instead of dbname
         :rtype: psycopg2.connection
 
         """
-        conn = psycopg2.connect(**self.connection_arguments)
+        args = self.connection_arguments
+        if database:
+            args['database'] = database
+        conn = psycopg2.connect(**args)
         conn.set_isolation_level(extensions.ISOLATION_LEVEL_AUTOCOMMIT)
         return conn
 
@@ -271,8 +549,12 @@ class PostgreSQL(base.Plugin):
         :return dict: The dictionary to be passed to psycopg2.connect
             via double-splat
         """
-        filtered_args = ["name", "superuser", "relation_stats"]
-        args = {}
+        filtered_args = ["name", "superuser", "relation_stats",
+                         "statement_timeout", "query_intervals",
+                         "top_relations", "top_statements",
+                         "discover_databases", "exclude_databases",
+                         "max_concurrency", "max_connections"]
+        args = dict(self.KEEPALIVES)
         for key in set(self.config) - set(filtered_args):
             if key == 'dbname':
                 args['database'] = self.config[key]
@@ -280,27 +562,476 @@ class PostgreSQL(base.Plugin):
                 args[key] = self.config[key]
         return args
 
+    def detect_capabilities(self, cursor):
+        """Return the queries and features that depend on the server version
+        and installed extensions
+
+        :param psycopg2.cursor cursor: The cursor to query with
+        :rtype: dict
+
+        """
+        if self.server_version >= (10, 0, 0):
+            capabilities = {'replication_query': REPLICATION_10,
+                            'wal_directory': 'pg_wal'}
+        elif self.server_version >= (9, 2, 0):
+            capabilities = {'replication_query': REPLICATION_9_2,
+                            'wal_directory': 'pg_xlog'}
+        else:
+            capabilities = {'replication_query': REPLICATION,
+                            'wal_directory': 'pg_xlog'}
+        capabilities['statements_query'] = self.detect_statements(cursor)
+        return capabilities
+
+    def detect_statements(self, cursor):
+        """Return the pg_stat_statements query if the extension is installed
+        in the connected database and statements are configured, otherwise
+        None. The queryid column was added in 9.4 and total_time was renamed
+        total_exec_time in 13.
+
+        :param psycopg2.cursor cursor: The cursor to query with
+        :rtype: str or None
+
+        """
+        if not self.config.get('top_statements') or \
+                self.server_version < (9, 4, 0):
+            return None
+        cursor.execute(STATEMENTS_EXTENSION)
+        if not cursor.fetchone()[0]:
+            LOGGER.warning('pg_stat_statements is not installed, skipping '
+                           'statement stats')
+            return None
+        column = ('total_exec_time' if self.server_version >= (13, 0, 0)
+                  else 'total_time')
+        return STATEMENTS % column
+
+    def disconnect(self, database=None):
+        """Close and forget the persistent connection, if there is one
+
+        :param str database: The discovered database to disconnect from
+
+        """
+        if database:
+            connection = self.state.get('database_connections',
+                                        dict()).pop(database, None)
+        else:
+            connection = self.state.pop('connection', None)
+        self.close_connection(connection)
+
+    @staticmethod
+    def connection_lost(error):
+        """Return True if the error means the connection can not be used
+        anymore, rather than that a single statement failed.
+
+        :param psycopg2.Error error: The error raised
+        :rtype: bool
+
+        """
+        return (isinstance(error, psycopg2.InterfaceError) or
+                (isinstance(error, psycopg2.OperationalError) and
+                 not isinstance(error, extensions.QueryCanceledError)))
+
+    def fetch_databases(self, cursor):
+        """Return the databases that accept connections, leaving out those
+        listed in exclude_databases.
+
+        :param psycopg2.cursor cursor: The cursor to query with
+        :rtype: list
+
+        """
+        cursor.execute(DATABASES)
+        exclude = self.config.get('exclude_databases') or list()
+        return [row['datname'] for row in cursor.fetchall()
+                if row['datname'] not in exclude]
+
+    def fetch_each_stats(self, cursor, queries):
+        """Run the stats queries one statement at a time, returning the
+        results by name. A query that fails, such as on a permission error
+        or the statement timeout, is logged and left out of the results.
+
+        :param psycopg2.cursor cursor: The cursor to query with
+        :param list queries: The (name, query, multirow) tuples to run
+        :rtype: dict
+
+        """
+        stats = dict()
+        for name, query, multirow in queries:
+            try:
+                cursor.execute(query)
+            except psycopg2.Error as error:
+                if self.connection_lost(error):
+                    raise
+                LOGGER.error('%s %s stats query failed: %s',
+                             self.__class__.__name__, name, error)
+                continue
+            stats[name] = cursor.fetchall() if multirow else cursor.fetchone()
+        return stats
+
+    def fetch_stats(self, cursor, queries):
+        """Run the stats queries, returning the results by name. Servers that
+        support json_agg get a single statement with each query as a JSON
+        column, so collection is one round trip. If that statement fails the
+        queries are run one at a time, so the results of the queries that
+        succeed are still reported, and the queries that failed are run
+        separately from then on. Older servers are always queried one
+        statement at a time.
+
+        :param psycopg2.cursor cursor: The cursor to query with
+        :param list queries: The (name, query, multirow) tuples to run
+        :rtype: dict
+
+        """
+        if self.server_version < (9, 3, 0):
+            return self.fetch_each_stats(cursor, queries)
+
+        separate = self.state.setdefault('separate_queries', set())
+        batched = [query for query in queries if query[0] not in separate]
+        stats = self.fetch_each_stats(
+            cursor, [query for query in queries if query[0] in separate])
+        try:
+            stats.update(self.fetch_batched_stats(cursor, batched))
+        except psycopg2.Error as error:
+            if self.connection_lost(error):
+                raise
+            LOGGER.warning('%s batched stats query failed, running the '
+                           'queries separately: %s',
+                           self.__class__.__name__, error)
+            results = self.fetch_each_stats(cursor, batched)
+            separate.update([name for name, query, multirow in batched
+                             if name not in results])
+            stats.update(results)
+        return stats
+
+    @staticmethod
+    def fetch_batched_stats(cursor, queries):
+        """Combine the stats queries into a single statement, aggregating
+        multi-row results with json_agg and single rows with row_to_json.
+
+        :param psycopg2.cursor cursor: The cursor to query with
+        :param list queries: The (name, query, multirow) tuples to run
+        :rtype: dict
+
+        """
+        if not queries:
+            return dict()
+        columns = list()
+        for name, query, multirow in queries:
+            columns.append('(SELECT %s(q) FROM (%s) AS q) AS %s' %
+                           ('json_agg' if multirow else 'row_to_json',
+                            query.strip().rstrip(';'), name))
+        cursor.execute('SELECT %s;' % ', '.join(columns))
+        row = cursor.fetchone()
+        stats = dict()
+        for name, query, multirow in queries:
+            value = row[name]
+            if isinstance(value, basestring):
+                value = codec.loads(value)
+            stats[name] = value or (list() if multirow else dict())
+        return stats
+
+    def due_queries(self, due):
+        """Return the (name, query, multirow) tuples for the due query groups
+
+        :param set due: The query groups to run
+        :rtype: list
+
+        """
+        return [query for query in self.stats_queries()
+                if self.QUERY_GROUPS.get(query[0], query[0]) in due]
+
+    def due_query_groups(self, handlers):
+        """Return the query groups that should run this poll
+
+        :param list handlers: The (query group, method) pairs
+        :rtype: set
+
+        """
+        return set([group for group, handler in handlers
+                    if self.query_group_due(group)])
+
+    def fetch_database_stats(self, database, queries):
+        """Run the queries against a discovered database over its persistent
+        connection, returning the results by name.
+
+        :param str database: The database to query
+        :param list queries: The (name, query, multirow) tuples to run
+        :rtype: dict
+
+        """
+        if not queries:
+            return dict()
+        return self.query(lambda cursor: self.fetch_stats(cursor, queries),
+                          database)
+
+    def get_connection(self):
+        """Return the persistent connection for the target, connecting if
+        there is not an open one. The server version and capabilities are
+        cached when a new connection is established.
+
+        :rtype: psycopg2.connection
+
+        """
+        connection = self.state.get('connection')
+        if connection and not connection.closed:
+            return connection
+        self.disconnect()
+
+        connection = self.connect()
+        self.state['connection'] = connection
+        self.state['server_version'] = self.parse_server_version(
+            connection.server_version)
+        cursor = connection.cursor()
+        self.prepare_connection(cursor)
+        cursor.close()
+        return connection
+
+    def get_database_connection(self, database):
+        """Return the persistent connection for a discovered database,
+        connecting if there is not an open one.
+
+        :param str database: The database to connect to
+        :rtype: psycopg2.connection
+
+        """
+        connections = self.state.setdefault('database_connections', dict())
+        connection = connections.get(database)
+        if connection and not connection.closed:
+            return connection
+        self.disconnect(database)
+
+        connection = self.connect(database)
+        cursor = connection.cursor()
+        self.set_statement_timeout(cursor)
+        cursor.close()
+        connections[database] = connection
+        return connection
+
+    def initialize(self):
+        """Empty stats collection dictionaries for the polling interval"""
+        super(PostgreSQL, self).initialize()
+        self.delta_gauges = set()
+
+    @property
+    def max_concurrency(self):
+        """Return how many discovered databases may be queried at the same
+        time, reading max_connections, its earlier name, if it is not set.
+
+        :rtype: int
+
+        """
+        return int(self.config.get('max_concurrency',
+                                   self.config.get(
+                                       'max_connections',
+                                       self.DEFAULT_MAX_CONCURRENCY)))
+
+    def metric_name(self, metric, units):
+        """Return the metric name in the format for the NewRelic platform,
+        under the database being added when polling discovered databases.
+
+        :param str metric: The name of th metric
+        :param str units: The unit name
+
+        """
+        if self.database:
+            metric = 'Database/%s/%s' % (self.database, metric)
+        return super(PostgreSQL, self).metric_name(metric, units)
+
+    @staticmethod
+    def parse_server_version(version):
+        """Return the integer server version in PEP 369 format
+
+        :param int version: The server version from libpq
+        :rtype: tuple
+
+        """
+        return (version % 1000000 / 10000,
+                version % 10000 / 100,
+                version % 100)
+
     def poll(self):
         self.initialize()
         try:
-            self.connection = self.connect()
+            self.get_connection()
         except psycopg2.OperationalError as error:
             LOGGER.critical('Could not connect to %s, skipping stats run: %s',
                             self.__class__.__name__, error)
+            self.disconnect()
+            return
+        try:
+            self.add_stats()
+        except extensions.QueryCanceledError as error:
+            LOGGER.error('%s stats query exceeded the statement timeout: %s',
+                         self.__class__.__name__, error)
+        except (psycopg2.InterfaceError, psycopg2.OperationalError) as error:
+            LOGGER.error('%s connection failed while collecting stats: %s',
+                         self.__class__.__name__, error)
+            self.disconnect()
             return
-        cursor = self.connection.cursor(cursor_factory=extras.DictCursor)
-        self.add_stats(cursor)
-        cursor.close()
-        self.connection.close()
         self.finish()
 
+    def prune_databases(self, databases):
+        """Close the connections to databases that are no longer polled and
+        forget their cached query groups and activity counters.
+
+        :param list databases: The databases being polled
+
+        """
+        for database in set(self.state.get('database_connections',
+                                           dict())) - set(databases):
+            self.disconnect(database)
+        for key in ('query_tiers', 'activity_counters'):
+            values = self.state.get(key, dict())
+            for database, name in list(values):
+                if database is not None and database not in databases:
+                    del values[(database, name)]
+
+    def query(self, method, database=None):
+        """Call the method with a cursor on the persistent connection,
+        reconnecting and calling it again once if the connection has gone
+        away since the last poll. The connection is not checked beforehand,
+        so a healthy connection costs no extra round trip.
+
+        :param callable method: The method to call with the cursor
+        :param str database: Use the connection to this discovered database
+        :rtype: mixed
+
+        """
+        for attempt in range(2):
+            connection = (self.get_database_connection(database) if database
+                          else self.get_connection())
+            cursor = connection.cursor(cursor_factory=extras.DictCursor)
+            try:
+                return method(cursor)
+            except psycopg2.Error as error:
+                if not self.connection_lost(error):
+                    raise
+                self.disconnect(database)
+                if attempt:
+                    raise
+                LOGGER.warning('%s connection failed, reconnecting: %s',
+                               self.__class__.__name__, error)
+            finally:
+                cursor.close()
+
+    def query_group_due(self, group):
+        """Return True if the query group should run this poll
+
+        :param str group: The query group name
+        :rtype: bool
+
+        """
+        interval = self.query_group_interval(group)
+        tier = self.state.get('query_tiers', dict()).get((self.database,
+                                                          group))
+        if interval <= self.poll_interval or not tier:
+            return True
+        return time.time() - tier['refreshed'] >= interval - 1
+
+    def query_group_interval(self, group):
+        """Return the configured refresh interval in seconds for the query
+        group, defaulting to every poll.
+
+        :param str group: The query group name
+        :rtype: int
+
+        """
+        intervals = self.config.get('query_intervals') or dict()
+        return intervals.get(group, self.poll_interval)
+
+    def stats_handlers(self):
+        """Return the (query group, method) pairs that add the metrics for
+        each query group, based upon the configuration.
+
+        :rtype: list
+
+        """
+        handlers = [
+            ('backends',
+             lambda stats: self.add_backend_stats(stats['backends'])),
+            ('bgwriter',
+             lambda stats: self.add_bgwriter_stats(stats['bgwriter'])),
+            ('database',
+             lambda stats: self.add_database_stats(stats['database'])),
+            ('locks', lambda stats: self.add_lock_stats(stats['locks']))]
+        if self.config.get('relation_stats', True):
+            handlers.append(('relations', self.add_relation_stats))
+        if self.config.get('top_relations'):
+            handlers.append(('relation_activity',
+                             self.add_relation_activity_stats))
+        if self.capabilities['statements_query']:
+            handlers.append(
+                ('statements',
+                 lambda stats: self.add_statement_stats(stats['statements'])))
+        handlers += [
+            ('replication',
+             lambda stats: self.add_replication_stats(stats['replication'])),
+            ('transactions',
+             lambda stats: self.add_transaction_stats(stats['transactions']))]
+
+        # add_wal_metrics needs superuser to get directory listings
+        if self.config.get('superuser', True):
+            handlers.append(
+                ('archive',
+                 lambda stats: self.add_wal_stats(stats['archive'])))
+        return handlers
+
+    def stats_queries(self):
+        """Return the (name, query, multirow) tuples for the stats to collect,
+        based upon the configuration and the server version.
+
+        :rtype: list
+
+        """
+        queries = [('backends', BACKENDS if self.server_version < (9, 2, 0)
+                    else BACKENDS_9_2, False),
+                   ('bgwriter', BGWRITER, False),
+                   ('database', DATABASE, True),
+                   ('locks', LOCKS, True)]
+        if self.config.get('relation_stats', True):
+            queries += [('index_count', INDEX_COUNT, False),
+                        ('index_size', INDEX_SIZE_ON_DISK, False),
+                        ('statio', STATIO, False),
+                        ('table_count', TABLE_COUNT, False),
+                        ('table_size', TABLE_SIZE_ON_DISK, False)]
+        if self.config.get('top_relations'):
+            queries += [('index_activity', INDEX_ACTIVITY, True),
+                        ('table_activity', TABLE_ACTIVITY, True)]
+        if self.capabilities['statements_query']:
+            queries.append(('statements',
+                            self.capabilities['statements_query'], True))
+        queries += [('replication', self.capabilities['replication_query'],
+                     True),
+                    ('transactions', TRANSACTIONS, False)]
+        if self.config.get('superuser', True):
+            queries.append(('archive',
+                            ARCHIVE % self.capabilities['wal_directory'],
+                            False))
+        return queries
+
+    def prepare_connection(self, cursor):
+        """Set the statement timeout so stats queries can not pile up on a
+        busy server, and detect the server capabilities.
+
+        :param psycopg2.cursor cursor: The cursor to query with
+
+        """
+        self.set_statement_timeout(cursor)
+        self.state['capabilities'] = self.detect_capabilities(cursor)
+
+    def set_statement_timeout(self, cursor):
+        """Set the statement timeout for the connection
+
+        :param psycopg2.cursor cursor: The cursor to query with
+
+        """
+        cursor.execute('SET statement_timeout = %s',
+                       (int(self.config.get('statement_timeout',
+                                            self.DEFAULT_STATEMENT_TIMEOUT)),))
+
     @property
     def server_version(self):
-        """Return connection server version in PEP 369 format
+        """Return the cached server version in PEP 369 format
 
         :returns: tuple
 
         """
-        return (self.connection.server_version % 1000000 / 10000,
-                self.connection.server_version % 10000 / 100,
-                self.connection.server_version % 100)
+        return self.state['server_version']
@@ -2,10 +2,13 @@
 rabbitmq
 
 """
+import fnmatch
 import logging
+import re
 import requests
 import time
 
+from newrelic_plugin_agent import codec
 from newrelic_plugin_agent.plugins import base
 
 LOGGER = logging.getLogger(__name__)
@@ -20,6 +23,22 @@ class RabbitMQ(base.Plugin):
     DEFAULT_HOST = 'localhost'
     DEFAULT_PORT = 80
     DEFAULT_API_PATH = '/api'
+    DEFAULT_PAGE_SIZE = 500
+    DEFAULT_TIMEOUT = 10
+    FAILOVER_BACKOFF = 30
+    FAILOVER_BACKOFF_MAX = 600
+    LATENCY_WEIGHT = 0.3
+    DEFAULT_EXCLUDE_QUEUES = ['amq.gen*']
+
+    MESSAGE_STATS_COLUMNS = ['message_stats.%s' % key for key in
+                             ['ack', 'deliver', 'deliver_get',
+                              'deliver_no_ack', 'get', 'get_no_ack',
+                              'publish', 'redeliver']]
+    CHANNEL_COLUMNS = ['node', 'client_flow_blocked'] + MESSAGE_STATS_COLUMNS
+    NODE_COLUMNS = ['name', 'proc_used', 'fd_used', 'mem_used', 'sockets_used']
+    QUEUE_COLUMNS = ['name', 'vhost', 'node', 'consumers', 'active_consumers',
+                     'messages_ready',
+                     'messages_unacknowledged'] + MESSAGE_STATS_COLUMNS
 
     DUMMY_STATS = {'ack': 0,
                    'deliver': 0,
@@ -29,30 +48,46 @@ class RabbitMQ(base.Plugin):
                    'publish': 0,
                    'redeliver': 0}
 
-    def add_node_datapoints(self, node_data, queue_data, channel_data):
+    MESSAGE_NAMES = {'ack': 'Acknowledged',
+                     'deliver': 'Delivered',
+                     'deliver_no_ack': 'Delivered No-Ack',
+                     'get': 'Got',
+                     'get_no_ack': 'Got No-Ack',
+                     'publish': 'Published',
+                     'redeliver': 'Redelivered'}
+
+    QUEUE_TOTALS = ['queues', 'consumers', 'active_consumers',
+                    'messages_ready', 'messages_unacknowledged']
+    VHOST_COLUMNS = ['name', 'messages_ready', 'messages_unacknowledged',
+                     'message_stats.deliver_get', 'message_stats.publish',
+                     'message_stats.redeliver']
+
+    def add_node_datapoints(self, node_data, channel_index, queue_index,
+                            summary=True, messages=True):
         """Add all of the data points for a node
 
         :param list node_data: all of the nodes
-        :param list queue_data: all of the queues
-        :param list channel_data: all of the channels
+        :param dict channel_index: the channel totals by node
+        :param dict queue_index: the queue totals by node
+        :param bool summary: add the channel and consumer summary values
+        :param bool messages: add the message values from the channel totals
 
         """
         channels = 0
         for node in node_data:
             name = node['name'].split('@')[-1]
-            self.add_node_channel_datapoints(name, channel_data)
-            self.add_node_message_datapoints(name, queue_data, channel_data)
-            self.add_node_queue_datapoints(name, queue_data)
-
-            count = 0
-            for channel in channel_data:
-                if channel['node'].split('@')[-1] == name:
-                    count += 1
-            channels += count
+            totals = self.node_totals()
+            totals.update(channel_index.get(name, dict()))
+            totals.update(queue_index.get(name, dict()))
+            self.add_node_channel_datapoints(name, totals)
+            if messages:
+                self.add_node_message_datapoints(name, totals)
+            self.add_node_queue_datapoints(name, totals)
+            channels += totals['channels']
 
             base_name = 'Node/%s' % name
             self.add_gauge_value('%s/Channels/Open' % base_name,
-                                 'channels', count)
+                                 'channels', totals['channels'])
             self.add_gauge_value('%s/Erlang Processes' % base_name, 'processes',
                                  node.get('proc_used', 0))
             self.add_gauge_value('%s/File Descriptors' % base_name, 'fds',
@@ -63,169 +98,256 @@ class RabbitMQ(base.Plugin):
                                  node.get('sockets_used', 0))
 
         # Summary stats
-        self.add_gauge_value('Summary/Channels', 'channels', channels)
-        self.add_gauge_value('Summary/Consumers', 'consumers', self.consumers)
+        if summary:
+            self.add_gauge_value('Summary/Channels', 'channels', channels)
+            self.add_gauge_value('Summary/Consumers', 'consumers',
+                                 self.consumers)
 
-    def add_node_channel_datapoints(self, node, channel_data):
-        """Add datapoints for a node, creating summary values for top-level
-        queue consumer counts and message counts.
+    def add_node_channel_datapoints(self, node, totals):
+        """Add datapoints for the channels on a node.
 
         :param str node: The node name
-        :param list channel_data: The full stack of queue metrics
+        :param dict totals: The aggregated values for the node
 
         """
-        channel_flow_blocked = 0
-        for channel in channel_data:
-            if channel['node'].split('@')[-1] == node:
-                if channel.get('client_flow_blocked'):
-                    channel_flow_blocked += 1
-
         self.add_gauge_value('Node/%s/Channels/Blocked' % node, 'channels',
-                             channel_flow_blocked)
+                             totals['channels_blocked'])
 
-    def add_node_message_datapoints(self, node, queue_data, channel_data):
+    def add_node_message_datapoints(self, node, totals):
         """Add message stats for the node
 
         :param str node: The node name
-        :param list queue_data: all of the queues
-        :param list channel_data: all of the channels
+        :param dict totals: The aggregated values for the node
 
         """
         base_name = 'Node/%s/Messages' % node
-
-        # Top level message stats
-        keys = self.DUMMY_STATS.keys()
-        count, total, min_val, max_val, values = self.initialize_counters(keys)
-
-        for channel in channel_data:
-            if channel['node'].split('@')[-1] == node:
-                for key in keys:
-                    total[key] += channel.get(key, 0)
-
-        # Per-Channel message Rates
-        count, total, min_val, max_val, values = self.initialize_counters(keys)
-        message_stats = list()
-        for channel in channel_data:
-            if channel['node'].split('@')[-1] == node:
-                stats = channel.get('message_stats')
-                if stats:
-                    message_stats.append(stats)
-
-        for stat_block in message_stats:
-            for key in keys:
-                total[key] += stat_block.get(key, 0)
-
-        for key in keys:
-            name = key
-            if key == 'ack':
-                name = 'Acknowledged'
-            elif key == 'deliver':
-                name = 'Delivered'
-            elif key == 'deliver_get':
-                name = 'Delivered (Total)'
-            elif key == 'deliver_no_ack':
-                name = 'Delivered No-Ack'
-            elif key == 'get':
-                name = 'Got'
-            elif key == 'get_no_ack':
-                name = 'Got No-Ack'
-            elif key == 'publish':
-                name = 'Published'
-            elif key == 'redeliver':
-                name = 'Redelivered'
+        for key, name in self.MESSAGE_NAMES.items():
             self.add_derive_value('%s/%s' % (base_name, name),
                                   'messages',
-                                  total[key])
-
-        keys = ['messages_ready', 'messages_unacknowledged']
-        count, total, min_val, max_val, values = self.initialize_counters(keys)
-        for queue in queue_data:
-            if queue['node'].split('@')[-1] == node:
-                for key in keys:
-                    total[key] += queue.get(key, 0)
+                                  totals['message_stats'][key])
 
         self.add_gauge_value('%s Available' % base_name, 'messages',
-                             total['messages_ready'])
+                             totals['messages_ready'])
         self.add_gauge_value('%s Unacknowledged' % base_name,
                              'messages',
-                             total['messages_unacknowledged'])
+                             totals['messages_unacknowledged'])
 
-    def add_node_queue_datapoints(self, node, queue_data):
+    def add_node_queue_datapoints(self, node, totals):
         """Add datapoints for a node, creating summary values for top-level
-        queue consumer counts and message counts.
+        queue consumer counts.
 
         :param str node: The node name
-        :param list queue_data: The full stack of queue metrics
+        :param dict totals: The aggregated values for the node
 
         """
-        keys = ['consumers', 'active_consumers', 'idle_consumers']
-        count, total, min_val, max_val, values = self.initialize_counters(keys)
-        del keys[2]
-        for queue in queue_data:
-            if queue['node'].split('@')[-1] == node:
-                for key in keys:
-                    count[key] += 1
-                    value = queue.get(key, 0)
-                    total[key] += value
-                    values[key].append(value)
-
-                # Inventing a new key here, so it's a manual override
-                key = 'idle_consumers'
-                count[key] += count['consumers']
-                idle_count = total['consumers'] - total['active_consumers']
-                total[key] += idle_count
-                values[key].append(idle_count)
-
         base_name = 'Node/%s/Consumers' % node
         self.add_gauge_value('%s/Count' % base_name, 'consumers',
-                             total['consumers'],
+                             totals['consumers'],
                              None,
                              None,
-                             count['consumers'])
+                             totals['queues'])
 
-        self.consumers += total['consumers']
+        self.consumers += totals['consumers']
 
         self.add_gauge_value('%s/Active' % base_name, 'consumers',
-                             total['active_consumers'],
+                             totals['active_consumers'],
                              None,
                              None,
-                             count['active_consumers'])
+                             totals['queues'])
 
-        base_name = 'Node/%s/Consumers' % node
         self.add_gauge_value('%s/Idle' % base_name, 'consumers',
-                             total['idle_consumers'],
+                             totals['consumers'] - totals['active_consumers'],
                              None,
                              None,
-                             count['idle_consumers'])
+                             totals['queues'])
+
+    def index_channels(self, channel_data):
+        """Group the channel counts and message stats by node in a single
+        pass over the channel list.
+
+        :param list channel_data: all of the channels
+        :rtype: dict
+
+        """
+        index = dict()
+        for channel in channel_data:
+            node = channel['node'].split('@')[-1]
+            if node not in index:
+                index[node] = {'channels': 0,
+                               'channels_blocked': 0,
+                               'message_stats': dict.fromkeys(
+                                   self.MESSAGE_NAMES, 0)}
+            totals = index[node]
+            totals['channels'] += 1
+            if channel.get('client_flow_blocked'):
+                totals['channels_blocked'] += 1
+            stats = channel.get('message_stats')
+            if stats:
+                for key in self.MESSAGE_NAMES:
+                    totals['message_stats'][key] += stats.get(key, 0)
+        return index
+
+    def index_queues(self, queue_data):
+        """Group the queue message and consumer counts by node in a single
+        pass over the queue list.
+
+        :param list queue_data: all of the queues
+        :rtype: dict
+
+        """
+        index = dict()
+        for queue in queue_data:
+            node = queue['node'].split('@')[-1]
+            if node not in index:
+                index[node] = dict.fromkeys(self.QUEUE_TOTALS, 0)
+            totals = index[node]
+            totals['queues'] += 1
+            for key in self.QUEUE_TOTALS[1:]:
+                totals[key] += queue.get(key, 0)
+        return index
+
+    def node_totals(self):
+        """Return the initial aggregate values for a node
+
+        :rtype: dict
+
+        """
+        totals = dict.fromkeys(self.QUEUE_TOTALS, 0)
+        totals.update({'channels': 0,
+                       'channels_blocked': 0,
+                       'message_stats': dict.fromkeys(self.MESSAGE_NAMES, 0)})
+        return totals
+
+    @staticmethod
+    def compile_patterns(patterns):
+        """Compile a list of glob patterns, or regular expressions when
+        prefixed with re:, into a list of regular expression objects.
+
+        :param list patterns: The patterns to compile
+        :rtype: list
+
+        """
+        return [re.compile(pattern[3:] if pattern.startswith('re:')
+                           else fnmatch.translate(pattern))
+                for pattern in patterns or list()]
+
+    def compile_queue_filter(self):
+        """Build the vhost and queue filter from the configuration. The filter
+        is a tuple of the queue exclusion patterns that apply to every vhost
+        and a dict of per-vhost (queue names, include patterns, exclude
+        patterns) tuples, or None if every vhost is tracked.
+
+        :rtype: tuple
+
+        """
+        exclude = self.compile_patterns(
+            self.config.get('exclude_queues', self.DEFAULT_EXCLUDE_QUEUES))
+        if not self.config.get('vhosts'):
+            return exclude, None
+        vhosts = dict()
+        for vhost, settings in self.config['vhosts'].items():
+            settings = settings or dict()
+            vhosts['/' if vhost == 'Default' else vhost] = (
+                frozenset(settings.get('queues') or list()),
+                self.compile_patterns(settings.get('include')),
+                self.compile_patterns(settings.get('exclude')))
+        return exclude, vhosts
+
+    @property
+    def queue_filter(self):
+        """Return the vhost and queue filter, which is compiled on the first
+        poll and kept in the state, as a new plugin instance is created for
+        every poll.
+
+        :rtype: tuple
+
+        """
+        if 'queue_filter' not in self.state:
+            self.state['queue_filter'] = self.compile_queue_filter()
+        return self.state['queue_filter']
 
     def track_vhost_queue(self, vhost_name, queue_name):
-        """ Checks whether the data for a vhost queue should be tracked or not
-        The check is based on the user configs, no configs means track everything
+        """Checks whether the data for a vhost queue should be tracked or not
+        The check is based on the user configs, no configs means track
+        everything but auto-named queues
+
         :param str vhost_name: the virtual host name
         :param str queue_name: the queue name
+        :rtype: bool
+
         """
-        TRACK_EVERYTHING = dict()
-        tracked_vhosts = self.config.get('vhosts', TRACK_EVERYTHING)
-        vhost_settings = tracked_vhosts.get(vhost_name) or {}
-        vhost_queues = vhost_settings.get('queues', [])
-        if tracked_vhosts is TRACK_EVERYTHING:
+        exclude, vhosts = self.queue_filter
+        if any(pattern.match(queue_name) for pattern in exclude):
+            return False
+        if vhosts is None:
             return True
-        if vhost_name in tracked_vhosts and vhost_queues == []:
+        if vhost_name not in vhosts:
+            return False
+        names, include, exclude = vhosts[vhost_name]
+        if any(pattern.match(queue_name) for pattern in exclude):
+            return False
+        if not names and not include:
             return True
-        return queue_name in vhost_queues
+        return (queue_name in names or
+                any(pattern.match(queue_name) for pattern in include))
 
-    def add_queue_datapoints(self, queue_data):
+    def add_overview_datapoints(self, overview, vhost_data):
+        """Add the summary values from the overview and the per-vhost totals
+        from the vhost listing.
+
+        :param dict overview: The cluster overview
+        :param list vhost_data: all of the vhosts
+
+        """
+        message_stats = overview.get('message_stats') or dict()
+        self.add_derive_value('Summary/Messages/Delivered', 'messages',
+                              message_stats.get('deliver_get', 0))
+        self.add_derive_value('Summary/Messages/Published', 'messages',
+                              message_stats.get('publish', 0))
+        self.add_derive_value('Summary/Messages/Redelivered', 'messages',
+                              message_stats.get('redeliver', 0))
+
+        queue_totals = overview.get('queue_totals') or dict()
+        self.add_gauge_value('Summary/Messages Available', 'messages',
+                             queue_totals.get('messages_ready', 0))
+        self.add_gauge_value('Summary/Messages Unacknowledged', 'messages',
+                             queue_totals.get('messages_unacknowledged', 0))
+
+        object_totals = overview.get('object_totals') or dict()
+        self.add_gauge_value('Summary/Channels', 'channels',
+                             object_totals.get('channels', 0))
+        self.add_gauge_value('Summary/Consumers', 'consumers',
+                             object_totals.get('consumers', 0))
+        self.add_gauge_value('Summary/Queues', 'queues',
+                             object_totals.get('queues', 0))
+
+        for vhost in vhost_data:
+            name = 'Default' if vhost['name'] == '/' else vhost['name']
+            base_name = 'Vhost/%s/Messages' % name
+            message_stats = vhost.get('message_stats') or dict()
+            self.add_derive_value('%s/Delivered (All)' % base_name, 'messages',
+                                  message_stats.get('deliver_get', 0))
+            self.add_derive_value('%s/Published' % base_name, 'messages',
+                                  message_stats.get('publish', 0))
+            self.add_derive_value('%s/Redelivered' % base_name, 'messages',
+                                  message_stats.get('redeliver', 0))
+            self.add_gauge_value('%s Available' % base_name, 'messages',
+                                 vhost.get('messages_ready', 0))
+            self.add_gauge_value('%s Unacknowledged' % base_name, 'messages',
+                                 vhost.get('messages_unacknowledged', 0))
+
+    def add_queue_datapoints(self, queue_data, summary=True):
         """Add per-queue datapoints to the processing stack.
 
         :param list queue_data: The raw queue data list
+        :param bool summary: add the summary message values
 
         """
         count = 0
         available, consumers, deliver, publish, redeliver, unacked = \
             0, 0, 0, 0, 0, 0
         for count, queue in enumerate(queue_data):
-            if queue['name'][0:7] == 'amq.gen':
-                LOGGER.debug('Skipping auto-named queue: %s', queue['name'])
+            if not self.track_vhost_queue(queue['vhost'], queue['name']):
                 continue
 
             message_stats = queue.get('message_stats', dict())
@@ -235,9 +357,6 @@ class RabbitMQ(base.Plugin):
             vhost = 'Default' if queue['vhost'] == '/' else queue['vhost']
             base_name = 'Queue/%s/%s' % (vhost, queue['name'])
 
-            if not self.track_vhost_queue(vhost, queue['name']):
-                continue
-
             self.add_gauge_value('%s/Consumers' % base_name, 'consumers',
                                  queue.get('consumers', 0))
 
@@ -270,6 +389,9 @@ class RabbitMQ(base.Plugin):
             redeliver += message_stats.get('redeliver', 0)
             unacked += queue.get('messages_unacknowledged', 0)
 
+        if not summary:
+            return
+
         # Summary stats
         self.add_derive_value('Summary/Messages/Delivered', 'messages',
                               deliver, count=count)
@@ -293,37 +415,90 @@ class RabbitMQ(base.Plugin):
         kwargs = {'url': url,
                   'auth': (self.config.get('username', self.DEFAULT_USER),
                            self.config.get('password', self.DEFAULT_PASSWORD)),
+                  'timeout': self.config.get('timeout', self.DEFAULT_TIMEOUT),
                   'verify': self.config.get('verify_ssl_cert', True)}
         if params:
             kwargs['params'] = params
 
         try:
             return self.requests_session.get(**kwargs)
-        except requests.ConnectionError as error:
+        except requests.RequestException as error:
             LOGGER.error('Error fetching data from %s: %s', url, error)
             return None
 
-    def fetch_data(self, data_type, columns=None):
-        """Fetch the data from the RabbitMQ server for the specified data type
+    def fetch_data(self, data_type, columns=None, paginate=False):
+        """Fetch the data from the RabbitMQ server for the specified data type.
+        When paginate is set, the listing is requested in pages of page_size
+        items. Servers that do not support pagination return the full list
+        for the first request. The later pages are requested from the
+        endpoint that returned the first one, so a listing is not stitched
+        together from different nodes. Returns None if any request failed,
+        as a partial listing would under report.
 
         :param str data_type: The type of data to query
         :param list columns: Ask for specific columns
-        :rtype: list
+        :param bool paginate: Request the data a page at a time
+        :rtype: list|dict|None
 
         """
-        url = '%s/%s' % (self.rabbitmq_base_url, data_type)
         params = {'columns': ','.join(columns)} if columns else {}
-        response = self.http_get(url, params)
-        if not response or response.status_code != 200:
-            if response:
+        page_size = self.config.get('page_size', self.DEFAULT_PAGE_SIZE)
+        if not paginate or not page_size:
+            return self.fetch_json(data_type, params)[1]
+
+        items, page, base_urls = list(), 1, None
+        while True:
+            params.update({'page': page, 'page_size': page_size})
+            base_url, data = self.fetch_json(data_type, params, base_urls)
+            base_urls = [base_url]
+            if data is None:
+                if page > 1:
+                    LOGGER.error('Error fetching page %i of %s, discarding '
+                                 'the %i items already fetched', page,
+                                 data_type, len(items))
+                return None
+            if isinstance(data, list):
+                return data
+            items.extend(data.get('items', list()))
+            if page >= data.get('page_count', 0):
+                return items
+            page += 1
+
+    def fetch_json(self, data_type, params, base_urls=None):
+        """Request the data type from the fastest healthy management endpoint,
+        failing over to the next one on connection errors, timeouts and
+        server errors. Returns the endpoint that answered and the decoded
+        JSON response body, which is None if the request failed.
+
+        :param str data_type: The type of data to query
+        :param dict params: Get query string parameters
+        :param list base_urls: Only use these endpoints
+        :rtype: tuple
+
+        """
+        base_url = None
+        for base_url in base_urls or self.endpoints():
+            url = '%s/%s' % (base_url, data_type)
+            response = self.http_get(url, params)
+            if response is None or response.status_code >= 500:
+                if response is not None:
+                    LOGGER.error('Error response from %s (%s): %s', url,
+                                 response.status_code, response.content)
+                self.mark_unhealthy(base_url)
+                continue
+            self.mark_healthy(base_url, response.elapsed.total_seconds())
+            if response.status_code != 200:
                 LOGGER.error('Error response from %s (%s): %s', url,
                              response.status_code, response.content)
-            return list()
-        try:
-            return response.json()
-        except Exception as error:
-            LOGGER.error('JSON decoding error: %r', error)
-            return list()
+                return base_url, None
+            try:
+                return base_url, codec.loads(response.content)
+            except Exception as error:
+                LOGGER.error('JSON decoding error: %r', error)
+                return base_url, None
+        LOGGER.error('No RabbitMQ management endpoint available for %s',
+                     data_type)
+        return base_url, None
 
     def fetch_channel_data(self):
         """Return the channel data from the RabbitMQ server
@@ -331,7 +506,7 @@ class RabbitMQ(base.Plugin):
         :rtype: list
 
         """
-        return self.fetch_data('channels')
+        return self.fetch_data('channels', self.CHANNEL_COLUMNS, True)
 
     def fetch_node_data(self):
         """Return the node data from the RabbitMQ server
@@ -339,7 +514,7 @@ class RabbitMQ(base.Plugin):
         :rtype: list
 
         """
-        return self.fetch_data('nodes')
+        return self.fetch_data('nodes', self.NODE_COLUMNS)
 
     def fetch_queue_data(self):
         """Return the queue data from the RabbitMQ server
@@ -347,7 +522,54 @@ class RabbitMQ(base.Plugin):
         :rtype: list
 
         """
-        return self.fetch_data('queues')
+        return self.fetch_data('queues', self.QUEUE_COLUMNS, True)
+
+    def fetch_overview_data(self):
+        """Return the cluster overview from the RabbitMQ server
+
+        :rtype: dict
+
+        """
+        return self.fetch_data('overview')
+
+    def fetch_vhost_data(self):
+        """Return the vhost data from the RabbitMQ server
+
+        :rtype: list
+
+        """
+        return self.fetch_data('vhosts', self.VHOST_COLUMNS)
+
+    def spread_listing_values(self, derive):
+        """Spread the derive values added from the queue and channel listings
+        evenly over the polls since the last listing, so the growth over a
+        queue_interval is not reported as a single poll's worth.
+
+        :param set derive: The derive metrics added before the listing values
+
+        """
+        now, last = time.time(), self.state.get('queue_listing')
+        self.state['queue_listing'] = now
+        if not last:
+            return
+        polls = int(round((now - last) / float(self.poll_interval)))
+        if polls <= 1:
+            return
+        for metric in set(self.derive_values) - derive:
+            payload = self.derive_values[metric]
+            self.derive_values[metric] = self.metric_payload(
+                payload['total'] / float(polls), count=payload['count'])
+
+    def queue_listing_due(self):
+        """Return True if queue_interval seconds have passed since the full
+        queue and channel listings were last fetched.
+
+        :rtype: bool
+
+        """
+        interval = self.config.get('queue_interval', self.poll_interval)
+        return (time.time() - self.state.get('queue_listing', 0) >=
+                interval - 1)
 
     def poll(self):
         """Poll the RabbitMQ server"""
@@ -362,29 +584,164 @@ class RabbitMQ(base.Plugin):
         self.rate = dict()
         self.consumers = 0
 
-        # Fetch the data from RabbitMQ
-        channel_data = self.fetch_channel_data()
-        node_data = self.fetch_node_data()
-        queue_data = self.fetch_queue_data()
+        overview = self.config.get('overview', False)
+        listing = not overview or self.queue_listing_due()
 
-        # Create all of the metrics
-        self.add_queue_datapoints(queue_data)
-        self.add_node_datapoints(node_data, queue_data, channel_data)
+        # Fetch the data from RabbitMQ
+        tasks = [(self.fetch_node_data, ())]
+        if listing:
+            tasks += [(self.fetch_channel_data, ()),
+                      (self.fetch_queue_data, ())]
+        if overview:
+            tasks += [(self.fetch_overview_data, ()),
+                      (self.fetch_vhost_data, ())]
+        results = self.run_concurrently(tasks)
+        node_data = results[0]
+        channel_data, queue_data = results[1:3] if listing else (None, None)
+        listed = channel_data is not None and queue_data is not None
+        if listing and not listed:
+            LOGGER.error('Skipping the queue and channel values, the '
+                         'listings could not be fetched')
+
+        # Create all of the metrics, leaving out the values for listings that
+        # could not be fetched instead of reporting them as zero
+        if overview:
+            self.add_overview_datapoints(results[-2] or dict(),
+                                         results[-1] or list())
+        derive = set(self.derive_values)
+        if listed:
+            self.add_queue_datapoints(queue_data, not overview)
+            self.state['channel_index'] = self.index_channels(channel_data)
+            self.state['queue_index'] = self.index_queues(queue_data)
+        if node_data is None:
+            LOGGER.error('Skipping the node values, the node listing could '
+                         'not be fetched')
+        else:
+            self.add_node_datapoints(node_data,
+                                     self.state.get('channel_index', dict()),
+                                     self.state.get('queue_index', dict()),
+                                     not overview, listed)
+        if listed:
+            self.spread_listing_values(derive)
         LOGGER.info('Polling complete in %.2f seconds',
                     time.time() - start_time)
 
+    def endpoints(self):
+        """Return the management API base URLs in the order they should be
+        tried: healthy endpoints by ascending latency, then the endpoints
+        that are backing off from a failure by their retry time.
+
+        :rtype: list
+
+        """
+        now = time.time()
+        health = self.endpoint_health
+        healthy = [url for url in self.base_urls
+                   if health[url]['retry_at'] <= now]
+        backoff = [url for url in self.base_urls
+                   if health[url]['retry_at'] > now]
+        healthy.sort(key=lambda url: health[url]['latency'])
+        backoff.sort(key=lambda url: health[url]['retry_at'])
+        return healthy + backoff
+
     @property
-    def rabbitmq_base_url(self):
-        """Return the fully composed RabbitMQ base URL
+    def endpoint_health(self):
+        """Return the latency and failure state of each management endpoint,
+        which is kept across poll intervals.
 
-        :rtype: str
+        :rtype: dict
+
+        """
+        health = self.state.setdefault('endpoints', dict())
+        for url in self.base_urls:
+            if url not in health:
+                health[url] = {'failures': 0, 'latency': 0, 'retry_at': 0}
+        return health
+
+    def mark_healthy(self, base_url, latency):
+        """Record a successful request to the endpoint, updating the moving
+        average of its latency.
+
+        :param str base_url: The endpoint base URL
+        :param float latency: The request duration in seconds
+
+        """
+        health = self.endpoint_health[base_url]
+        if health['failures'] or not health['latency']:
+            health['latency'] = latency
+        else:
+            health['latency'] += self.LATENCY_WEIGHT * (latency -
+                                                        health['latency'])
+        health['failures'], health['retry_at'] = 0, 0
+
+    def mark_unhealthy(self, base_url):
+        """Record a failed request to the endpoint, backing off retries
+        exponentially up to FAILOVER_BACKOFF_MAX seconds. Failures while the
+        endpoint is already backing off are not counted again.
+
+        :param str base_url: The endpoint base URL
+
+        """
+        health = self.endpoint_health[base_url]
+        if health['retry_at'] > time.time():
+            return
+        health['failures'] += 1
+        backoff = min(self.FAILOVER_BACKOFF * 2 ** (health['failures'] - 1),
+                      self.FAILOVER_BACKOFF_MAX)
+        health['retry_at'] = time.time() + backoff
+        LOGGER.warning('Marking %s unhealthy for %i seconds after %i '
+                       'failure(s)', base_url, backoff, health['failures'])
+
+    @property
+    def base_urls(self):
+        """Return the fully composed base URL for each management endpoint.
+        The hosts configuration value lists the nodes of a cluster, either as
+        host or host:port, falling back to host and port. IPv6 addresses are
+        given bare or in brackets, and need brackets to include a port.
+
+        :rtype: list
 
         """
         port = self.config.get('port', self.DEFAULT_PORT)
         secure = self.config.get('secure', False)
-        host = self.config.get('host', self.DEFAULT_HOST)
+        hosts = (self.config.get('hosts') or
+                 [self.config.get('host', self.DEFAULT_HOST)])
         api_path = self.config.get('api_path', self.DEFAULT_API_PATH)
         scheme = 'https' if secure else 'http'
 
-        return '{scheme}://{host}:{port}{api_path}'.format(
-            scheme=scheme, host=host, port=port, api_path=api_path)
+        urls = list()
+        for host in hosts:
+            host, host_port = self.split_host(str(host), port)
+            if ':' in host:
+                host = '[%s]' % host
+            urls.append('{scheme}://{host}:{port}{api_path}'.format(
+                scheme=scheme, host=host, port=host_port, api_path=api_path))
+        return urls
+
+    @staticmethod
+    def split_host(host, port):
+        """Split a host or host:port value into the host and port, using the
+        default port when there is none. A value with more than one colon is
+        a bare IPv6 address unless the address is in brackets.
+
+        :param str host: The host value
+        :param int port: The default port
+        :rtype: tuple
+
+        """
+        if host.startswith('['):
+            address, _separator, rest = host[1:].partition(']')
+            return address, rest[1:] if rest.startswith(':') else port
+        if host.count(':') == 1:
+            return tuple(host.rsplit(':', 1))
+        return host, port
+
+    @property
+    def rabbitmq_base_url(self):
+        """Return the fully composed base URL of the preferred management
+        endpoint
+
+        :rtype: str
+
+        """
+        return self.endpoints()[0]
@@ -3,17 +3,213 @@ Redis plugin polls Redis for stats
 
 """
 import logging
+import socket
+import time
 
 from newrelic_plugin_agent.plugins import base
 
 LOGGER = logging.getLogger(__name__)
 
+# (metric name, unit) for the values summed across the cluster nodes
+CLUSTER_ROLLUP = [('Clients/Blocked', 'clients'),
+                  ('Clients/Connected', 'clients'),
+                  ('Commands Processed', 'commands'),
+                  ('Connections', 'connections'),
+                  ('Evictions', 'keys'),
+                  ('Expirations', 'keys'),
+                  ('Keys Hit', 'keys'),
+                  ('Keys Missed', 'keys'),
+                  ('Memory Use', 'bytes')]
+
+# (metric name, unit) for the values summed across the cluster masters only,
+# as replicas hold copies of the same keys
+CLUSTER_MASTER_ROLLUP = [('Keys/Total', 'keys'),
+                         ('Keys/Will Expire', 'keys')]
+
+
+class ProtocolError(Exception):
+    """Raised when the server sends something that is not a RESP reply"""
+    pass
+
+
+class ReplyError(Exception):
+    """An error reply from the server, returned in place of the reply so the
+    rest of a pipeline can still be read.
+
+    """
+    pass
+
+
+class RESPReader(object):
+    """Read RESP replies from a socket, receiving more data only when the
+    buffered data does not hold the rest of the reply.
+
+    """
+    CHUNK_SIZE = 65536
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.buffer = ''
+        self.offset = 0
+
+    def read(self, length):
+        """Return the next length bytes, receiving until they are buffered
+
+        :param int length: The number of bytes to read
+        :rtype: str
+
+        """
+        available = len(self.buffer) - self.offset
+        if available < length:
+            chunks = [self.buffer[self.offset:]]
+            while available < length:
+                chunk = self.recv()
+                chunks.append(chunk)
+                available += len(chunk)
+            self.buffer, self.offset = ''.join(chunks), 0
+        value = self.buffer[self.offset:self.offset + length]
+        self.offset += length
+        return value
+
+    def read_line(self):
+        """Return the next CRLF terminated line, without the CRLF
+
+        :rtype: str
+
+        """
+        while True:
+            end = self.buffer.find('\r\n', self.offset)
+            if end > -1:
+                line = self.buffer[self.offset:end]
+                self.offset = end + 2
+                return line
+            self.buffer = self.buffer[self.offset:] + self.recv()
+            self.offset = 0
+
+    def read_reply(self):
+        """Read and return the next reply. Bulk strings are returned as str,
+        arrays as lists and error replies as ReplyError instances.
+
+        :rtype: mixed
+        :raises: ProtocolError
+
+        """
+        line = self.read_line()
+        prefix, value = line[:1], line[1:]
+        if prefix == '+':
+            return value
+        elif prefix == '-':
+            return ReplyError(value)
+        elif prefix == ':':
+            return int(value)
+        elif prefix == '$':
+            if int(value) < 0:
+                return None
+            return self.read(int(value) + 2)[:-2]
+        elif prefix == '*':
+            if int(value) < 0:
+                return None
+            return [self.read_reply() for _offset in range(int(value))]
+        raise ProtocolError('Unexpected reply: %r' % line[:32])
+
+    def recv(self):
+        """Receive the next chunk of data from the socket
+
+        :rtype: str
+        :raises: socket.error
+
+        """
+        chunk = self.connection.recv(self.CHUNK_SIZE)
+        if not chunk:
+            raise socket.error('Connection closed by the server')
+        return chunk
+
 
 class Redis(base.SocketStatsPlugin):
 
     GUID = 'com.meetme.newrelic_redis_agent'
 
     DEFAULT_PORT = 6379
+    DEFAULT_MAX_CONCURRENCY = 8
+    DEFAULT_SLOWLOG_MAX = 128
+    DEFAULT_TIMEOUT = 10
+    DEFAULT_TOPOLOGY_INTERVAL = 300
+
+    def add_cluster_datapoints(self, info, nodes):
+        """Add the CLUSTER INFO values, the node counts and the rollup of the
+        values polled from each node.
+
+        :param dict info: The CLUSTER INFO values
+        :param list nodes: The nodes from CLUSTER NODES
+
+        """
+        if info:
+            self.add_gauge_value('Cluster/State OK', 'state',
+                                 int(info.get('cluster_state') == 'ok'))
+            self.add_gauge_value('Cluster/Slots/Assigned', 'slots',
+                                 info.get('cluster_slots_assigned', 0))
+            self.add_gauge_value('Cluster/Slots/Failing', 'slots',
+                                 info.get('cluster_slots_fail', 0))
+            self.add_gauge_value('Cluster/Known Nodes', 'nodes',
+                                 info.get('cluster_known_nodes', 0))
+
+        masters = [node['address'] for node in nodes if node['master']]
+        self.add_gauge_value('Cluster/Nodes/Masters', 'nodes', len(masters))
+        self.add_gauge_value('Cluster/Nodes/Replicas', 'nodes',
+                             len(nodes) - len(masters))
+        self.add_gauge_value('Cluster/Nodes/Failed', 'nodes',
+                             len([node for node in nodes if node['failed']]))
+        polled = [child for child in self.children.values()
+                  if child.gauge_values]
+        self.add_gauge_value('Cluster/Nodes/Unreachable', 'nodes',
+                             len(self.children) - len(polled))
+
+        for metrics, children in [
+                (CLUSTER_ROLLUP, polled),
+                (CLUSTER_MASTER_ROLLUP,
+                 [child for child in polled
+                  if child.config['name'] in masters])]:
+            for name, unit in metrics:
+                metric = self.metric_name(name, unit)
+                self.add_gauge_value(name, unit, sum(
+                    [self.metric_total(child, metric) for child in children]))
+
+    def add_command_datapoints(self, stats):
+        """Add the calls and time spent for each command from the INFO
+        commandstats values. The time is reported with the number of calls
+        in the interval as its count, giving the average time per call.
+
+        :param dict stats: The INFO values
+
+        """
+        for key, command_stats in stats.items():
+            if not key.startswith('cmdstat_'):
+                continue
+            metric = 'Commands/%s' % key[8:]
+            self.add_derive_value('%s/Calls' % metric, 'calls',
+                                  command_stats.get('calls', 0))
+            calls = self.derive_values[self.metric_name('%s/Calls' % metric,
+                                                        'calls')]['total']
+            self.add_derive_value('%s/Time' % metric, 'us',
+                                  command_stats.get('usec', 0),
+                                  count=calls)
+
+    def add_slowlog_datapoints(self, entries):
+        """Add the number of new slowlog entries and the distribution of their
+        durations for each command.
+
+        :param list entries: The new SLOWLOG GET entries
+
+        """
+        self.add_gauge_value('Slowlog/Entries', 'entries', len(entries))
+        durations = dict()
+        for entry in entries:
+            command = entry[3][0].lower() if entry[3] else 'unknown'
+            durations.setdefault(command, list()).append(entry[2])
+        for command, values in durations.items():
+            self.add_gauge_value('Slowlog/%s' % command, 'us', sum(values),
+                                 min(values), max(values), len(values),
+                                 sum([value * value for value in values]))
 
     def add_datapoints(self, stats):
         """Add all of the data points for a node
@@ -87,13 +283,14 @@ class Redis(base.SocketStatsPlugin):
         self.add_gauge_value('Memory Fragmentation', 'ratio',
                              stats.get('mem_fragmentation_ratio', 0))
 
+        # The keyspace section only lists databases that have keys
         keys, expires = 0, 0
-        for db in range(0, self.config.get('db_count', 16)):
-
-            db_stats = stats.get('db%i' % db, dict())
-            self.add_gauge_value('DB/%s/Expires' % db, 'keys',
-                                db_stats.get('expires', 0))
-            self.add_gauge_value('DB/%s/Keys' % db, 'keys',
+        for key, db_stats in stats.items():
+            if not key.startswith('db') or not isinstance(db_stats, dict):
+                continue
+            self.add_gauge_value('DB/%s/Expires' % key[2:], 'keys',
+                                 db_stats.get('expires', 0))
+            self.add_gauge_value('DB/%s/Keys' % key[2:], 'keys',
                                  db_stats.get('keys', 0))
             keys += db_stats.get('keys', 0)
             expires += db_stats.get('expires', 0)
@@ -101,70 +298,322 @@ class Redis(base.SocketStatsPlugin):
         self.add_gauge_value('Keys/Total', 'keys', keys)
         self.add_gauge_value('Keys/Will Expire', 'keys', expires)
 
+        self.add_command_datapoints(stats)
+        if 'slowlog' in stats:
+            self.add_slowlog_datapoints(stats['slowlog'])
+
     def connect(self):
         """Top level interface to create a socket and connect it to the
-        redis daemon.
+        redis daemon, returning a reader for the connection.
 
-        :rtype: socket
+        :rtype: RESPReader
 
         """
-        connection = super(Redis, self).connect()
-        if connection and self.config.get('password'):
-            connection.send("*2\r\n$4\r\nAUTH\r\n$%i\r\n%s\r\n" %
-                            (len(self.config['password']),
-                             self.config['password']))
-            buffer_value = connection.recv(self.SOCKET_RECV_MAX)
-            if buffer_value == '+OK\r\n':
-                return connection
-            LOGGER.error('Authentication error: %s', buffer_value[4:].strip())
+        connection = super(Redis, self).connect(
+            self.config.get('timeout', self.DEFAULT_TIMEOUT))
+        if not connection:
             return None
-        return connection
+        reader = RESPReader(connection)
+        if self.config.get('password'):
+            try:
+                reply = self.execute(reader,
+                                     [('AUTH', self.config['password'])])[0]
+            except (socket.error, ProtocolError):
+                connection.close()
+                raise
+            if reply != 'OK':
+                LOGGER.error('Authentication error: %s', reply)
+                connection.close()
+                return None
+        return reader
+
+    def cluster_topology(self, reader):
+        """Return the CLUSTER INFO values and, when the topology is due for a
+        refresh, the nodes from CLUSTER NODES. Both are fetched in a single
+        write.
+
+        :param RESPReader reader: The reader for the seed connection
+        :rtype: tuple
 
-    def fetch_data(self, connection):
-        """Loop in and read in all the data until we have received it all.
+        """
+        commands = [('CLUSTER', 'INFO')]
+        if self.topology_due():
+            commands.append(('CLUSTER', 'NODES'))
+        replies = self.execute(reader, commands)
+        for reply in replies:
+            if isinstance(reply, ReplyError):
+                LOGGER.error('Could not fetch the cluster topology: %s',
+                             reply)
+                return None, None
+        info = self.parse_info(replies[0])
+        if len(replies) > 1:
+            return info, self.parse_cluster_nodes(replies[1])
+        return info, None
+
+    def disconnect(self):
+        """Close and forget the persistent connection, if there is one"""
+        reader = self.state.pop('reader', None)
+        if reader:
+            reader.connection.close()
+
+    @staticmethod
+    def encode(command):
+        """Return the command encoded as a RESP array of bulk strings
+
+        :param tuple command: The command and its arguments
+        :rtype: str
 
-        :param  socket connection: The connection
-        :rtype: dict
+        """
+        return '*%i\r\n%s' % (len(command),
+                               ''.join(['$%i\r\n%s\r\n' % (len(str(arg)), arg)
+                                        for arg in command]))
+
+    def execute(self, reader, commands):
+        """Send the commands in a single write and return their replies
+
+        :param RESPReader reader: The reader for the connection
+        :param list commands: The commands as tuples of arguments
+        :rtype: list
 
         """
-        connection.send("*0\r\ninfo\r\n")
+        reader.connection.sendall(''.join([self.encode(command)
+                                           for command in commands]))
+        return [reader.read_reply() for _command in commands]
 
-        # Read in the first line $1437
-        buffer_value = connection.recv(self.SOCKET_RECV_MAX)
-        lines = buffer_value.split('\r\n')
+    def fetch_data(self, reader):
+        """Fetch INFO, INFO commandstats and the newest slowlog entry in a
+        single round trip. The default INFO sections include the keyspace.
 
-        if lines[0][0] == '$':
-            byte_size = int(lines[0][1:].strip())
-        else:
+        :param RESPReader reader: The reader for the connection
+        :rtype: dict
+
+        """
+        commands = [('INFO',), ('INFO', 'commandstats')]
+        if self.config.get('slowlog', True):
+            commands.append(('SLOWLOG', 'GET', 1))
+        replies = self.execute(reader, commands)
+        if isinstance(replies[0], ReplyError):
+            LOGGER.error('INFO failed: %s', replies[0])
             return None
+        values = self.parse_info(replies[0])
+        if not isinstance(replies[1], ReplyError):
+            values.update(self.parse_info(replies[1]))
+        if len(replies) > 2 and not isinstance(replies[2], ReplyError):
+            values['slowlog'] = self.fetch_slowlog(reader, replies[2])
+        return values
+
+    def fetch_slowlog(self, reader, newest):
+        """Return the slowlog entries added since the last poll, using the
+        newest entry to work out how many to fetch. Entry ids only ever
+        increase, so a lower id means the server was restarted. The first
+        poll only records the newest id.
+
+        :param RESPReader reader: The reader for the connection
+        :param list newest: The reply to SLOWLOG GET 1
+        :rtype: list
+
+        """
+        newest_id = newest[0][0] if newest else -1
+        last_id = self.state.get('slowlog_id')
+        self.state['slowlog_id'] = newest_id
+        if last_id is None or newest_id == last_id:
+            return list()
+        if newest_id < last_id:
+            last_id = -1
+        count = min(newest_id - last_id,
+                    int(self.config.get('slowlog_max',
+                                        self.DEFAULT_SLOWLOG_MAX)))
+        if count == 1:
+            return newest
+        entries = self.execute(reader, [('SLOWLOG', 'GET', count)])[0]
+        if isinstance(entries, ReplyError):
+            LOGGER.error('SLOWLOG GET failed: %s', entries)
+            return list()
+        return [entry for entry in entries if entry[0] > last_id]
+
+    def get_reader(self):
+        """Return the reader for the persistent connection, connecting if
+        there is not one.
+
+        :rtype: RESPReader
 
-        while len(buffer_value) < byte_size:
-            buffer_value += connection.recv(self.SOCKET_RECV_MAX)
+        """
+        if 'reader' not in self.state:
+            reader = self.connect()
+            if not reader:
+                return None
+            self.state['reader'] = reader
+        return self.state['reader']
+
+    @staticmethod
+    def metric_total(plugin, metric):
+        """Return the total of a gauge or derive value added by a plugin, or
+        0 if it was not added.
+
+        :param Redis plugin: The plugin that added the value
+        :param str metric: The full metric name
+        :rtype: int or float
+
+        """
+        values = plugin.gauge_values.get(metric,
+                                         plugin.derive_values.get(metric))
+        return values['total'] if values else 0
+
+    @staticmethod
+    def parse_cluster_nodes(reply):
+        """Parse the CLUSTER NODES reply into a list of node dicts with the
+        address, and whether the node is a master and is failing. Nodes
+        without an address are left out.
+
+        :param str reply: The CLUSTER NODES reply
+        :rtype: list
 
-        lines = buffer_value.split('\r\n')
+        """
+        nodes = list()
+        for line in reply.splitlines():
+            fields = line.split(' ')
+            if len(fields) < 8:
+                continue
+            address = fields[1].split('@')[0].split(',')[0]
+            flags = fields[2].split(',')
+            if 'noaddr' in flags or 'handshake' in flags or \
+                    address.endswith(':0'):
+                continue
+            nodes.append({'address': address,
+                          'master': 'master' in flags,
+                          'failed': 'fail' in flags or 'fail?' in flags})
+        return nodes
+
+    @staticmethod
+    def parse_info(info):
+        """Parse an INFO reply in one pass over its lines. Keyspace and
+        commandstats lines hold comma separated key=value pairs and are
+        parsed into dicts.
+
+        :param str info: The INFO reply
+        :rtype: dict
+
+        """
         values = dict()
-        for line in lines:
-            if ':' in line:
-                key, value = line.strip().split(':',1)
-                if key[:2] == 'db':
-                    values[key] = dict()
-                    subvalues = value.split(',')
-                    for temp in subvalues:
-                        subvalue = temp.split('=')
-                        value = subvalue[-1]
-                        try:
-                            values[key][subvalue[0]] = int(value)
-                        except ValueError:
-                            try:
-                                values[key][subvalue[0]] = float(value)
-                            except ValueError:
-                                values[key][subvalue[0]] = value
-                    continue
-                try:
-                    values[key] = int(value)
-                except ValueError:
-                    try:
-                        values[key] = float(value)
-                    except ValueError:
-                        values[key] = value
+        for line in info.split('\r\n'):
+            if not line or line[0] == '#' or ':' not in line:
+                continue
+            key, value = line.split(':', 1)
+            if '=' in value:
+                values[key] = dict()
+                for pair in value.split(','):
+                    name, _separator, subvalue = pair.partition('=')
+                    values[key][name] = Redis.parse_value(subvalue)
+            else:
+                values[key] = Redis.parse_value(value)
         return values
+
+    @staticmethod
+    def parse_value(value):
+        """Return the value as an int or float if it is numeric
+
+        :param str value: The value to parse
+        :rtype: int, float or str
+
+        """
+        try:
+            return int(value)
+        except ValueError:
+            try:
+                return float(value)
+            except ValueError:
+                return value
+
+    def poll(self):
+        """Fetch the stats over the persistent connection, reconnecting once
+        if the connection has gone away since the last poll.
+
+        """
+        LOGGER.info('Polling %s', self.__class__.__name__)
+        self.initialize()
+        if self.config.get('cluster'):
+            return self.poll_cluster()
+
+        data = self.query(self.fetch_data)
+        if data:
+            self.add_datapoints(data)
+            self.finish()
+        else:
+            self.error_message()
+
+    def poll_cluster(self):
+        """Poll every node in the cluster as a separate component, using the
+        configured node as the seed for discovering the topology. The
+        topology is refreshed every topology_interval seconds, or on the
+        next poll after a node could not be polled.
+
+        """
+        info, nodes = self.query(self.cluster_topology) or (None, None)
+        topology = self.state.get('topology')
+        if nodes is not None:
+            topology = {'nodes': nodes, 'refreshed': time.time()}
+            self.state['topology'] = topology
+        if not topology:
+            LOGGER.error('%s could not discover the cluster nodes',
+                         self.__class__.__name__)
+            return
+
+        for node in topology['nodes']:
+            host, _separator, port = node['address'].rpartition(':')
+            config = dict(self.config, name=node['address'], host=host,
+                          port=int(port), cluster=False)
+            config.pop('path', None)
+            self.add_child(node['address'], config)
+        self.poll_children(int(self.config.get('max_concurrency',
+                                               self.DEFAULT_MAX_CONCURRENCY)))
+        if [child for child in self.children.values()
+                if not child.gauge_values]:
+            topology['refreshed'] = 0
+
+        self.add_cluster_datapoints(info, topology['nodes'])
+        self.finish()
+
+    def query(self, method):
+        """Call the method with the reader for the persistent connection,
+        reconnecting and calling it again once if the connection has gone
+        away since the last poll.
+
+        :param callable method: The method to call with the reader
+        :rtype: mixed
+
+        """
+        for attempt in range(2):
+            try:
+                reader = self.get_reader()
+                if not reader:
+                    LOGGER.error('%s could not connect, skipping poll '
+                                 'interval', self.__class__.__name__)
+                    return None
+                return method(reader)
+            except (socket.error, ProtocolError) as error:
+                LOGGER.warning('%s connection failed: %s',
+                               self.__class__.__name__, error)
+                self.disconnect()
+
+    def release_state(self, state):
+        """Close the connection of a cluster node that is no longer polled
+
+        :param dict state: The node's state
+
+        """
+        reader = state.get('reader')
+        if reader:
+            reader.connection.close()
+
+    def topology_due(self):
+        """Return True if the cluster topology should be refreshed
+
+        :rtype: bool
+
+        """
+        topology = self.state.get('topology')
+        if not topology:
+            return True
+        interval = self.config.get('topology_interval',
+                                   self.DEFAULT_TOPOLOGY_INTERVAL)
+        return time.time() - topology['refreshed'] >= interval - 1
@@ -2,10 +2,10 @@
 uWSGI
 
 """
-import json
 import logging
 import re
 
+from newrelic_plugin_agent import codec
 from newrelic_plugin_agent.plugins import base
 
 LOGGER = logging.getLogger(__name__)
@@ -96,6 +96,6 @@ class uWSGI(base.SocketStatsPlugin):
         data = super(uWSGI, self).fetch_data(connection, read_till_empty=True)
         if data:
             data = re.sub(r'"HTTP_COOKIE=[^"]*"', '""', data)
-            return json.loads(data)
+            return codec.loads(data)
         return {}
 
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+"""
+Compare the time per poll cycle spent decoding and encoding JSON with each
+installed backend, using generated payloads shaped like the RabbitMQ queue
+listing, uWSGI stats and Elasticsearch node stats responses and the platform
+payload the agent sends.
+
+    $ python scripts/codec_benchmark.py [--cycles 20]
+
+"""
+import argparse
+import importlib
+import json
+import random
+import timeit
+
+BACKENDS = ['json', 'simplejson', 'ujson']
+
+
+def elasticsearch_node_stats(nodes=60):
+    """Return a node stats document for a cluster of nodes
+
+    :param int nodes: The number of nodes
+    :rtype: dict
+
+    """
+    def node(offset):
+        return {
+            'name': 'node-%i' % offset,
+            'host': '10.0.%i.%i' % (offset / 256, offset % 256),
+            'timestamp': 1414000000000 + offset,
+            'indices': dict([(group, dict([('%s_%i' % (group, field),
+                                            random.randint(0, 2 ** 40))
+                                           for field in range(8)]))
+                             for group in ['docs', 'store', 'indexing', 'get',
+                                           'search', 'merges', 'refresh',
+                                           'flush', 'warmer', 'filter_cache',
+                                           'id_cache', 'fielddata',
+                                           'percolate', 'completion',
+                                           'segments', 'translog']]),
+            'os': {'load_average': [0.5, 0.4, 0.3],
+                   'cpu': {'sys': 3, 'user': 12, 'idle': 84},
+                   'mem': {'free_in_bytes': 2 ** 32,
+                           'used_in_bytes': 2 ** 34}},
+            'jvm': {'mem': dict([('pool_%i' % pool, {'used_in_bytes': 2 ** 30,
+                                                     'max_in_bytes': 2 ** 31})
+                                 for pool in range(6)]),
+                    'gc': {'collectors': {
+                        'young': {'collection_count': 123456,
+                                  'collection_time_in_millis': 987654},
+                        'old': {'collection_count': 12,
+                                'collection_time_in_millis': 3456}}}},
+            'thread_pool': dict([(pool, {'threads': 8, 'queue': 0,
+                                         'active': 1, 'rejected': 0,
+                                         'largest': 8, 'completed': 1234567})
+                                 for pool in ['bulk', 'flush', 'generic',
+                                              'get', 'index', 'management',
+                                              'merge', 'optimize',
+                                              'percolate', 'refresh',
+                                              'search', 'snapshot',
+                                              'suggest', 'warmer']]),
+            'http': {'current_open': 12, 'total_opened': 123456},
+            'transport': {'server_open': 13, 'rx_count': 1234567,
+                          'rx_size_in_bytes': 2 ** 36, 'tx_count': 1234567,
+                          'tx_size_in_bytes': 2 ** 36}}
+    return {'cluster_name': 'benchmark',
+            'nodes': dict([('node-id-%i' % offset, node(offset))
+                           for offset in range(nodes)])}
+
+
+def platform_payload(metrics=10000):
+    """Return a platform payload with the number of metrics
+
+    :param int metrics: The number of metrics
+    :rtype: dict
+
+    """
+    return {'agent': {'host': 'benchmark', 'pid': 1234, 'version': '1.3.0'},
+            'components': [{'name': 'benchmark',
+                            'guid': 'com.meetme.newrelic_plugin_agent',
+                            'duration': 60,
+                            'metrics': dict([
+                                ('Component/Metric/%i[units]' % offset,
+                                 {'min': None, 'max': None,
+                                  'total': random.random() * 1000,
+                                  'count': 1, 'sum_of_squares': 0})
+                                for offset in range(metrics)])}]}
+
+
+def rabbitmq_queues(queues=20000):
+    """Return a queue listing with the columns the plugin requests
+
+    :param int queues: The number of queues
+    :rtype: list
+
+    """
+    return [{'name': 'queue.%i' % offset,
+             'vhost': 'vhost-%i' % (offset % 10),
+             'node': 'rabbit@node-%i' % (offset % 3),
+             'consumers': random.randint(0, 10),
+             'memory': random.randint(0, 2 ** 24),
+             'messages': random.randint(0, 10000),
+             'messages_ready': random.randint(0, 10000),
+             'messages_unacknowledged': random.randint(0, 100),
+             'message_stats': dict([(name, random.randint(0, 2 ** 32))
+                                    for name in ['ack', 'deliver',
+                                                 'deliver_get',
+                                                 'deliver_no_ack', 'get',
+                                                 'get_no_ack', 'publish',
+                                                 'redeliver']])}
+            for offset in range(queues)]
+
+
+def uwsgi_stats(workers=64):
+    """Return a uWSGI stats document for the number of workers
+
+    :param int workers: The number of workers
+    :rtype: dict
+
+    """
+    return {'version': '2.0.7', 'listen_queue': 0, 'listen_queue_errors': 0,
+            'load': 0, 'pid': 1234,
+            'workers': [{'id': worker, 'pid': 2000 + worker,
+                         'requests': random.randint(0, 2 ** 24),
+                         'exceptions': 0, 'status': 'idle', 'rss': 0,
+                         'vsz': 0, 'running_time': random.randint(0, 2 ** 32),
+                         'avg_rt': random.randint(0, 100000), 'tx': 2 ** 32,
+                         'cores': [{'id': core, 'requests': 1234,
+                                    'static_requests': 0, 'routed_requests': 0,
+                                    'offloaded_requests': 0,
+                                    'write_errors': 0, 'read_errors': 0,
+                                    'in_request': 0, 'vars': []}
+                                   for core in range(4)]}
+                        for worker in range(workers)]}
+
+
+def cycle(backend, documents, payload):
+    """Decode each of the documents and encode the payload, as a poll cycle
+    of the agent does.
+
+    :param module backend: The JSON library
+    :param list documents: The JSON documents to decode
+    :param dict payload: The payload to encode
+
+    """
+    for document in documents:
+        backend.loads(document)
+    backend.dumps(payload)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--cycles', type=int, default=20,
+                        help='Poll cycles to time for each backend')
+    args = parser.parse_args()
+
+    random.seed(0)
+    names = ['RabbitMQ queues', 'uWSGI stats', 'Elasticsearch node stats']
+    documents = [json.dumps(rabbitmq_queues()), json.dumps(uwsgi_stats()),
+                 json.dumps(elasticsearch_node_stats())]
+    payload = platform_payload()
+    for name, document in zip(names, documents):
+        print('%-26s %8.1f KB' % (name, len(document) / 1024.0))
+    print('')
+    print('%-12s %9s  %9s  %9s  %9s  %13s' %
+          ('', 'RabbitMQ', 'uWSGI', 'ES', 'Payload', 'Poll cycle'))
+
+    for name in BACKENDS:
+        try:
+            backend = importlib.import_module(name)
+        except ImportError:
+            print('%-12s not installed' % name)
+            continue
+        timings = [min(timeit.repeat(lambda: backend.loads(document),
+                                     number=1, repeat=args.cycles))
+                   for document in documents]
+        timings.append(min(timeit.repeat(lambda: backend.dumps(payload),
+                                         number=1, repeat=args.cycles)))
+        total = min(timeit.repeat(lambda: cycle(backend, documents, payload),
+                                  number=1, repeat=args.cycles))
+        print('%-12s %s  %11.1fms' %
+              (name, '  '.join(['%7.1fms' % (timing * 1000)
+                                for timing in timings]), total * 1000))
+
+
+if __name__ == '__main__':
+    main()
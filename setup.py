@@ -13,10 +13,12 @@ data_files[base_path] = ['LICENSE',
 
 console_scripts = ['newrelic-plugin-agent=newrelic_plugin_agent.agent:main']
 install_requires = ['helper>=2.2.2', 'requests>=2.0.0']
-tests_require = []
-extras_require = {'mongodb': ['pymongo'],
+tests_require = ['ijson', 'psycopg2']
+extras_require = {'elasticsearch': ['ijson'],
+                  'mongodb': ['pymongo'],
                   'pgbouncer': ['psycopg2'],
-                  'postgresql': ['psycopg2']}
+                  'postgresql': ['psycopg2'],
+                  'ujson': ['ujson']}
 
 if sys.version_info < (2, 7, 0):
     install_requires.append('importlib')
@@ -34,6 +36,7 @@ setup(name='newrelic_plugin_agent',
       install_requires=install_requires,
       extras_require=extras_require,
       tests_require=tests_require,
+      test_suite='tests',
       classifiers=[
           'Development Status :: 4 - Beta',
           'Intended Audience :: System Administrators',
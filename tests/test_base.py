@@ -0,0 +1,161 @@
+"""
+Tests for the shared plugin base classes
+
+"""
+import StringIO
+import unittest
+
+import ijson
+import requests
+
+from newrelic_plugin_agent.plugins import base
+
+DOCUMENT = ('{"cluster_name": "test", '
+            '"nodes": {"a": {"name": "node-a", "jvm": {"uptime": 1}, '
+            '"indices": {"docs": {"count": 10, "deleted": 1.5}, '
+            '"store": {"size": 2}}, "http": {"total_opened": 3}}, '
+            '"b": {"name": "node-b", "indices": {"docs": {"count": 20}}, '
+            '"roles": ["data", "master"]}}}')
+
+
+class FakeResponse(object):
+    """A streaming response that yields the given lines, then raises the
+    error if there is one.
+
+    """
+    def __init__(self, lines, error=None):
+        self.lines = lines
+        self.error = error
+        self.closed = False
+
+    def iter_lines(self, chunk_size):
+        for line in self.lines:
+            yield line
+        if self.error:
+            raise self.error
+
+    def close(self):
+        self.closed = True
+
+
+class CSVPlugin(base.CSVStatsPlugin):
+
+    CSV_COLUMNS = ['name', 'rate']
+
+
+class ReadRowsTestCase(unittest.TestCase):
+
+    LINES = ['name,ignored,rate', 'a,x,1', 'b,y,2', 'c']
+
+    def test_rows_are_projected_to_csv_columns(self):
+        response = FakeResponse(self.LINES)
+        self.assertEqual(list(CSVPlugin({}, 60).read_rows(response)),
+                         [{'name': 'a', 'rate': '1'},
+                          {'name': 'b', 'rate': '2'},
+                          {'name': 'c'}])
+        self.assertTrue(response.closed)
+
+    def test_all_columns_without_csv_columns(self):
+        response = FakeResponse(self.LINES[:2])
+        self.assertEqual(list(base.CSVStatsPlugin({}, 60).read_rows(response)),
+                         [{'name': 'a', 'ignored': 'x', 'rate': '1'}])
+
+    def test_empty_body(self):
+        response = FakeResponse([])
+        self.assertEqual(list(CSVPlugin({}, 60).read_rows(response)), [])
+        self.assertTrue(response.closed)
+
+    def test_read_error_stops_rows(self):
+        response = FakeResponse(self.LINES[:2],
+                                requests.exceptions.ChunkedEncodingError())
+        self.assertEqual(list(CSVPlugin({}, 60).read_rows(response)),
+                         [{'name': 'a', 'rate': '1'}])
+        self.assertTrue(response.closed)
+
+    def test_response_closed_when_iteration_stops_early(self):
+        response = FakeResponse(self.LINES)
+        rows = CSVPlugin({}, 60).read_rows(response)
+        rows.next()
+        rows.close()
+        self.assertTrue(response.closed)
+
+
+class HTTPGetTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.get = requests.get
+
+    def tearDown(self):
+        requests.get = self.get
+
+    def test_error_response_is_closed(self):
+        response = FakeResponse([])
+        response.status_code, response.content = 503, 'unavailable'
+        requests.get = lambda **kwargs: response
+        self.assertIsNone(base.HTTPStatsPlugin({}, 60).http_get(stream=True))
+        self.assertTrue(response.closed)
+
+
+class PathMatchTestCase(unittest.TestCase):
+
+    PATHS = [('nodes', '*', 'name'), ('nodes', '*', 'indices', 'docs')]
+
+    def test_root_descends(self):
+        self.assertEqual(base.JSONStatsPlugin.path_match((), self.PATHS),
+                         'descend')
+
+    def test_ancestor_descends(self):
+        self.assertEqual(base.JSONStatsPlugin.path_match(
+            ('nodes', 'a', 'indices'), self.PATHS), 'descend')
+
+    def test_wildcard_matches_any_key(self):
+        self.assertEqual(base.JSONStatsPlugin.path_match(
+            ('nodes', 'b', 'name'), self.PATHS), 'select')
+
+    def test_below_key_path_selects(self):
+        self.assertEqual(base.JSONStatsPlugin.path_match(
+            ('nodes', 'a', 'indices', 'docs', 'count'), self.PATHS), 'select')
+
+    def test_other_path_is_skipped(self):
+        self.assertIsNone(base.JSONStatsPlugin.path_match(
+            ('nodes', 'a', 'jvm'), self.PATHS))
+        self.assertIsNone(base.JSONStatsPlugin.path_match(
+            ('cluster_name',), self.PATHS))
+
+
+class SelectPathsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.plugin = base.JSONStatsPlugin({}, 60)
+
+    def select(self, paths, document=DOCUMENT):
+        return self.plugin.select_paths(ijson.basic_parse(
+            StringIO.StringIO(document)), paths)
+
+    def test_selects_only_matching_subtrees(self):
+        self.assertEqual(
+            self.select([('nodes', '*', 'name'),
+                         ('nodes', '*', 'indices', 'docs')]),
+            {'nodes': {'a': {'name': 'node-a',
+                             'indices': {'docs': {'count': 10,
+                                                  'deleted': 1.5}}},
+                       'b': {'name': 'node-b',
+                             'indices': {'docs': {'count': 20}}}}})
+
+    def test_decimals_are_floats(self):
+        value = self.select([('nodes', 'a', 'indices', 'docs', 'deleted')])
+        self.assertIsInstance(
+            value['nodes']['a']['indices']['docs']['deleted'], float)
+
+    def test_selects_arrays(self):
+        self.assertEqual(self.select([('nodes', 'b', 'roles')]),
+                         {'nodes': {'b': {'roles': ['data', 'master']}}})
+
+    def test_wildcard_matches_array_elements(self):
+        self.assertEqual(
+            self.select([('items', '*', 'id')],
+                        '{"items": [{"id": 1, "x": 2}, {"id": 2}, 3]}'),
+            {'items': [{'id': 1}, {'id': 2}]})
+
+    def test_no_match_returns_empty_root(self):
+        self.assertEqual(self.select([('missing',)]), {})
@@ -0,0 +1,67 @@
+"""
+Tests for the JSON codec
+
+"""
+import json
+import unittest
+
+from newrelic_plugin_agent import codec
+
+
+class FakeBackend(object):
+    """A JSON backend that raises the given error when decoding"""
+
+    __name__ = 'fake'
+
+    def __init__(self, error):
+        self.error = error
+        self.calls = 0
+
+    def loads(self, value):
+        self.calls += 1
+        raise self.error
+
+
+class LoadsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = codec.backend
+
+    def tearDown(self):
+        codec.backend = self.backend
+
+    def test_decodes_document(self):
+        self.assertEqual(codec.loads('{"a": [1, 2.5, "b"]}'),
+                         {'a': [1, 2.5, 'b']})
+
+    def test_decodes_number_wider_than_64_bits(self):
+        self.assertEqual(codec.loads('[123456789012345678901234567890]'),
+                         [123456789012345678901234567890])
+
+    def test_falls_back_on_overflow_error(self):
+        codec.backend = FakeBackend(OverflowError('overflow'))
+        self.assertEqual(codec.loads('[1]'), [1])
+
+    def test_falls_back_on_too_big_value_error(self):
+        codec.backend = FakeBackend(ValueError('Value is too big!'))
+        self.assertEqual(codec.loads('[1]'), [1])
+
+    def test_invalid_document_is_not_decoded_again(self):
+        codec.backend = FakeBackend(ValueError('Expected object or value'))
+        self.assertRaises(ValueError, codec.loads, '[1]')
+        self.assertEqual(codec.backend.calls, 1)
+
+    def test_invalid_document_raises_with_stdlib_backend(self):
+        codec.backend = json
+        self.assertRaises(ValueError, codec.loads, '{"a": ')
+
+
+class DumpsTestCase(unittest.TestCase):
+
+    def test_round_trip(self):
+        value = {'a': [1, 2.5, 'b', None, True]}
+        self.assertEqual(codec.loads(codec.dumps(value)), value)
+
+    def test_encodes_number_wider_than_64_bits(self):
+        self.assertEqual(codec.dumps([123456789012345678901234567890]),
+                         '[123456789012345678901234567890]')
@@ -0,0 +1,97 @@
+"""
+Tests for the Elasticsearch plugin
+
+"""
+import unittest
+
+from newrelic_plugin_agent.plugins import elasticsearch
+
+
+def node(name, tcp=None):
+    value = {'name': name, 'http': {'total_opened': 3},
+             'transport': {'rx_size_in_bytes': 10, 'tx_size_in_bytes': 20}}
+    if tcp is not None:
+        value['network'] = {'tcp': tcp}
+    return value
+
+
+class NetworkDatapointsTestCase(unittest.TestCase):
+
+    TCP = 'Component/Network/Connections/Active[conn]'
+
+    def setUp(self):
+        self.plugin = elasticsearch.ElasticSearch({}, 60)
+        self.plugin._state = dict()
+
+    def run_once(self, *nodes):
+        self.plugin.initialize()
+        self.plugin.add_datapoints(
+            {'nodes': dict((value['name'], value) for value in nodes)})
+        return self.plugin.derive_last_interval
+
+    def test_tcp_values_are_summed_when_returned(self):
+        tcp = {'active_opens': 5, 'in_errs': 1, 'retrans_segs': 2}
+        values = self.run_once(node('a', tcp), node('b', tcp))
+        self.assertEqual(values[self.TCP], 10)
+        self.assertEqual(values['Component/Network/Segments/In[errors]'], 2)
+        self.assertEqual(
+            values['Component/Network/Segments/Retransmitted[seg]'], 4)
+        self.assertEqual(values['Component/Network/Traffic/Sent[bytes]'], 40)
+
+    def test_tcp_values_are_left_out_when_not_returned(self):
+        values = self.run_once(node('a'), node('b'))
+        self.assertNotIn(self.TCP, values)
+        self.assertEqual(values['Component/Network/HTTP Connections[conn]'],
+                         6)
+
+    def test_tcp_values_are_in_the_filter_path(self):
+        self.assertIn('nodes.*.network.tcp',
+                      elasticsearch.ElasticSearch.DEFAULT_QUERY)
+
+
+def index(indexed, queries, query_time, size):
+    return {'total': {'indexing': {'index_total': indexed},
+                      'search': {'query_total': queries,
+                                 'query_time_in_millis': query_time},
+                      'store': {'size_in_bytes': size}}}
+
+
+class AddTopIndexStatsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.plugin = elasticsearch.ElasticSearch({'top_indices': 1}, 60)
+        self.plugin._state = dict()
+
+    def run_once(self, indices):
+        self.plugin.initialize()
+        self.plugin.add_top_index_stats(indices)
+        return dict((name, value['total'])
+                    for name, value in self.plugin.gauge_values.items())
+
+    def test_first_poll_only_records_counters(self):
+        self.assertEqual(self.run_once({'logs': index(1, 1, 1, 1)}), {})
+        self.assertEqual(self.plugin.state['index_counters'],
+                         {'logs': (1, 1, 1)})
+
+    def test_most_active_index_and_other(self):
+        self.run_once({'a': index(100, 10, 50, 1000),
+                       'b': index(100, 10, 50, 2000),
+                       'c': index(100, 10, 50, 3000)})
+        values = self.run_once({'a': index(110, 14, 70, 1100),
+                                'b': index(200, 20, 150, 2200),
+                                'c': index(100, 10, 50, 3300),
+                                'd': index(500, 0, 0, 400)})
+        self.assertEqual(values,
+                         {'Component/Index/b/Indexing[docs]': 100,
+                          'Component/Index/b/Search Queries[queries]': 10,
+                          'Component/Index/b/Search Query Time[ms]': 10.0,
+                          'Component/Index/b/Storage[bytes]': 2200,
+                          'Component/Index/Other/Indexing[docs]': 10,
+                          'Component/Index/Other/Search Queries[queries]': 4,
+                          'Component/Index/Other/Search Query Time[ms]': 5.0,
+                          'Component/Index/Other/Storage[bytes]': 4800})
+
+    def test_deleted_indices_are_forgotten(self):
+        self.run_once({'a': index(1, 1, 1, 1), 'b': index(1, 1, 1, 1)})
+        self.run_once({'b': index(2, 2, 2, 1)})
+        self.assertEqual(sorted(self.plugin.state['index_counters']), ['b'])
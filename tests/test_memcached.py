@@ -0,0 +1,126 @@
+"""
+Tests for the memcached plugin
+
+"""
+import socket
+import unittest
+
+from newrelic_plugin_agent.plugins import memcached
+
+
+class ProcessLineTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.plugin = memcached.Memcached({}, 60)
+        self.values, self.slabs = dict(), dict()
+
+    def process(self, reply, *lines):
+        for line in lines:
+            self.plugin.process_line(reply, line, self.values, self.slabs)
+
+    def test_stats_keeps_only_reported_keys(self):
+        self.process(0, 'STAT curr_connections 10', 'STAT rusage_user 0.5',
+                     'STAT version 1.4.25', 'STAT pid 42')
+        self.assertEqual(self.values, {'curr_connections': 10,
+                                       'rusage_user': 0.5})
+        self.assertEqual(self.slabs, {})
+
+    def test_stats_slabs_lines_are_per_slab(self):
+        self.process(1, 'STAT 1:chunk_size 96', 'STAT 1:total_pages 2',
+                     'STAT 12:chunk_size 1184')
+        self.assertEqual(self.slabs, {'1': {'chunk_size': 96,
+                                            'total_pages': 2},
+                                      '12': {'chunk_size': 1184}})
+
+    def test_stats_slabs_global_values(self):
+        self.process(1, 'STAT active_slabs 2', 'STAT total_malloced 2097152')
+        self.assertEqual(self.values, {'active_slabs': 2,
+                                       'total_malloced': 2097152})
+
+    def test_stats_items_lines_are_per_slab(self):
+        self.process(2, 'STAT items:1:number 5', 'STAT items:1:age 3600',
+                     'STAT items:3:evicted 7')
+        self.assertEqual(self.slabs, {'1': {'number': 5, 'age': 3600},
+                                      '3': {'evicted': 7}})
+
+    def test_ignores_other_lines(self):
+        self.process(1, 'END', 'ERROR', 'STAT 1:chunk_size', '')
+        self.process(2, 'STAT 1:chunk_size 96')
+        self.assertEqual(self.values, {})
+        self.assertEqual(self.slabs, {})
+
+    def test_unparsable_value_is_zero(self):
+        self.process(0, 'STAT curr_items many')
+        self.assertEqual(self.values, {'curr_items': 0})
+
+
+class FakeConnection(object):
+    """A socket that returns the given chunks from recv, raising the error
+    once they run out if one is given.
+
+    """
+    def __init__(self, chunks, error=None):
+        self.chunks = list(chunks)
+        self.error = error
+        self.sent = list()
+
+    def sendall(self, data):
+        self.sent.append(data)
+
+    def recv(self, size):
+        if not self.chunks and self.error:
+            raise self.error
+        return self.chunks.pop(0) if self.chunks else ''
+
+
+class FetchDataTestCase(unittest.TestCase):
+
+    REPLIES = ('STAT curr_connections 10\r\nSTAT get_hits 4\r\nEND\r\n'
+               'STAT 1:chunk_size 96\r\nSTAT active_slabs 1\r\nEND\r\n'
+               'STAT items:1:number 5\r\nEND\r\n')
+
+    def setUp(self):
+        self.plugin = memcached.Memcached({}, 60)
+
+    def fetch(self, *chunks):
+        return self.plugin.fetch_data(FakeConnection(chunks))
+
+    def test_commands_are_sent_in_one_write(self):
+        connection = FakeConnection([self.REPLIES])
+        self.plugin.fetch_data(connection)
+        self.assertEqual(connection.sent,
+                         ['stats\r\nstats slabs\r\nstats items\r\n'])
+
+    def test_replies_in_one_chunk(self):
+        values = self.fetch(self.REPLIES)
+        self.assertEqual(values['curr_connections'], 10)
+        self.assertEqual(values['active_slabs'], 1)
+        self.assertEqual(values['slabs'], {'1': {'chunk_size': 96,
+                                                 'number': 5}})
+
+    def test_lines_split_across_chunks(self):
+        chunks = [self.REPLIES[offset:offset + 7]
+                  for offset in range(0, len(self.REPLIES), 7)]
+        self.assertEqual(self.fetch(*chunks), self.fetch(self.REPLIES))
+
+    def test_line_ending_split_across_chunks(self):
+        offset = self.REPLIES.index('\n')
+        values = self.fetch(self.REPLIES[:offset], self.REPLIES[offset:])
+        self.assertEqual(values['curr_connections'], 10)
+        self.assertEqual(values['get_hits'], 4)
+
+    def test_terminator_split_across_chunks(self):
+        offset = self.REPLIES.index('END') + 1
+        values = self.fetch(self.REPLIES[:offset], self.REPLIES[offset:])
+        self.assertEqual(values['slabs']['1']['number'], 5)
+
+    def test_missing_values_are_zero(self):
+        self.assertEqual(self.fetch(self.REPLIES)['curr_items'], 0)
+
+    def test_connection_closed_before_the_last_reply(self):
+        self.assertIsNone(self.fetch(self.REPLIES[:-8]))
+
+    def test_recv_error(self):
+        connection = FakeConnection([self.REPLIES[:20]],
+                                    socket.timeout('timed out'))
+        self.assertIsNone(self.plugin.fetch_data(connection))
@@ -0,0 +1,326 @@
+"""
+Tests for the MongoDB plugin
+
+"""
+import datetime
+import threading
+import time
+import unittest
+
+import pymongo
+from pymongo import errors
+
+from newrelic_plugin_agent.plugins import mongodb
+
+CONFIG = {'host': 'localhost', 'port': 27017, 'name': 'test',
+          'databases': ['a', 'b', 'c']}
+
+
+class FakeDatabase(object):
+    """Answer commands from the server's responses, recording each command
+    with its options.
+
+    """
+    def __init__(self, server, name):
+        self.server = server
+        self.name = name
+
+    def authenticate(self, username, password=None):
+        self.server.authenticated.append((self.name, username))
+
+    def command(self, name, **kwargs):
+        server = self.server
+        with server.lock:
+            server.commands.append((self.name, name, kwargs))
+            server.active += 1
+            server.most_active = max(server.most_active, server.active)
+        time.sleep(server.delay)
+        try:
+            response = server.responses.get((self.name, name))
+            if response is None:
+                raise errors.OperationFailure('no such command: %s' % name)
+            if isinstance(response, Exception):
+                raise response
+            return response
+        finally:
+            with server.lock:
+                server.active -= 1
+
+
+class FakeServer(object):
+
+    def __init__(self):
+        self.responses = {('admin', 'serverStatus'): {'version': '4.0.5'}}
+        self.commands, self.authenticated = list(), list()
+        self.clients = list()
+        self.active = self.most_active = self.delay = 0
+        self.lock = threading.Lock()
+
+
+class FakeClient(object):
+
+    servers = dict()
+
+    def __init__(self, host, port, **kwargs):
+        self.address = (host, port)
+        self.server = self.servers.setdefault(self.address, FakeServer())
+        self.server.clients.append(self)
+        self.closed = False
+
+    def __getitem__(self, name):
+        return FakeDatabase(self.server, name)
+
+    @property
+    def admin(self):
+        return self['admin']
+
+    def close(self):
+        self.closed = True
+
+
+class MongoDBTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = pymongo.MongoClient
+        pymongo.MongoClient = FakeClient
+        FakeClient.servers = dict()
+        self.server = self.add_server('localhost', 27017)
+        self.state = dict()
+
+    def tearDown(self):
+        pymongo.MongoClient = self.client
+
+    @staticmethod
+    def add_server(host, port):
+        server = FakeServer()
+        FakeClient.servers[(host, port)] = server
+        return server
+
+    def poll(self, config=None):
+        plugin = mongodb.MongoDB(config or CONFIG, 60)
+        plugin._state = self.state
+        plugin.poll()
+        return plugin
+
+    def commands(self, name, server=None):
+        return [command for command in (server or self.server).commands
+                if command[1] == name]
+
+
+class ClientTestCase(MongoDBTestCase):
+
+    def test_one_client_is_kept_between_polls(self):
+        self.poll()
+        self.poll()
+        self.assertEqual(len(self.server.clients), 1)
+        self.assertFalse(self.server.clients[0].closed)
+        self.assertEqual(len(self.commands('serverStatus')), 2)
+
+    def test_client_authenticates_once(self):
+        config = dict(CONFIG, admin_username='admin',
+                      databases={'a': {'username': 'reader'}, 'b': None})
+        self.poll(config)
+        self.poll(config)
+        self.assertEqual(self.server.authenticated,
+                         [('admin', 'admin'), ('a', 'reader')])
+
+    def test_failed_admin_authentication_closes_the_client(self):
+        def authenticate(database, username, password=None):
+            raise errors.OperationFailure('auth failed')
+        FakeDatabase.authenticate, original = (authenticate,
+                                               FakeDatabase.authenticate)
+        try:
+            self.poll(dict(CONFIG, admin_username='admin'))
+        finally:
+            FakeDatabase.authenticate = original
+        self.assertTrue(self.server.clients[0].closed)
+        self.assertNotIn('client', self.state)
+
+
+class DatabaseStatsTestCase(MongoDBTestCase):
+
+    def setUp(self):
+        super(DatabaseStatsTestCase, self).setUp()
+        for database in CONFIG['databases']:
+            self.server.responses[(database, 'dbStats')] = {'objects': 5}
+
+    def test_db_stats_are_fetched_for_each_database(self):
+        plugin = self.poll()
+        self.assertEqual(sorted(command[0] for command
+                                in self.commands('dbStats')),
+                         ['a', 'b', 'c'])
+        for database in CONFIG['databases']:
+            self.assertEqual(plugin.gauge_values[
+                'Component/Database/%s/Objects[objects]' %
+                database]['total'], 5)
+
+    def test_concurrency_is_bounded_by_max_concurrency(self):
+        self.server.delay = 0.05
+        self.poll(dict(CONFIG, max_concurrency=2))
+        self.assertEqual(self.server.most_active, 2)
+
+    def test_failed_database_is_left_out(self):
+        self.server.responses[('b', 'dbStats')] = errors.OperationFailure(
+            'not authorized')
+        plugin = self.poll()
+        self.assertNotIn('Component/Database/b/Objects[objects]',
+                         plugin.gauge_values)
+        self.assertIn('Component/Database/c/Objects[objects]',
+                      plugin.gauge_values)
+
+
+class ServerStatusTestCase(MongoDBTestCase):
+
+    def exclusions(self):
+        return self.commands('serverStatus')[-1][2]
+
+    def test_unreported_sections_are_excluded(self):
+        self.poll()
+        self.assertEqual(self.exclusions(),
+                         dict([(section, 0) for section
+                               in mongodb.EXCLUDED_SECTIONS]))
+
+    def test_optional_sections_can_be_requested(self):
+        config = dict(CONFIG, server_status_sections=['wiredTiger', 'locks'])
+        self.server.responses[('admin', 'serverStatus')] = {
+            'version': '4.0.5',
+            'wiredTiger': {'cache': {'bytes currently in the cache': 10}}}
+        plugin = self.poll(config)
+        self.assertNotIn('wiredTiger', self.exclusions())
+        self.assertIn('locks', self.exclusions())
+        self.assertEqual(plugin.gauge_values[
+            'Component/WiredTiger/Cache/Used[bytes]']['total'], 10)
+
+    def test_metrics_are_excluded_for_servers_older_than_3_2(self):
+        self.server.responses[('admin', 'serverStatus')] = {
+            'version': '3.0.12'}
+        self.poll()
+        self.assertNotIn('metrics', self.exclusions())
+        self.poll()
+        self.assertEqual(self.exclusions()['metrics'], 0)
+
+    def test_metrics_are_kept_for_cursor_counts(self):
+        self.server.responses[('admin', 'serverStatus')] = {
+            'version': '3.6.3-rc0',
+            'metrics': {'cursor': {'open': {'total': 4}, 'timedOut': 1}}}
+        plugin = self.poll()
+        self.poll()
+        self.assertNotIn('metrics', self.exclusions())
+        self.assertEqual(plugin.gauge_values[
+            'Component/Cursors/Open[cursors]']['total'], 4)
+        self.assertNotIn('Component/Documents/Inserted[documents]',
+                         plugin.derive_values)
+
+
+class ParseVersionTestCase(unittest.TestCase):
+
+    def test_parse_version(self):
+        self.assertEqual(mongodb.MongoDB.parse_version('3.6.3-rc0'),
+                         (3, 6, 3))
+
+    def test_unknown_version(self):
+        self.assertIsNone(mongodb.MongoDB.parse_version(None))
+        self.assertIsNone(mongodb.MongoDB.parse_version('unknown'))
+
+
+class DiscoverDatabasesTestCase(MongoDBTestCase):
+
+    CONFIG = dict(CONFIG, databases=None, discover_databases=True,
+                  include_databases=['app_*', 'admin'],
+                  exclude_databases=['*_test'])
+
+    def setUp(self):
+        super(DiscoverDatabasesTestCase, self).setUp()
+        names = ['admin', 'app_one', 'app_two', 'app_test', 'local']
+        self.server.responses[('admin', 'listDatabases')] = {
+            'databases': [{'name': name} for name in names]}
+        for name in names:
+            self.server.responses[(name, 'dbStats')] = {'objects': 1}
+
+    def test_databases_are_filtered_by_pattern(self):
+        self.poll(self.CONFIG)
+        self.assertEqual(self.commands('listDatabases')[0][2],
+                         {'nameOnly': True})
+        self.assertEqual(sorted(command[0] for command
+                                in self.commands('dbStats')),
+                         ['admin', 'app_one', 'app_two'])
+
+    def test_all_databases_are_included_by_default(self):
+        config = dict(self.CONFIG)
+        del config['include_databases']
+        self.poll(config)
+        self.assertEqual(len(self.commands('dbStats')), 4)
+
+
+def member(name, state, optime, is_self=False, health=1):
+    value = {'name': name, 'state': state, 'health': health,
+             'optimeDate': datetime.datetime(2020, 1, 1, 0, 0, optime)}
+    if is_self:
+        value['self'] = True
+    return value
+
+
+class MembersTestCase(MongoDBTestCase):
+
+    CONFIG = dict(CONFIG, databases=list(), discover_members=True)
+
+    def setUp(self):
+        super(MembersTestCase, self).setUp()
+        self.secondary = self.add_server('db2', 27018)
+        self.arbiter = self.add_server('db3', 27019)
+        self.set_members([member('localhost:27017', 1, 30, True),
+                          member('db2:27018', 2, 20),
+                          member('db3:27019', 2, 25, health=0)])
+
+    def set_members(self, members):
+        self.server.responses[('admin', 'replSetGetStatus')] = {
+            'members': members}
+
+    @staticmethod
+    def gauge(plugin, name, units):
+        return plugin.gauge_values['Component/%s[%s]' % (name, units)][
+            'total']
+
+    def test_members_are_polled_as_children(self):
+        plugin = self.poll(self.CONFIG)
+        self.assertEqual(sorted(plugin.children), ['db2:27018', 'db3:27019'])
+        self.assertEqual(len(self.commands('serverStatus', self.secondary)),
+                         1)
+        self.assertFalse(self.commands('replSetGetStatus', self.secondary))
+        self.assertEqual(self.gauge(plugin, 'Replica Set/Members',
+                                    'members'), 3)
+        self.assertEqual(self.gauge(plugin, 'Replica Set/Healthy Members',
+                                    'members'), 2)
+
+    def test_lag_is_measured_from_the_primary_optime(self):
+        plugin = self.poll(self.CONFIG)
+        self.assertEqual(self.gauge(plugin, 'Replication/Lag', 'seconds'), 0)
+        children = plugin.children
+        self.assertEqual(self.gauge(children['db2:27018'], 'Replication/Lag',
+                                    'seconds'), 10)
+        self.assertEqual(self.gauge(children['db3:27019'], 'Replication/Lag',
+                                    'seconds'), 5)
+        self.assertEqual(self.gauge(children['db3:27019'],
+                                    'Replication/Health', 'health'), 0)
+
+    def test_lag_uses_the_newest_optime_without_a_primary(self):
+        self.set_members([member('localhost:27017', 2, 30, True),
+                          member('db2:27018', 2, 20)])
+        plugin = self.poll(self.CONFIG)
+        self.assertEqual(self.gauge(plugin.children['db2:27018'],
+                                    'Replication/Lag', 'seconds'), 10)
+
+    def test_removed_member_client_is_closed(self):
+        self.poll(self.CONFIG)
+        self.set_members([member('localhost:27017', 1, 30, True),
+                          member('db2:27018', 2, 20)])
+        self.poll(self.CONFIG)
+        self.assertTrue(self.arbiter.clients[0].closed)
+        self.assertFalse(self.secondary.clients[0].closed)
+        self.assertEqual(len(self.secondary.clients), 1)
+        self.assertEqual(sorted(self.state['children']), ['db2:27018'])
+
+    def test_standalone_server_has_no_members(self):
+        del self.server.responses[('admin', 'replSetGetStatus')]
+        plugin = self.poll(self.CONFIG)
+        self.assertFalse(plugin.children)
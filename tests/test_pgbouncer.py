@@ -0,0 +1,222 @@
+"""
+Tests for the pgBouncer plugin
+
+"""
+import datetime
+import time
+import unittest
+
+import psycopg2
+
+from newrelic_plugin_agent.plugins import pgbouncer
+
+CONFIG = {'host': 'localhost', 'port': 6432, 'user': 'stats',
+          'name': 'test'}
+
+
+class FakeCursor(object):
+    """Answer the SHOW commands from the connection's results, as lists of
+    row dicts that are iterated over like a psycopg2 cursor.
+
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = list()
+        self.description = list()
+
+    def execute(self, query, args=None):
+        connection = self.connection
+        connection.statements.append(query)
+        if connection.lost:
+            connection.closed = 2
+            raise psycopg2.OperationalError('server closed the connection')
+        self.rows = connection.results.get(query, list())
+        columns = list()
+        for row in self.rows:
+            columns += [column for column in row if column not in columns]
+        self.description = [(column,) for column in columns]
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+
+    def __init__(self, results):
+        self.results = results
+        self.statements = list()
+        self.closed = 0
+        self.lost = False
+        self.server_version = 10803
+
+    def cursor(self, cursor_factory=None):
+        return FakeCursor(self)
+
+    def close(self):
+        self.closed = 1
+
+    def set_isolation_level(self, level):
+        pass
+
+
+def server(database, connect_time):
+    return {'database': database, 'state': 'active',
+            'connect_time': connect_time, 'request_time': connect_time}
+
+
+def client(database, connect_time, state='active', wait=0, wait_us=None,
+           request_time=None):
+    row = {'database': database, 'state': state, 'wait': wait,
+           'connect_time': connect_time,
+           'request_time': request_time or connect_time}
+    if wait_us is not None:
+        row['wait_us'] = wait_us
+    return row
+
+
+def pool(database, user, cl_active, maxwait, maxwait_us=0):
+    return {'database': database, 'user': user, 'cl_active': cl_active,
+            'cl_waiting': 1, 'sv_active': 2, 'sv_idle': 0, 'sv_login': 0,
+            'sv_tested': 0, 'sv_used': 1, 'maxwait': maxwait,
+            'maxwait_us': maxwait_us}
+
+
+class PgBouncerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.connect = psycopg2.connect
+        psycopg2.connect = self.fake_connect
+        self.connections, self.results = list(), dict()
+        self.state, self.arguments = dict(), list()
+
+    def tearDown(self):
+        psycopg2.connect = self.connect
+
+    def fake_connect(self, **kwargs):
+        self.arguments.append(kwargs)
+        connection = FakeConnection(self.results)
+        self.connections.append(connection)
+        return connection
+
+    def poll(self):
+        plugin = pgbouncer.PgBouncer(CONFIG, 60)
+        plugin._state = self.state
+        plugin.poll()
+        return plugin
+
+    @staticmethod
+    def timestamp(seconds_ago):
+        return time.strftime('%Y-%m-%d %H:%M:%S UTC',
+                             time.gmtime(time.time() - seconds_ago))
+
+    def gauge(self, plugin, name, units='seconds'):
+        return plugin.gauge_values['Component/%s[%s]' % (name, units)]
+
+
+class PollTestCase(PgBouncerTestCase):
+
+    def test_admin_console_connection_is_reused(self):
+        self.poll()
+        self.poll()
+        self.assertEqual(len(self.connections), 1)
+        self.assertEqual(self.arguments[0]['database'], 'pgbouncer')
+
+    def test_no_server_parameters_are_set(self):
+        self.poll()
+        self.assertFalse([statement
+                          for statement in self.connections[0].statements
+                          if not statement.startswith('SHOW')])
+
+    def test_reconnects_and_retries_once_when_the_connection_is_lost(self):
+        self.results['SHOW LISTS'] = [{'list': 'pools', 'items': 3}]
+        self.poll()
+        self.connections[0].lost = True
+        plugin = self.poll()
+        self.assertEqual(len(self.connections), 2)
+        self.assertEqual(self.gauge(plugin, 'Overview/Pools',
+                                    'pools')['total'], 3)
+
+
+class PoolStatsTestCase(PgBouncerTestCase):
+
+    def test_pools_for_each_user_are_summed(self):
+        self.results['SHOW POOLS'] = [pool('app', 'a', 3, 1, 500000),
+                                      pool('app', 'b', 4, 2),
+                                      pool('jobs', 'a', 1, 0)]
+        plugin = self.poll()
+        self.assertEqual(self.gauge(plugin, 'Pools/app/Clients/Active',
+                                    'clients')['total'], 7)
+        self.assertEqual(self.gauge(plugin, 'Pools/app/Servers/Active',
+                                    'servers')['total'], 4)
+        self.assertEqual(self.gauge(plugin, 'Pools/jobs/Clients/Active',
+                                    'clients')['total'], 1)
+
+    def test_longest_wait_is_reported(self):
+        self.results['SHOW POOLS'] = [pool('app', 'a', 3, 2, 250000),
+                                      pool('app', 'b', 4, 1, 900000)]
+        plugin = self.poll()
+        self.assertEqual(self.gauge(plugin, 'Pools/app/Maximum Wait')['total'],
+                         2.25)
+
+
+class ConnectionStatsTestCase(PgBouncerTestCase):
+
+    def test_server_connection_age_distribution(self):
+        self.results['SHOW SERVERS'] = [server('app', self.timestamp(10)),
+                                        server('app', self.timestamp(30)),
+                                        server('jobs', self.timestamp(5))]
+        plugin = self.poll()
+        ages = self.gauge(plugin, 'Pools/app/Servers/Connection Age')
+        self.assertEqual(ages['count'], 2)
+        self.assertAlmostEqual(ages['min'], 10, delta=2)
+        self.assertAlmostEqual(ages['max'], 30, delta=2)
+        self.assertAlmostEqual(ages['total'], 40, delta=2)
+        self.assertAlmostEqual(ages['sum_of_squares'], 1000, delta=200)
+        self.assertEqual(self.gauge(
+            plugin, 'Pools/jobs/Servers/Connection Age')['count'], 1)
+        self.assertNotIn('Component/Pools/app/Servers/Wait Time[seconds]',
+                         plugin.gauge_values)
+
+    def test_wait_time_of_waiting_clients_from_wait_columns(self):
+        self.results['SHOW CLIENTS'] = [
+            client('app', self.timestamp(60)),
+            client('app', self.timestamp(60), 'waiting', 1, 500000),
+            client('app', self.timestamp(60), 'waiting', 3, 0)]
+        plugin = self.poll()
+        waits = self.gauge(plugin, 'Pools/app/Clients/Wait Time')
+        self.assertEqual(waits['count'], 2)
+        self.assertEqual((waits['min'], waits['max'], waits['total']),
+                         (1.5, 3, 4.5))
+        self.assertEqual(self.gauge(
+            plugin, 'Pools/app/Clients/Connection Age')['count'], 3)
+
+    def test_wait_time_from_request_time_on_older_versions(self):
+        self.results['SHOW CLIENTS'] = [
+            client('app', self.timestamp(60), 'waiting',
+                   request_time=self.timestamp(20))]
+        plugin = self.poll()
+        self.assertAlmostEqual(self.gauge(
+            plugin, 'Pools/app/Clients/Wait Time')['total'], 20, delta=2)
+
+
+class ParseTimestampTestCase(unittest.TestCase):
+
+    def test_utc_string(self):
+        self.assertEqual(pgbouncer.PgBouncer.parse_timestamp(
+            '2020-01-02 03:04:05 UTC', dict()), 1577934245)
+
+    def test_datetime(self):
+        value = datetime.datetime(2020, 1, 2, 3, 4, 5)
+        self.assertEqual(pgbouncer.PgBouncer.parse_timestamp(value, dict()),
+                         time.mktime(value.timetuple()))
+
+    def test_empty_value(self):
+        self.assertIsNone(pgbouncer.PgBouncer.parse_timestamp(None, dict()))
+
+    def test_parsed_values_are_cached(self):
+        timestamps = {'2020-01-02 03:04:05 UTC': 1}
+        self.assertEqual(pgbouncer.PgBouncer.parse_timestamp(
+            '2020-01-02 03:04:05 UTC', timestamps), 1)
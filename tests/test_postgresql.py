@@ -0,0 +1,491 @@
+"""
+Tests for the PostgreSQL plugin
+
+"""
+import decimal
+import json
+import re
+import unittest
+
+import psycopg2
+
+from newrelic_plugin_agent.plugins import postgresql
+
+BATCHED = re.compile(r'\(SELECT (json_agg|row_to_json)\(q\) FROM \((.*?)\) '
+                     r'AS q\) AS (\w+)', re.DOTALL)
+
+CONFIG = {'host': 'localhost', 'name': 'test', 'superuser': False,
+          'relation_stats': False}
+
+
+class FakeCursor(object):
+    """Answer queries from the connection's results, as lists of row dicts.
+    Batched statements are answered with each query's rows as JSON.
+
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = list()
+
+    def execute(self, query, args=None):
+        connection = self.connection
+        connection.statements.append(query)
+        if connection.lost:
+            connection.closed = 2
+            raise psycopg2.OperationalError('server closed the connection')
+        if query.startswith('SELECT (SELECT'):
+            row = dict()
+            for function, inner, name in BATCHED.findall(query):
+                rows = self.results(inner)
+                if function == 'json_agg':
+                    row[name] = json.dumps(rows) if rows else None
+                else:
+                    row[name] = json.dumps(rows[0]) if rows else None
+            self.rows = [row]
+        else:
+            self.rows = self.results(query)
+
+    def results(self, query):
+        query = query.strip().rstrip(';')
+        for failing in self.connection.failing:
+            if failing in query:
+                raise psycopg2.ProgrammingError('permission denied')
+        return self.connection.results.get(query, list())
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+
+    def __init__(self, database, results, failing):
+        self.database = database
+        self.results = results
+        self.failing = failing
+        self.statements = list()
+        self.closed = 0
+        self.lost = False
+        self.server_version = 100005
+
+    def cursor(self, cursor_factory=None):
+        return FakeCursor(self)
+
+    def close(self):
+        self.closed = 1
+
+    def set_isolation_level(self, level):
+        pass
+
+
+class PostgreSQLTestCase(unittest.TestCase):
+    """Connect the plugin to fake connections that answer from results,
+    raising a permission error for queries containing a failing string.
+
+    """
+    def setUp(self):
+        self.connect = psycopg2.connect
+        psycopg2.connect = self.fake_connect
+        self.connections, self.results, self.failing = list(), dict(), set()
+        self.state, self.last, self.refuse = dict(), None, False
+
+    def tearDown(self):
+        psycopg2.connect = self.connect
+
+    def fake_connect(self, **kwargs):
+        if self.refuse:
+            raise psycopg2.OperationalError('connection refused')
+        connection = FakeConnection(kwargs.get('database'), self.results,
+                                    self.failing)
+        self.connections.append(connection)
+        return connection
+
+    def set_results(self, query, rows):
+        self.results[query.strip().rstrip(';')] = rows
+
+    def poll(self, config=None, poll_interval=60):
+        plugin = postgresql.PostgreSQL(config or CONFIG, poll_interval,
+                                       self.last)
+        plugin._state = self.state
+        plugin.poll()
+        self.last = plugin.derive_last_interval
+        return plugin
+
+    @staticmethod
+    def values(plugin):
+        totals = dict()
+        for metrics in (plugin.gauge_values, plugin.derive_values):
+            for name, value in metrics.items():
+                totals[name] = value['total']
+        return totals
+
+
+class FetchStatsTestCase(PostgreSQLTestCase):
+
+    QUERIES = [('locks', postgresql.LOCKS, True),
+               ('transactions', postgresql.TRANSACTIONS, False),
+               ('bgwriter', postgresql.BGWRITER, False)]
+
+    def setUp(self):
+        super(FetchStatsTestCase, self).setUp()
+        self.set_results(postgresql.LOCKS, [{'mode': 'ShareLock',
+                                             'count': 2}])
+        self.set_results(postgresql.TRANSACTIONS,
+                         [{'transactions_committed': 5}])
+        self.plugin = postgresql.PostgreSQL(CONFIG, 60)
+        self.plugin._state = self.state
+        self.plugin.state['server_version'] = (10, 0, 5)
+        self.connection = self.fake_connect()
+
+    def fetch(self):
+        return self.plugin.fetch_stats(self.connection.cursor(),
+                                       self.QUERIES)
+
+    def test_queries_are_batched_in_one_statement(self):
+        self.assertEqual(self.fetch(),
+                         {'locks': [{'mode': 'ShareLock', 'count': 2}],
+                          'transactions': {'transactions_committed': 5},
+                          'bgwriter': {}})
+        self.assertEqual(len(self.connection.statements), 1)
+
+    def test_old_servers_run_each_query(self):
+        self.plugin.state['server_version'] = (9, 2, 4)
+        self.assertEqual(self.fetch()['transactions'],
+                         {'transactions_committed': 5})
+        self.assertEqual(len(self.connection.statements), 3)
+
+    def test_failed_batch_falls_back_to_separate_queries(self):
+        self.failing.add('pg_stat_bgwriter')
+        self.assertEqual(self.fetch(),
+                         {'locks': [{'mode': 'ShareLock', 'count': 2}],
+                          'transactions': {'transactions_committed': 5}})
+        self.assertEqual(len(self.connection.statements), 4)
+        self.assertEqual(self.plugin.state['separate_queries'],
+                         set(['bgwriter']))
+
+    def test_failed_query_runs_separately_on_later_polls(self):
+        self.failing.add('pg_stat_bgwriter')
+        self.fetch()
+        del self.connection.statements[:]
+        self.assertEqual(sorted(self.fetch()), ['locks', 'transactions'])
+        self.assertEqual(len(self.connection.statements), 2)
+        self.assertTrue(self.connection.statements[0].startswith(
+            postgresql.BGWRITER))
+        self.assertIn('AS locks', self.connection.statements[1])
+        self.assertNotIn('bgwriter', self.connection.statements[1])
+
+    def test_lost_connection_is_raised(self):
+        self.connection.lost = True
+        self.assertRaises(psycopg2.OperationalError, self.fetch)
+
+
+class PollTestCase(PostgreSQLTestCase):
+
+    def setUp(self):
+        super(PollTestCase, self).setUp()
+        self.set_results(postgresql.TRANSACTIONS,
+                         [{'transactions_committed': 5}])
+
+    def test_poll_is_one_round_trip_on_an_open_connection(self):
+        self.poll()
+        connection = self.connections[0]
+        del connection.statements[:]
+        self.poll()
+        self.assertEqual(len(self.connections), 1)
+        self.assertEqual(len(connection.statements), 1)
+        self.assertTrue(connection.statements[0].startswith('SELECT (SELECT'))
+
+    def test_reconnects_and_retries_once_when_the_connection_is_lost(self):
+        self.poll()
+        self.connections[0].lost = True
+        self.set_results(postgresql.TRANSACTIONS,
+                         [{'transactions_committed': 8}])
+        values = self.values(self.poll())
+        self.assertEqual(len(self.connections), 2)
+        self.assertEqual(self.connections[0].closed, 2)
+        self.assertEqual(
+            values['Component/Transactions/Committed[transactions]'], 3)
+
+    def test_poll_is_skipped_when_the_retry_fails(self):
+        self.poll()
+        self.connections[0].lost = True
+        self.refuse = True
+        plugin = self.poll()
+        self.assertEqual(plugin.derive_values, dict())
+        self.assertNotIn('connection', self.state)
+
+
+class QueryTiersTestCase(PostgreSQLTestCase):
+
+    CONFIG = dict(CONFIG, query_intervals={'transactions': 300})
+    COMMITTED = 'Component/Transactions/Committed[transactions]'
+
+    def set_committed(self, value):
+        self.set_results(postgresql.TRANSACTIONS,
+                         [{'transactions_committed': value}])
+
+    def batch(self):
+        return self.connections[0].statements[-1]
+
+    def test_group_runs_only_when_its_interval_has_passed(self):
+        self.set_committed(5)
+        self.poll(self.CONFIG)
+        self.assertIn('AS transactions', self.batch())
+        self.poll(self.CONFIG)
+        self.assertNotIn('AS transactions', self.batch())
+        self.assertIn('AS locks', self.batch())
+        self.state['query_tiers'][(None, 'transactions')]['refreshed'] -= 300
+        self.poll(self.CONFIG)
+        self.assertIn('AS transactions', self.batch())
+
+    def test_cached_values_are_reported_between_runs(self):
+        self.set_committed(5)
+        self.poll(self.CONFIG)
+        self.state['query_tiers'][(None, 'transactions')]['refreshed'] -= 300
+        self.set_committed(55)
+        self.assertEqual(self.values(self.poll(self.CONFIG))[self.COMMITTED],
+                         10)
+        self.set_committed(100)
+        self.assertEqual(self.values(self.poll(self.CONFIG))[self.COMMITTED],
+                         10)
+
+    def test_derive_values_are_spread_over_the_polls_between_runs(self):
+        self.set_committed(5)
+        self.poll(self.CONFIG)
+        self.state['query_tiers'][(None, 'transactions')]['refreshed'] -= 600
+        self.set_committed(125)
+        self.assertEqual(self.values(self.poll(self.CONFIG))[self.COMMITTED],
+                         12)
+
+    def test_groups_without_an_interval_run_every_poll(self):
+        self.poll()
+        self.poll()
+        self.assertIn('AS transactions', self.batch())
+        self.assertNotIn('query_tiers', self.state)
+
+
+class AddTopDeltasTestCase(unittest.TestCase):
+
+    METRICS = [('calls', 'Calls', 'calls'), ('total_time', 'Time', 'ms')]
+
+    def setUp(self):
+        self.plugin = postgresql.PostgreSQL({}, 60)
+        self.plugin._state = dict()
+
+    def run_once(self, rows, limit=1):
+        self.plugin.initialize()
+        self.plugin.add_top_deltas('Statements', rows, 'queryid',
+                                   lambda row: str(row['queryid']),
+                                   self.METRICS, 1, limit)
+        return dict((name, value['total'])
+                    for name, value in self.plugin.gauge_values.items())
+
+    def test_first_run_only_records_counters(self):
+        self.assertEqual(self.run_once([{'queryid': 1, 'calls': 5,
+                                         'total_time': 1.5}]), {})
+
+    def test_most_active_rows_and_other(self):
+        self.run_once([{'queryid': 1, 'calls': 5, 'total_time': 10},
+                       {'queryid': 2, 'calls': 100, 'total_time': 10},
+                       {'queryid': 3, 'calls': 1, 'total_time': 10}])
+        values = self.run_once(
+            [{'queryid': 1, 'calls': 15, 'total_time': 30},
+             {'queryid': 2, 'calls': 102, 'total_time': 90},
+             {'queryid': 3, 'calls': 2, 'total_time': 10},
+             {'queryid': 4, 'calls': 500, 'total_time': 500}])
+        self.assertEqual(values,
+                         {'Component/Statements/1/Calls[calls]': 10,
+                          'Component/Statements/1/Time[ms]': 20,
+                          'Component/Statements/Other/Calls[calls]': 3,
+                          'Component/Statements/Other/Time[ms]': 80})
+
+    def test_counter_reset_is_not_negative(self):
+        self.run_once([{'queryid': 1, 'calls': 50, 'total_time': 10}])
+        values = self.run_once([{'queryid': 1, 'calls': 5,
+                                 'total_time': 20}])
+        self.assertEqual(values['Component/Statements/1/Calls[calls]'], 0)
+        self.assertEqual(values['Component/Statements/1/Time[ms]'], 10)
+
+    def test_keeps_fractional_decimal_timings(self):
+        self.run_once([{'queryid': 1, 'calls': decimal.Decimal(1),
+                        'total_time': decimal.Decimal('0.25')}])
+        values = self.run_once([{'queryid': 1, 'calls': decimal.Decimal(3),
+                                 'total_time': decimal.Decimal('1.5')}])
+        self.assertEqual(values['Component/Statements/1/Calls[calls]'], 2)
+        self.assertEqual(values['Component/Statements/1/Time[ms]'], 1.25)
+
+    def test_rows_that_go_away_are_forgotten(self):
+        self.run_once([{'queryid': 1, 'calls': 1, 'total_time': 1}])
+        self.run_once([{'queryid': 2, 'calls': 1, 'total_time': 1}])
+        self.assertEqual(
+            self.plugin.state['activity_counters'][(None, 'Statements')],
+            {2: (1, 1)})
+
+    def test_discovered_database_counters_are_kept_apart(self):
+        self.plugin.database = 'db1'
+        self.run_once([{'queryid': 1, 'calls': 1, 'total_time': 1}])
+        self.assertEqual(sorted(self.plugin.state['activity_counters']),
+                         [('db1', 'Statements')])
+
+
+def table(relid, name, seq_scan):
+    return {'relid': relid, 'schemaname': 'public', 'relname': name,
+            'seq_scan': seq_scan, 'idx_scan': 0, 'n_tup_ins': 0,
+            'n_tup_upd': 0, 'n_tup_del': 0, 'heap_blks_read': 0,
+            'heap_blks_hit': 0}
+
+
+class RelationActivityTestCase(PostgreSQLTestCase):
+
+    CONFIG = dict(CONFIG, top_relations=1,
+                  query_intervals={'relation_activity': 600})
+    TABLE = 'Component/Tables/public.a/Scans/Sequential[scans]'
+    OTHER = 'Component/Tables/Other/Scans/Sequential[scans]'
+
+    def test_reported_changes_add_up_to_the_real_change(self):
+        self.set_results(postgresql.TABLE_ACTIVITY,
+                         [table(1, 'a', 0), table(2, 'b', 0)])
+        self.poll(self.CONFIG)
+        tier = self.state['query_tiers'][(None, 'relation_activity')]
+        tier['refreshed'] -= 600
+        self.set_results(postgresql.TABLE_ACTIVITY,
+                         [table(1, 'a', 100), table(2, 'b', 30)])
+        reported = list()
+        for _poll in range(10):
+            reported.append(self.values(self.poll(self.CONFIG)))
+        self.assertEqual([values[self.TABLE] for values in reported],
+                         [10.0] * 10)
+        self.assertEqual(sum(values[self.TABLE] for values in reported), 100)
+        self.assertEqual(sum(values[self.OTHER] for values in reported), 30)
+
+
+class Row(dict):
+    """A row that can also be indexed by column position, like a DictRow"""
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return self.values()[key]
+        return super(Row, self).__getitem__(key)
+
+
+def statement(queryid, calls, total_time):
+    return {'queryid': queryid, 'calls': calls, 'total_time': total_time,
+            'rows': calls}
+
+
+class StatementsTestCase(PostgreSQLTestCase):
+
+    CONFIG = dict(CONFIG, top_statements=1,
+                  query_intervals={'statements': 300})
+    TIME = 'Component/Statements/7/Time[ms]'
+    OTHER = 'Component/Statements/Other/Calls[calls]'
+
+    def setUp(self):
+        super(StatementsTestCase, self).setUp()
+        self.set_results(postgresql.STATEMENTS_EXTENSION,
+                         [Row(installed=1)])
+        self.query = postgresql.STATEMENTS % 'total_exec_time'
+
+    def fake_connect(self, **kwargs):
+        connection = super(StatementsTestCase, self).fake_connect(**kwargs)
+        connection.server_version = 130002
+        return connection
+
+    def test_reported_changes_add_up_to_the_real_change(self):
+        self.set_results(self.query, [statement(7, 10, 100.0),
+                                      statement(8, 1, 1.0)])
+        self.poll(self.CONFIG)
+        self.state['query_tiers'][(None, 'statements')]['refreshed'] -= 300
+        self.set_results(self.query, [statement(7, 20, 150.5),
+                                      statement(8, 6, 2.0)])
+        reported = list()
+        for _poll in range(5):
+            reported.append(self.values(self.poll(self.CONFIG)))
+        self.assertEqual([values[self.TIME] for values in reported],
+                         [10.1] * 5)
+        self.assertAlmostEqual(sum(values[self.TIME] for values in reported),
+                               50.5)
+        self.assertEqual(sum(values[self.OTHER] for values in reported), 5)
+
+
+class DiscoveredDatabasesTestCase(PostgreSQLTestCase):
+
+    CONFIG = dict(CONFIG, discover_databases=True, relation_stats=True,
+                  max_concurrency=2)
+    DATABASES = ['a', 'b', 'c', 'd', 'e']
+
+    def setUp(self):
+        super(DiscoveredDatabasesTestCase, self).setUp()
+        self.set_databases(self.DATABASES)
+        self.run_concurrently = postgresql.PostgreSQL.run_concurrently
+        self.max_threads = list()
+
+        def run_concurrently(plugin, tasks, max_threads=None):
+            self.max_threads.append(max_threads)
+            return self.run_concurrently(plugin, tasks, max_threads)
+        postgresql.PostgreSQL.run_concurrently = run_concurrently
+
+    def tearDown(self):
+        postgresql.PostgreSQL.run_concurrently = self.run_concurrently
+        super(DiscoveredDatabasesTestCase, self).tearDown()
+
+    def set_databases(self, databases):
+        self.set_results(postgresql.DATABASES,
+                         [{'datname': name} for name in databases])
+
+    def connected(self):
+        return sorted(connection.database for connection in self.connections
+                      if connection.database)
+
+    def test_connections_are_kept_for_more_databases_than_concurrency(self):
+        self.poll(self.CONFIG)
+        self.poll(self.CONFIG)
+        self.assertEqual(self.connected(), self.DATABASES)
+        self.assertEqual(sorted(self.state['database_connections']),
+                         self.DATABASES)
+        self.assertFalse(any(connection.closed
+                             for connection in self.connections))
+
+    def test_concurrency_is_bounded_by_max_concurrency(self):
+        self.poll(self.CONFIG)
+        self.assertEqual(self.max_threads, [2])
+
+    def test_max_connections_is_read_when_max_concurrency_is_not_set(self):
+        config = dict(self.CONFIG, max_connections=3)
+        del config['max_concurrency']
+        self.poll(config)
+        self.assertEqual(self.max_threads, [3])
+
+    def test_dropped_database_is_disconnected_and_pruned(self):
+        config = dict(self.CONFIG, query_intervals={'relations': 600})
+        self.poll(config)
+        dropped = self.state['database_connections']['e']
+        self.assertIn(('e', 'relations'), self.state['query_tiers'])
+        self.set_databases(self.DATABASES[:-1])
+        self.poll(config)
+        self.assertEqual(dropped.closed, 1)
+        self.assertNotIn('e', self.state['database_connections'])
+        self.assertNotIn(('e', 'relations'), self.state['query_tiers'])
+
+    def test_lost_database_connection_is_retried(self):
+        self.poll(self.CONFIG)
+        self.state['database_connections']['c'].lost = True
+        self.poll(self.CONFIG)
+        self.assertEqual(self.connected(), sorted(self.DATABASES + ['c']))
+        self.assertFalse(self.state['database_connections']['c'].closed)
+
+
+class CounterValueTestCase(unittest.TestCase):
+
+    def test_counter_value(self):
+        value = postgresql.PostgreSQL.counter_value
+        self.assertEqual(value(decimal.Decimal('12')), 12)
+        self.assertIsInstance(value(decimal.Decimal('12')), int)
+        self.assertEqual(value(decimal.Decimal('1.5')), 1.5)
+        self.assertEqual(value(2.5), 2.5)
+        self.assertEqual(value(None), 0)
@@ -0,0 +1,408 @@
+"""
+Tests for the RabbitMQ plugin
+
+"""
+import datetime
+import json
+import time
+import unittest
+
+from newrelic_plugin_agent.plugins import rabbitmq
+
+
+def values(plugin):
+    """Return the gauge and derive totals by metric name"""
+    totals = dict()
+    for metrics in (plugin.gauge_values, plugin.derive_values):
+        for name, value in metrics.items():
+            totals[name] = value['total']
+    return totals
+
+
+class FakeResponse(object):
+    """A management API response with the JSON encoded data"""
+
+    def __init__(self, status_code, data=None):
+        self.status_code = status_code
+        self.content = json.dumps(data)
+        self.elapsed = datetime.timedelta(milliseconds=10)
+
+
+class FakeRabbitMQ(rabbitmq.RabbitMQ):
+    """Answer each request with the responder, recording the URL and the
+    query string parameters.
+
+    """
+    def __init__(self, config, responder, state=None, last=None):
+        super(FakeRabbitMQ, self).__init__(config, 60, last)
+        self._state = dict() if state is None else state
+        self.responder = responder
+        self.requests = list()
+
+    def http_get(self, url, params=None):
+        self.requests.append((url, dict(params or dict())))
+        return self.responder(url, params or dict())
+
+
+class NodeIndexTestCase(unittest.TestCase):
+
+    CHANNELS = [{'node': 'rabbit@a', 'client_flow_blocked': True,
+                 'message_stats': {'publish': 5, 'ack': 2}},
+                {'node': 'rabbit@a', 'message_stats': {'publish': 1}},
+                {'node': 'rabbit@b'}]
+    QUEUES = [{'node': 'rabbit@a', 'consumers': 2, 'active_consumers': 1,
+               'messages_ready': 10, 'messages_unacknowledged': 1},
+              {'node': 'rabbit@b', 'consumers': 1, 'active_consumers': 1,
+               'messages_ready': 3},
+              {'node': 'rabbit@b'}]
+
+    def setUp(self):
+        self.plugin = rabbitmq.RabbitMQ({}, 60)
+        self.plugin._state = dict()
+        self.plugin.consumers = 0
+
+    def test_index_channels(self):
+        index = self.plugin.index_channels(self.CHANNELS)
+        self.assertEqual(sorted(index), ['a', 'b'])
+        self.assertEqual(index['a']['channels'], 2)
+        self.assertEqual(index['a']['channels_blocked'], 1)
+        self.assertEqual(index['a']['message_stats']['publish'], 6)
+        self.assertEqual(index['a']['message_stats']['ack'], 2)
+        self.assertEqual(index['b']['channels'], 1)
+        self.assertEqual(index['b']['message_stats']['publish'], 0)
+
+    def test_index_queues(self):
+        self.assertEqual(self.plugin.index_queues(self.QUEUES),
+                         {'a': {'queues': 1, 'consumers': 2,
+                                'active_consumers': 1, 'messages_ready': 10,
+                                'messages_unacknowledged': 1},
+                          'b': {'queues': 2, 'consumers': 1,
+                                'active_consumers': 1, 'messages_ready': 3,
+                                'messages_unacknowledged': 0}})
+
+    def test_node_datapoints_from_the_indexes(self):
+        self.plugin.add_node_datapoints(
+            [{'name': 'rabbit@a', 'proc_used': 10}, {'name': 'rabbit@c'}],
+            self.plugin.index_channels(self.CHANNELS),
+            self.plugin.index_queues(self.QUEUES))
+        metrics = values(self.plugin)
+        self.assertEqual(metrics['Component/Node/a/Channels/Open[channels]'],
+                         2)
+        self.assertEqual(
+            metrics['Component/Node/a/Channels/Blocked[channels]'], 1)
+        self.assertEqual(
+            metrics['Component/Node/a/Consumers/Idle[consumers]'], 1)
+        self.assertEqual(
+            metrics['Component/Node/a/Messages Available[messages]'], 10)
+        self.assertEqual(
+            metrics['Component/Node/a/Erlang Processes[processes]'], 10)
+        self.assertEqual(metrics['Component/Node/c/Channels/Open[channels]'],
+                         0)
+        self.assertEqual(metrics['Component/Summary/Channels[channels]'], 2)
+        self.assertEqual(metrics['Component/Summary/Consumers[consumers]'], 2)
+        self.assertNotIn('Component/Node/b/Channels/Open[channels]', metrics)
+
+    def test_node_datapoints_without_messages(self):
+        self.plugin.add_node_datapoints(
+            [{'name': 'rabbit@a'}], self.plugin.index_channels(self.CHANNELS),
+            dict(), messages=False)
+        self.assertFalse([name for name in values(self.plugin)
+                          if '/Messages' in name])
+
+
+def pages(items, page_size, status_code=200):
+    """Return a responder that pages through the items"""
+    def responder(url, params):
+        page = params['page']
+        return FakeResponse(status_code, {
+            'items': items[(page - 1) * page_size:page * page_size],
+            'page': page, 'page_count': (len(items) - 1) // page_size + 1})
+    return responder
+
+
+class FetchDataTestCase(unittest.TestCase):
+
+    def test_requests_only_the_consumed_columns(self):
+        plugin = FakeRabbitMQ({}, lambda url, params: FakeResponse(200, []))
+        plugin.fetch_node_data()
+        self.assertEqual(plugin.requests,
+                         [('http://localhost:80/api/nodes',
+                           {'columns': 'name,proc_used,fd_used,mem_used,'
+                                       'sockets_used'})])
+
+    def test_listing_is_paginated(self):
+        plugin = FakeRabbitMQ({'page_size': 2}, pages(range(5), 2))
+        self.assertEqual(plugin.fetch_data('queues', ['name'], True),
+                         range(5))
+        self.assertEqual([params['page'] for url, params in plugin.requests],
+                         [1, 2, 3])
+        self.assertEqual(plugin.requests[0][1]['page_size'], 2)
+        self.assertEqual(plugin.requests[0][1]['columns'], 'name')
+
+    def test_server_without_pagination(self):
+        plugin = FakeRabbitMQ({}, lambda url, params: FakeResponse(200,
+                                                                  [1, 2]))
+        self.assertEqual(plugin.fetch_data('queues', None, True), [1, 2])
+        self.assertEqual(len(plugin.requests), 1)
+
+    def test_pagination_disabled(self):
+        plugin = FakeRabbitMQ({'page_size': 0},
+                              lambda url, params: FakeResponse(200, [1]))
+        self.assertEqual(plugin.fetch_data('queues', None, True), [1])
+        self.assertEqual(plugin.requests[0][1], dict())
+
+    def test_failed_page_discards_the_listing(self):
+        responder = pages(range(5), 2)
+
+        def failing(url, params):
+            if params['page'] == 2:
+                return FakeResponse(404)
+            return responder(url, params)
+
+        plugin = FakeRabbitMQ({'page_size': 2}, failing)
+        self.assertIsNone(plugin.fetch_data('queues', None, True))
+        self.assertEqual(len(plugin.requests), 2)
+
+    def test_poll_fetches_the_listings(self):
+        plugin = FakeRabbitMQ({}, lambda url, params: FakeResponse(200, []))
+        plugin.poll()
+        self.assertEqual(sorted(url.rsplit('/', 1)[1]
+                                for url, params in plugin.requests),
+                         ['channels', 'nodes', 'queues'])
+
+    def test_failed_listing_is_not_reported_as_zero(self):
+        def responder(url, params):
+            if url.endswith('/queues'):
+                return FakeResponse(404)
+            if url.endswith('/nodes'):
+                return FakeResponse(200, [{'name': 'rabbit@a'}])
+            return FakeResponse(200, [])
+
+        plugin = FakeRabbitMQ({}, responder)
+        plugin.poll()
+        metrics = values(plugin)
+        self.assertIn('Component/Node/a/Memory[bytes]', metrics)
+        self.assertFalse([name for name in metrics if 'Messages' in name])
+
+
+class QueueFilterTestCase(unittest.TestCase):
+
+    def track(self, config, vhost, queue):
+        plugin = rabbitmq.RabbitMQ(config, 60)
+        plugin._state = dict()
+        return plugin.track_vhost_queue(vhost, queue)
+
+    def test_default_excludes_generated_queues(self):
+        self.assertTrue(self.track({}, '/', 'work'))
+        self.assertFalse(self.track({}, '/', 'amq.gen-JzTY20BRgKO'))
+
+    def test_global_exclusions(self):
+        config = {'exclude_queues': ['tmp.*', 're:^celery[0-9]+$']}
+        self.assertFalse(self.track(config, '/', 'tmp.1'))
+        self.assertFalse(self.track(config, '/', 'celery42'))
+        self.assertTrue(self.track(config, '/', 'celery'))
+        self.assertTrue(self.track(config, '/', 'amq.gen-1'))
+
+    def test_only_configured_vhosts(self):
+        config = {'vhosts': {'Default': None, 'app': {'queues': ['jobs']}}}
+        self.assertTrue(self.track(config, '/', 'anything'))
+        self.assertTrue(self.track(config, 'app', 'jobs'))
+        self.assertFalse(self.track(config, 'app', 'other'))
+        self.assertFalse(self.track(config, 'other', 'jobs'))
+
+    def test_vhost_include_and_exclude_patterns(self):
+        config = {'vhosts': {'app': {'queues': ['audit'],
+                                     'include': ['orders.*'],
+                                     'exclude': ['orders.dead*']}}}
+        self.assertTrue(self.track(config, 'app', 'audit'))
+        self.assertTrue(self.track(config, 'app', 'orders.eu'))
+        self.assertFalse(self.track(config, 'app', 'orders.dead-letter'))
+        self.assertFalse(self.track(config, 'app', 'invoices'))
+
+    def test_filter_is_compiled_once_per_target(self):
+        state, compiled = dict(), list()
+
+        class Counting(rabbitmq.RabbitMQ):
+            def compile_queue_filter(self):
+                compiled.append(True)
+                return super(Counting, self).compile_queue_filter()
+
+        for _poll in range(3):
+            plugin = Counting({}, 60)
+            plugin._state = state
+            plugin.track_vhost_queue('/', 'work')
+        self.assertEqual(len(compiled), 1)
+
+    def test_untracked_queues_are_not_reported(self):
+        plugin = rabbitmq.RabbitMQ({}, 60)
+        plugin._state = dict()
+        plugin.add_queue_datapoints([{'vhost': '/', 'name': 'work'},
+                                     {'vhost': '/', 'name': 'amq.gen-1'}])
+        names = [name for name in values(plugin) if '/Queue/' in name]
+        self.assertTrue(names)
+        self.assertFalse([name for name in names if 'amq.gen' in name])
+
+
+class OverviewTestCase(unittest.TestCase):
+
+    CONFIG = {'overview': True, 'queue_interval': 300}
+
+    def setUp(self):
+        self.state, self.last, self.published = dict(), None, 100
+
+    def responder(self, url, params):
+        data_type = url.rsplit('/', 1)[1]
+        if data_type == 'overview':
+            return FakeResponse(200, {
+                'message_stats': {'publish': self.published * 2},
+                'queue_totals': {'messages_ready': 7},
+                'object_totals': {'channels': 3, 'consumers': 4,
+                                  'queues': 5}})
+        if data_type == 'vhosts':
+            return FakeResponse(200, [{'name': '/', 'messages_ready': 7}])
+        if data_type == 'nodes':
+            return FakeResponse(200, [{'name': 'rabbit@a'}])
+        if data_type == 'channels':
+            return FakeResponse(200, [{'node': 'rabbit@a'}])
+        return FakeResponse(200, [{'node': 'rabbit@a', 'vhost': '/',
+                                   'name': 'work', 'messages_ready': 7,
+                                   'message_stats': {
+                                       'publish': self.published}}])
+
+    def poll(self):
+        plugin = FakeRabbitMQ(self.CONFIG, self.responder, self.state,
+                              self.last)
+        plugin.poll()
+        self.last = plugin.derive_last_interval
+        return plugin, values(plugin)
+
+    @staticmethod
+    def data_types(plugin):
+        return sorted(url.rsplit('/', 1)[1] for url, params in plugin.requests)
+
+    def test_summary_comes_from_the_overview(self):
+        plugin, metrics = self.poll()
+        self.assertEqual(self.data_types(plugin),
+                         ['channels', 'nodes', 'overview', 'queues',
+                          'vhosts'])
+        self.assertEqual(metrics['Component/Summary/Queues[queues]'], 5)
+        self.assertEqual(metrics['Component/Summary/Channels[channels]'], 3)
+        self.assertEqual(
+            metrics['Component/Vhost/Default/Messages Available[messages]'],
+            7)
+        self.assertIn('Component/Queue/Default/work/Consumers[consumers]',
+                      metrics)
+
+    def test_listings_are_skipped_until_the_queue_interval(self):
+        self.poll()
+        plugin, metrics = self.poll()
+        self.assertEqual(self.data_types(plugin),
+                         ['nodes', 'overview', 'vhosts'])
+        self.assertEqual(metrics['Component/Node/a/Channels/Open[channels]'],
+                         1)
+        self.assertFalse([name for name in metrics
+                          if name.startswith('Component/Queue/') or
+                          '/Node/a/Messages' in name])
+
+    def test_listing_values_are_spread_over_the_skipped_polls(self):
+        self.poll()
+        self.state['queue_listing'] -= 300
+        self.published = 600
+        plugin, metrics = self.poll()
+        self.assertEqual(
+            metrics['Component/Queue/Default/work/Messages/Published'
+                    '[messages]'], 100)
+        self.assertEqual(
+            metrics['Component/Summary/Messages/Published[messages]'], 1000)
+
+    def test_listing_is_due_after_the_queue_interval(self):
+        plugin = FakeRabbitMQ(self.CONFIG, self.responder, self.state)
+        self.assertTrue(plugin.queue_listing_due())
+        self.state['queue_listing'] = time.time() - 100
+        self.assertFalse(plugin.queue_listing_due())
+        self.state['queue_listing'] = time.time() - 300
+        self.assertTrue(plugin.queue_listing_due())
+
+
+class FailoverTestCase(unittest.TestCase):
+
+    CONFIG = {'hosts': ['a', 'b'], 'port': 15672}
+    A, B = 'http://a:15672/api', 'http://b:15672/api'
+
+    def test_base_urls(self):
+        plugin = rabbitmq.RabbitMQ({'hosts': ['a', 'b:15673', '::1',
+                                              '[::1]:15674', '[fe80::1]'],
+                                    'port': 15672, 'secure': True}, 60)
+        self.assertEqual(plugin.base_urls,
+                         ['https://a:15672/api', 'https://b:15673/api',
+                          'https://[::1]:15672/api',
+                          'https://[::1]:15674/api',
+                          'https://[fe80::1]:15672/api'])
+
+    def test_single_host(self):
+        plugin = rabbitmq.RabbitMQ({'host': 'mq', 'port': 15672}, 60)
+        self.assertEqual(plugin.base_urls, ['http://mq:15672/api'])
+
+    def test_fails_over_on_server_errors(self):
+        def responder(url, params):
+            if url.startswith(self.A):
+                return FakeResponse(503)
+            return FakeResponse(200, [1])
+
+        plugin = FakeRabbitMQ(self.CONFIG, responder)
+        self.assertEqual(plugin.fetch_json('nodes', dict()), (self.B, [1]))
+        self.assertEqual([url for url, params in plugin.requests],
+                         [self.A + '/nodes', self.B + '/nodes'])
+        self.assertEqual(plugin.endpoints(), [self.B, self.A])
+
+    def test_client_errors_do_not_fail_over(self):
+        plugin = FakeRabbitMQ(self.CONFIG,
+                              lambda url, params: FakeResponse(404))
+        self.assertEqual(plugin.fetch_json('nodes', dict()), (self.A, None))
+        self.assertEqual(len(plugin.requests), 1)
+
+    def test_backoff_doubles_up_to_the_maximum(self):
+        plugin = FakeRabbitMQ(self.CONFIG, None)
+        backoffs = list()
+        for _failure in range(7):
+            plugin.mark_unhealthy(self.A)
+            health = plugin.endpoint_health[self.A]
+            backoffs.append(int(round(health['retry_at'] - time.time())))
+            health['retry_at'] = 0
+        self.assertEqual(backoffs, [30, 60, 120, 240, 480, 600, 600])
+
+    def test_failures_while_backing_off_are_not_counted(self):
+        plugin = FakeRabbitMQ(self.CONFIG, None)
+        plugin.mark_unhealthy(self.A)
+        plugin.mark_unhealthy(self.A)
+        self.assertEqual(plugin.endpoint_health[self.A]['failures'], 1)
+
+    def test_success_resets_the_backoff(self):
+        plugin = FakeRabbitMQ(self.CONFIG, None)
+        plugin.mark_unhealthy(self.A)
+        plugin.mark_healthy(self.A, 0.2)
+        self.assertEqual(plugin.endpoint_health[self.A],
+                         {'failures': 0, 'latency': 0.2, 'retry_at': 0})
+
+    def test_endpoints_by_latency(self):
+        plugin = FakeRabbitMQ(self.CONFIG, None)
+        plugin.mark_healthy(self.A, 0.5)
+        plugin.mark_healthy(self.B, 0.1)
+        self.assertEqual(plugin.endpoints(), [self.B, self.A])
+        plugin.mark_healthy(self.B, 1.5)
+        self.assertAlmostEqual(plugin.endpoint_health[self.B]['latency'],
+                               0.52)
+        self.assertEqual(plugin.endpoints(), [self.A, self.B])
+
+    def test_pages_come_from_the_first_endpoint(self):
+        responder = pages(range(5), 2)
+
+        def failing(url, params):
+            if url.startswith(self.A) and params['page'] == 2:
+                return FakeResponse(503)
+            return responder(url, params)
+
+        plugin = FakeRabbitMQ(dict(self.CONFIG, page_size=2), failing)
+        self.assertIsNone(plugin.fetch_data('queues', None, True))
+        self.assertEqual([url for url, params in plugin.requests],
+                         [self.A + '/queues', self.A + '/queues'])
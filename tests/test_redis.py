@@ -0,0 +1,171 @@
+"""
+Tests for the Redis plugin
+
+"""
+import socket
+import unittest
+
+from newrelic_plugin_agent.plugins import redis
+
+
+class FakeConnection(object):
+    """A socket that returns the given chunks from recv"""
+
+    def __init__(self, *chunks):
+        self.chunks = list(chunks)
+
+    def recv(self, size):
+        return self.chunks.pop(0) if self.chunks else ''
+
+
+class RESPReaderTestCase(unittest.TestCase):
+
+    def read(self, *chunks):
+        return redis.RESPReader(FakeConnection(*chunks)).read_reply()
+
+    def test_simple_string(self):
+        self.assertEqual(self.read('+OK\r\n'), 'OK')
+
+    def test_integer(self):
+        self.assertEqual(self.read(':-42\r\n'), -42)
+
+    def test_bulk_string(self):
+        self.assertEqual(self.read('$8\r\nab\r\ncdef\r\n'), 'ab\r\ncdef')
+
+    def test_null_bulk_string_and_array(self):
+        self.assertIsNone(self.read('$-1\r\n'))
+        self.assertIsNone(self.read('*-1\r\n'))
+
+    def test_error_is_returned(self):
+        reply = self.read('-ERR unknown command\r\n')
+        self.assertIsInstance(reply, redis.ReplyError)
+        self.assertEqual(str(reply), 'ERR unknown command')
+
+    def test_nested_array(self):
+        self.assertEqual(self.read('*3\r\n:1\r\n*2\r\n+a\r\n$1\r\nb\r\n$0\r\n'
+                                   '\r\n'), [1, ['a', 'b'], ''])
+
+    def test_reply_split_across_chunks(self):
+        self.assertEqual(self.read('*2\r\n$5\r\nhe', 'llo\r', '\n:', '7\r\n'),
+                         ['hello', 7])
+
+    def test_pipelined_replies_share_the_buffer(self):
+        reader = redis.RESPReader(FakeConnection('+OK\r\n:1\r\n$1\r\nx\r\n'))
+        self.assertEqual([reader.read_reply() for _offset in range(3)],
+                         ['OK', 1, 'x'])
+
+    def test_unexpected_reply(self):
+        self.assertRaises(redis.ProtocolError, self.read, 'HTTP/1.1 400\r\n')
+
+    def test_connection_closed(self):
+        self.assertRaises(socket.error, self.read, '$10\r\nabc')
+
+
+class ParseInfoTestCase(unittest.TestCase):
+
+    INFO = ('# Server\r\n'
+            'redis_version:3.2.8\r\n'
+            'uptime_in_seconds:100\r\n'
+            'mem_fragmentation_ratio:1.25\r\n'
+            '\r\n'
+            '# Commandstats\r\n'
+            'cmdstat_get:calls=5,usec=20,usec_per_call=4.00\r\n'
+            '# Keyspace\r\n'
+            'db0:keys=10,expires=2,avg_ttl=0\r\n')
+
+    def test_parse_info(self):
+        self.assertEqual(redis.Redis.parse_info(self.INFO),
+                         {'redis_version': '3.2.8',
+                          'uptime_in_seconds': 100,
+                          'mem_fragmentation_ratio': 1.25,
+                          'cmdstat_get': {'calls': 5, 'usec': 20,
+                                          'usec_per_call': 4.0},
+                          'db0': {'keys': 10, 'expires': 2, 'avg_ttl': 0}})
+
+    def test_empty_info(self):
+        self.assertEqual(redis.Redis.parse_info(''), {})
+
+
+
+class ParseClusterNodesTestCase(unittest.TestCase):
+
+    NODES = '\n'.join([
+        'a1 10.0.0.1:7000@17000 myself,master - 0 0 1 connected 0-5460',
+        'b2 10.0.0.2:7001@17001 slave a1 0 1 1 connected',
+        'c3 10.0.0.3:7002@17002,host-c master,fail - 0 1 2 connected',
+        'd4 10.0.0.4:7003 slave,fail? c3 0 1 2 connected',
+        'e5 :0@0 master,noaddr - 0 1 3 disconnected',
+        'f6 10.0.0.6:7005@17005 handshake - 0 1 0 connected',
+        'truncated line', ''])
+
+    def test_parse_cluster_nodes(self):
+        self.assertEqual(redis.Redis.parse_cluster_nodes(self.NODES),
+                         [{'address': '10.0.0.1:7000', 'master': True,
+                           'failed': False},
+                          {'address': '10.0.0.2:7001', 'master': False,
+                           'failed': False},
+                          {'address': '10.0.0.3:7002', 'master': True,
+                           'failed': True},
+                          {'address': '10.0.0.4:7003', 'master': False,
+                           'failed': True}])
+
+
+class ClusterRollupTestCase(unittest.TestCase):
+
+    CONFIG = {'name': 'cluster', 'host': '10.0.0.1', 'port': 7000,
+              'cluster': True}
+    NODES = [{'address': '10.0.0.1:7000', 'master': True, 'failed': False},
+             {'address': '10.0.0.2:7001', 'master': False, 'failed': False},
+             {'address': '10.0.0.3:7002', 'master': True, 'failed': True}]
+    INFO = {'cluster_state': 'ok', 'cluster_slots_assigned': 16384,
+            'cluster_slots_fail': 0, 'cluster_known_nodes': 3}
+
+    def setUp(self):
+        self.plugin = redis.Redis(self.CONFIG, 60)
+        self.plugin._state = dict()
+
+    def add_node(self, address, keys, memory, commands):
+        host, _separator, port = address.rpartition(':')
+        child = self.plugin.add_child(address, dict(
+            self.CONFIG, name=address, host=host, port=int(port),
+            cluster=False))
+        child.add_gauge_value('Keys/Total', 'keys', keys)
+        child.add_gauge_value('Memory Use', 'bytes', memory)
+        child.derive_values[child.metric_name('Commands Processed',
+                                              'commands')] = \
+            child.metric_payload(commands)
+        return child
+
+    def gauge(self, name, unit):
+        return self.plugin.gauge_values[
+            self.plugin.metric_name(name, unit)]['total']
+
+    def test_node_counts_and_cluster_info(self):
+        self.add_node('10.0.0.1:7000', 10, 100, 5)
+        self.plugin.add_child('10.0.0.3:7002', dict(self.CONFIG))
+        self.plugin.add_cluster_datapoints(self.INFO, self.NODES)
+        self.assertEqual(self.gauge('Cluster/State OK', 'state'), 1)
+        self.assertEqual(self.gauge('Cluster/Slots/Assigned', 'slots'),
+                         16384)
+        self.assertEqual(self.gauge('Cluster/Nodes/Masters', 'nodes'), 2)
+        self.assertEqual(self.gauge('Cluster/Nodes/Replicas', 'nodes'), 1)
+        self.assertEqual(self.gauge('Cluster/Nodes/Failed', 'nodes'), 1)
+        self.assertEqual(self.gauge('Cluster/Nodes/Unreachable', 'nodes'), 1)
+
+    def test_values_are_summed_over_the_nodes(self):
+        self.add_node('10.0.0.1:7000', 10, 100, 5)
+        self.add_node('10.0.0.2:7001', 10, 150, 7)
+        self.add_node('10.0.0.3:7002', 20, 200, 11)
+        self.plugin.add_cluster_datapoints(None, self.NODES)
+        self.assertEqual(self.gauge('Memory Use', 'bytes'), 450)
+        self.assertEqual(self.gauge('Commands Processed', 'commands'), 23)
+        self.assertEqual(self.gauge('Clients/Blocked', 'clients'), 0)
+
+    def test_keys_are_summed_over_the_masters_only(self):
+        self.add_node('10.0.0.1:7000', 10, 100, 5)
+        self.add_node('10.0.0.2:7001', 10, 150, 7)
+        self.add_node('10.0.0.3:7002', 20, 200, 11)
+        self.plugin.add_cluster_datapoints(None, self.NODES)
+        self.assertEqual(self.gauge('Keys/Total', 'keys'), 30)
+        self.assertNotIn(self.plugin.metric_name('Cluster/State OK', 'state'),
+                         self.plugin.gauge_values)